@@ -1,4 +1,7 @@
-from django.db import models
+from itertools import groupby
+
+from django.db import models, connection, transaction
+from django.db.models import Q
 
 # Create your models here.
 
@@ -8,3 +11,139 @@ class TimeStampable(models.Model):
 
   class Meta:
     abstract = True
+
+class Heritable(models.Model):
+  """
+  Stores where a row sits in its family tree, so the tree can be read
+  without following ``father`` and ``mother`` one row at a time.  Models
+  using it define those two foreign keys themselves.
+
+  ``ancestry`` holds the ids of the ancestors up to ``ANCESTRY_DEPTH``
+  generations back, one group per generation, nearest first, as in
+  ``" 12 15 / 3 4 7 / 1 "``.  Descendants are found a generation at a time
+  through the ``father`` and ``mother`` keys, which are indexed, to the same
+  depth.
+
+  Both limits are deliberate.  Hashes are bred from a few dozen parents a
+  generation, so after a few generations a row's whole family is most of
+  the table.  Ancestors are drawn from those few dozen parents, so keeping
+  them to ``ANCESTRY_DEPTH`` generations bounds the stored ancestry, but a
+  good row has dozens of children a generation.  Only the first
+  ``LINEAGE_WIDTH`` of each generation of descendants by ``LINEAGE_ORDER``
+  are kept, and only their children are followed, so the lineage page reads
+  and shows at most ``ANCESTRY_DEPTH * LINEAGE_WIDTH`` descendants.
+  """
+  ANCESTRY_DEPTH = 6
+  LINEAGE_WIDTH = 50
+  LINEAGE_ORDER = ('-id', )
+
+  generation = models.IntegerField(default = 0, db_index = True)
+  ancestry = models.TextField(default = '', blank = True, editable = False)
+
+  class Meta:
+    abstract = True
+
+  @classmethod
+  def format_ancestry(cls, levels):
+    return ' ' + ' / '.join(' '.join(str(pk) for pk in level) for level in levels) + ' ' if levels else ''
+
+  @property
+  def ancestor_levels(self):
+    """
+    Ancestor ids grouped by generation, parents first.
+    """
+    return [[int(pk) for pk in level.split()] for level in self.ancestry.split('/') if level.strip()]
+
+  @property
+  def ancestor_ids(self):
+    return [pk for level in self.ancestor_levels for pk in level]
+
+  @classmethod
+  def descend(cls, parents):
+    """
+    ``(generation, ancestor levels)`` of a child of ``parents``, each given
+    as ``(id, generation, ancestor levels)``.
+    """
+    if not parents:
+      return 0, []
+    levels = [sorted(set(pk for pk, generation, ancestors in parents))]
+    seen = set(levels[0])
+    for depth in range(cls.ANCESTRY_DEPTH - 1):
+      level = set()
+      for pk, generation, ancestors in parents:
+        if depth < len(ancestors):
+          level.update(ancestors[depth])
+      level -= seen
+      if not level:
+        break
+      seen |= level
+      levels.append(sorted(level))
+    return max(generation for pk, generation, ancestors in parents) + 1, levels
+
+  def inherit(self, *parents):
+    """
+    Set ``generation`` and ``ancestry`` from ``parents``, which must already
+    have theirs.
+    """
+    self.generation, levels = self.descend([(p.id, p.generation, p.ancestor_levels) for p in parents if p != None])
+    self.ancestry = self.format_ancestry(levels)
+
+  def descendants(self):
+    """
+    Rows descended from this one within ``ANCESTRY_DEPTH`` generations, the
+    first ``LINEAGE_WIDTH`` of each by ``LINEAGE_ORDER``.  One query per
+    generation down, at most ``ANCESTRY_DEPTH``.
+    """
+    descendants = []
+    seen = set([self.id])
+    frontier = [self.id]
+    for depth in range(self.ANCESTRY_DEPTH):
+      children = self.__class__.objects.filter(Q(father__in = frontier) | Q(mother__in = frontier)).exclude(pk__in = seen)
+      level = list(children.order_by(*self.LINEAGE_ORDER)[:self.LINEAGE_WIDTH])
+      if not level:
+        break
+      descendants += level
+      frontier = [row.id for row in level]
+      seen.update(frontier)
+    return descendants
+
+  def family(self):
+    """
+    ``(ancestors, descendants)`` within ``ANCESTRY_DEPTH`` generations, each
+    a list of rows sorted by generation.  At most ``ANCESTRY_DEPTH + 1``
+    queries, however large the table.
+    """
+    ancestors = list(self.__class__.objects.filter(pk__in = self.ancestor_ids).order_by('generation', 'id'))
+    descendants = sorted(self.descendants(), key = lambda row: (row.generation, row.id))
+    return ancestors, descendants
+
+  @staticmethod
+  def by_generation(rows):
+    """
+    ``[(generation, rows), ...]`` for rows already sorted by generation.
+    """
+    return [(generation, list(group)) for generation, group in groupby(rows, lambda row: row.generation)]
+
+  @classmethod
+  def rebuild_lineage(cls, batch_size = 1000):
+    """
+    Fill in ``generation`` and ``ancestry`` for every row from the parent
+    foreign keys.  Parents are created before their children, so rows are
+    visited in id order.
+    """
+    lineage = {}
+    updates = []
+    for pk, father_id, mother_id in cls.objects.order_by('id').values_list('id', 'father', 'mother'):
+      parents = [(p, ) + lineage[p] for p in (father_id, mother_id) if p in lineage]
+      lineage[pk] = cls.descend(parents)
+      generation, levels = lineage[pk]
+      updates.append((generation, cls.format_ancestry(levels), pk))
+
+    qn = connection.ops.quote_name
+    sql = 'UPDATE %s SET %s = %%s, %s = %%s WHERE %s = %%s'%(qn(cls._meta.db_table), qn('generation'), qn('ancestry'), qn(cls._meta.pk.column))
+    cursor = connection.cursor()
+    for i in range(0, len(updates), batch_size):
+      with transaction.commit_on_success():
+        cursor.executemany(sql, updates[i:i+batch_size])
+        transaction.set_dirty()
+    return len(updates)
@@ -0,0 +1,233 @@
+"""Micro-benchmarks for the distance, nearest neighbor and hash hot paths.
+
+Runs against a synthetic corpus built in memory, so nothing is read from the
+database or from image files, and prints the results as JSON.  Given the
+JSON of an earlier run as a baseline, each case is compared against it and
+the run fails if one got slower by more than the threshold.
+
+  python -m mosy.benchmark --output bench.json
+  python -m mosy.benchmark --baseline bench.json
+
+Tiles are 50 pixels by default rather than the usual 100, which keeps a full
+run of the default 1000 tiles to about half a minute (28 seconds when last
+measured, most of it in ``LSH.evaluate``); pass ``--size 100`` to time full
+size tiles.  The neighbor graph is built before ``LSH.evaluate`` is timed, as
+it is stored in production, and ``LSH.evaluate`` is ``LSH.test`` without the
+save.  It needs at least 500 tiles.
+"""
+
+import json
+import os
+import platform
+import sys
+
+from optparse import OptionParser
+from random import Random, seed
+from time import time
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mosy.settings')
+
+import numpy
+
+from mosy.knn.models import LSH
+from mosy.mosaic.calibration import Calibration
+from mosy.mosaic.distance import DistanceEngine
+from mosy.mosaic.features import str_from_rgb
+from mosy.mosaic.graph import KNNGraph
+from mosy.mosaic.models import Tile
+
+VERSION = 1
+STATE = ('_POINTS', '_ENGINE', '_GRAPH', '_COMPONENTS', '_RADIUS', '_TOLERANCE', '_SNAPSHOT', '_KNN_ENGINE', '_KNN')
+WEIGHT = (20.0, 20.0, 20.0, 20.0, 20.0)
+
+def synthetic_points(count, size = 100, clusters = 50, spread = 12.0, rand_seed = 1):
+  """
+  ``{id: tile}`` of ``count`` tiles with their features filled in, drawn
+  around ``clusters`` random centres so every tile has close neighbors.
+  """
+  rand = numpy.random.RandomState(rand_seed)
+  dimension = (size / Tile.CHUNK_SIZE)**2 * 3
+  centres = rand.uniform(0, 255, (clusters, dimension))
+  points = {}
+  for pk in range(1, count + 1):
+    rgb = centres[rand.randint(clusters)] + rand.normal(0, spread, dimension)
+    tile = Tile(id = pk, size = size)
+    tile._rgb_list = tuple(rgb.clip(0, 255).tolist())
+    tile._str_list = str_from_rgb(tile._rgb_list)
+    points[pk] = tile
+  return points
+
+def synthetic_hash(dimension, rand):
+  lsh = LSH()
+  lsh.generate(dimension = dimension, commit = False)
+  lsh.score = rand.uniform(0, 50)
+  return lsh
+
+def measure(fn, repeat = 5, min_time = 0.1):
+  """
+  ``(best, median, number)``: the time of one call of ``fn`` in the fastest
+  and the median of ``repeat`` batches, each long enough to take at least
+  ``min_time`` seconds.  ``fn`` is passed the index of the call.
+  """
+  number = 1
+  while True:
+    start = time()
+    for i in range(number):
+      fn(i)
+    if time() - start >= min_time:
+      break
+    number *= 2
+  times = []
+  for r in range(repeat):
+    start = time()
+    for i in range(number):
+      fn(i)
+    times.append((time() - start) / number)
+  times.sort()
+  return times[0], times[len(times)/2], number
+
+def cases(points, rand):
+  """
+  ``[(name, fn), ...]`` over the corpus installed on ``Tile``.
+  """
+  ids = sorted(points.keys())
+  pairs = [(points[rand.choice(ids)], points[rand.choice(ids)]) for i in range(64)]
+  queries = [points[rand.choice(ids)] for i in range(64)]
+  dimension = Tile.ENGINE.dimension
+  hashes = [synthetic_hash(dimension, rand) for i in range(64)]
+
+  def evaluate(i):
+    lsh = hashes[i % len(hashes)]
+    lsh.evaluate()
+
+  def breed(i):
+    LSH.breed(hashes[i % len(hashes)], hashes[(i + 1) % len(hashes)], commit = False)
+
+  return [
+    ('Tile.distance', lambda i: Tile.distance(*pairs[i % len(pairs)])),
+    ('Tile.levenshtein', lambda i: Tile.levenshtein(*pairs[i % len(pairs)])),
+    ('Tile.mse', lambda i: Tile.mse(*pairs[i % len(pairs)])),
+    ('DistanceEngine.distance', lambda i: Tile.ENGINE.distance(queries[i % len(queries)])),
+    ('Tile.get_nn', lambda i: queries[i % len(queries)].get_nn(WEIGHT)),
+    ('Tile.get_knn', lambda i: queries[i % len(queries)].get_knn(WEIGHT)),
+    ('LSH.project', lambda i: hashes[i % len(hashes)].project(queries[i % len(queries)])),
+    ('LSH.project_many', lambda i: hashes[i % len(hashes)].project_many(Tile.ENGINE.matrix)),
+    ('LSH.evaluate', evaluate),
+    ('LSH.breed', breed),
+    ]
+
+def run(count = 1000, size = 50, only = None, repeat = 5, min_time = 0.1, rand_seed = 1):
+  """
+  Time every case, or those named in ``only``, against ``count`` synthetic
+  tiles of ``size`` pixels.  Returns the results as a dict ready for JSON.
+  """
+  saved = dict((key, Tile.__dict__[key]) for key in STATE if key in Tile.__dict__)
+  try:
+    points = synthetic_points(count, size, rand_seed = rand_seed)
+    for key in saved:
+      delattr(Tile, key)
+    Tile._POINTS = points
+    Tile._ENGINE = DistanceEngine.from_points(points)
+    Tile._GRAPH = None
+    if not only or 'LSH.evaluate' in only:
+      Tile._GRAPH = KNNGraph.build(Tile.ENGINE, 200)
+    calibration = Calibration.estimate(Tile.ENGINE, min(count, 200), seed = rand_seed)
+    Tile._RADIUS, Tile._TOLERANCE = calibration.radius, calibration.tolerance
+
+    seed(rand_seed)
+    results = {}
+    for name, fn in cases(points, Random(rand_seed)):
+      if only and name not in only:
+        continue
+      best, median, number = measure(fn, repeat, min_time)
+      results[name] = {'best': best, 'median': median, 'number': number}
+  finally:
+    for key in STATE:
+      if key in Tile.__dict__:
+        delattr(Tile, key)
+    for key, value in saved.items():
+      setattr(Tile, key, value)
+
+  return {
+    'version': VERSION,
+    'points': count,
+    'size': size,
+    'seed': rand_seed,
+    'python': platform.python_version(),
+    'numpy': numpy.__version__,
+    'machine': platform.node(),
+    'results': results,
+    }
+
+def compare(report, baseline, threshold = 0.25):
+  """
+  Add each case's baseline time and ratio to ``report`` and return the names
+  of the cases more than ``threshold`` slower than the baseline.  Best times
+  are compared, being the least disturbed by other load on the machine.
+  """
+  regressions = []
+  for name, result in sorted(report['results'].items()):
+    before = baseline.get('results', {}).get(name)
+    if not before:
+      continue
+    result['baseline'] = before['best']
+    result['ratio'] = result['best'] / before['best'] if before['best'] else None
+    if result['ratio'] and result['ratio'] > 1 + threshold:
+      regressions.append(name)
+  report['threshold'] = threshold
+  report['regressions'] = regressions
+  return regressions
+
+def summary(report):
+  lines = []
+  for name, result in sorted(report['results'].items()):
+    line = '%-24s %12.3f ms %10.3f ms median'%(name, result['best']*1000, result['median']*1000)
+    if result.get('ratio'):
+      line += '  %5.2fx baseline'%result['ratio']
+      if name in report.get('regressions', ()):
+        line += '  SLOWER'
+    lines.append(line)
+  return '\n'.join(lines)
+
+def main(argv = None):
+  parser = OptionParser(usage = 'python -m mosy.benchmark [options]')
+  parser.add_option('--points', type = 'int', default = 1000, help = 'synthetic tiles to build')
+  parser.add_option('--size', type = 'int', default = 50, help = 'tile size in pixels')
+  parser.add_option('--only', action = 'append', help = 'run only this case, may be repeated')
+  parser.add_option('--repeat', type = 'int', default = 5)
+  parser.add_option('--min-time', type = 'float', default = 0.1, help = 'seconds per timed batch')
+  parser.add_option('--seed', type = 'int', default = 1)
+  parser.add_option('--output', help = 'write the JSON here instead of to stdout')
+  parser.add_option('--baseline', help = 'JSON of an earlier run to compare against')
+  parser.add_option('--threshold', type = 'float', default = 0.25, help = 'slowdown that fails the run')
+  options, args = parser.parse_args(argv)
+
+  #Keep what the code under test prints out of the JSON
+  stdout, sys.stdout = sys.stdout, sys.stderr
+  try:
+    report = run(options.points, options.size, options.only, options.repeat, options.min_time, options.seed)
+  finally:
+    sys.stdout = stdout
+  regressions = []
+  if options.baseline:
+    f = open(options.baseline)
+    try:
+      baseline = json.load(f)
+    finally:
+      f.close()
+    regressions = compare(report, baseline, options.threshold)
+
+  data = json.dumps(report, indent = 2, sort_keys = True)
+  if options.output:
+    f = open(options.output, 'w')
+    try:
+      f.write(data)
+    finally:
+      f.close()
+  else:
+    print data
+  print >> sys.stderr, summary(report)
+  return 1 if regressions else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,154 @@
+"""Nearest neighbor queries answered by evolved hash functions.
+
+The index takes the best scoring ``LSH`` rows and groups them into ``L``
+tables of ``K`` hashes each.  A tile's key in a table is its ``K`` bucket
+numbers together, so two tiles share a key only if every hash in the table
+puts them in the same bucket.  A query gathers every tile that shares a key
+with it in any table and ranks just those candidates by ``Tile.distance``.
+"""
+
+import os
+
+from collections import defaultdict
+try:
+  from cPickle import load, dump
+except ImportError:
+  from pickle import load, dump
+
+import numpy
+
+from mosy.mosaic.calibration import fingerprint
+from mosy.mosaic.features import str_from_rgb
+
+class Point(object):
+  """
+  A bare address to query with, for points that aren't tiles.
+  """
+  id = None
+
+  def __init__(self, address):
+    self.rgb_list = tuple(address)
+    self.str_list = str_from_rgb(self.rgb_list)
+
+class LSHIndex(object):
+
+  def __init__(self, tables, engine = None):
+    """
+    ``tables`` is a list of ``(a, b, r)`` arrays, one per table, where row
+    ``i`` of ``a`` and element ``i`` of ``b`` and ``r`` describe a hash.
+    Queries are ranked with ``engine``.
+    """
+    self.engine = engine
+    self.tables = [(numpy.asarray(a, dtype = numpy.float64), numpy.asarray(b, dtype = numpy.float64), numpy.asarray(r, dtype = numpy.float64)) for a, b, r in tables]
+    self.buckets = [defaultdict(list) for t in self.tables]
+    self.ids = set()
+    self.fingerprint = None
+
+  @classmethod
+  def from_hashes(cls, hashes, width, engine = None):
+    """
+    Group ``hashes`` in order into tables of ``width`` hashes.  Leftover
+    hashes that don't fill a table are not used.
+    """
+    tables = []
+    for i in range(0, len(hashes) - width + 1, width):
+      group = hashes[i:i+width]
+      tables.append(([h.a for h in group], [h.b for h in group], [h.r for h in group]))
+    return cls(tables, engine)
+
+  def keys(self, matrix):
+    """
+    One array of bucket keys per table for every row of ``matrix``.
+    """
+    keys = []
+    for a, b, r in self.tables:
+      keys.append(numpy.floor((numpy.dot(matrix, a.T) + b)/r).astype(numpy.int64))
+    return keys
+
+  def insert_many(self, ids, matrix):
+    table_keys = self.keys(matrix)
+    for buckets, keys in zip(self.buckets, table_keys):
+      for pk, key in zip(ids, keys):
+        buckets[tuple(key)].append(int(pk))
+    self.ids.update(int(pk) for pk in ids)
+
+  def insert_engine(self):
+    """
+    Bucket every point of the engine that isn't indexed yet.
+    """
+    engine = self.engine
+    new = numpy.array([pk not in self.ids for pk in engine.ids], dtype = bool)
+    self.insert_many(engine.ids[new], engine.matrix[new])
+
+  def insert(self, tile):
+    """
+    Bucket one new tile, adding it to the engine so queries can rank it.
+    """
+    if tile.id in self.ids:
+      return
+    self.engine.add(tile)
+    self.insert_many([tile.id], numpy.array([tile.rgb_list], dtype = numpy.float64))
+
+  def candidates(self, point):
+    found = set()
+    table_keys = self.keys(numpy.array([point.rgb_list], dtype = numpy.float64))
+    for buckets, keys in zip(self.buckets, table_keys):
+      found.update(buckets.get(tuple(keys[0]), ()))
+    found.discard(point.id)
+    return found
+
+  def query(self, tile_or_address, k = 10):
+    """
+    The ``k`` nearest indexed tiles to a tile or a bare address, as a list of
+    ``(id, distance)`` nearest first.  Only tiles colliding with the query in
+    at least one table are ranked, so fewer than ``k`` may come back.
+    """
+    point = tile_or_address
+    if not hasattr(point, 'rgb_list'):
+      point = Point(tile_or_address)
+    #Tiles deleted since the index was built aren't in the engine any more
+    found = sorted(pk for pk in self.candidates(point) if pk in self.engine)
+    if not found:
+      return []
+    rows, d = self.engine.distance(point, candidates = found)
+    ids, d = self.engine.nearest(rows, d, k)
+    return [(int(pk), float(x)) for pk, x in zip(ids, d)]
+
+  def save(self, path):
+    self.fingerprint = fingerprint(self.engine)
+    tmp_path = path + '.tmp'
+    f = open(tmp_path, 'wb')
+    try:
+      dump((self.tables, [dict(b) for b in self.buckets], self.ids, self.fingerprint), f, 2)
+    finally:
+      f.close()
+    os.rename(tmp_path, path)
+
+  def current(self):
+    """
+    Whether the index was saved for the tiles the engine holds now.
+    """
+    return self.fingerprint == fingerprint(self.engine)
+
+  @property
+  def width(self):
+    return self.tables[0][0].shape[0] if self.tables else 0
+
+  @classmethod
+  def load(cls, path, engine = None):
+    if not os.path.exists(path):
+      return None
+    f = open(path, 'rb')
+    try:
+      stored = load(f)
+    finally:
+      f.close()
+    #Indexes saved before the fingerprint was kept are never current
+    tables, buckets, ids = stored[:3]
+    index = cls(tables, engine)
+    for table, stored_buckets in zip(index.buckets, buckets):
+      table.update(stored_buckets)
+    index.ids = ids
+    if len(stored) > 3:
+      index.fingerprint = stored[3]
+    return index
@@ -0,0 +1,110 @@
+"""Cached top hashes for the index page.
+
+The board is a list of small dicts holding only what the page shows, kept in
+the ``leaderboard`` cache so the web server can read it without touching the
+hash table while the evolver is writing to it.  ``evolve()`` offers every
+hash it saves; only hashes that can change the board cause a write, and the
+board is rebuilt from the table when it is missing or a hash on it got worse.
+``work()`` processes, which may run on other hosts, don't offer anything, so
+the cache is kept short lived and the board is read from the table again
+once it expires.
+"""
+
+from django.core.cache import get_cache
+
+class Leaderboard(object):
+
+  def __init__(self, model, size = 50, cache = 'leaderboard', key = 'knn_leaderboard'):
+    self.model = model
+    self.size = size
+    self.cache_name = cache
+    self.key = key
+
+  @property
+  def cache(self):
+    if not hasattr(self, '_cache'):
+      self._cache = get_cache(self.cache_name)
+    return self._cache
+
+  def entry(self, pk, score, collisions, p1, p2, father = None, mother = None):
+    return {
+      'id': pk,
+      'score': score,
+      'collisions': collisions,
+      'p1': p1,
+      'p2': p2,
+      'father': father,
+      'mother': mother,
+      }
+
+  def rebuild(self):
+    """
+    Read the board from the table, parents included, in one query.
+    """
+    rows = self.model.ranked().values_list(
+      'id', 'score', 'collisions', 'p1', 'p2',
+      'father', 'father__score', 'mother', 'mother__score',
+      )[:self.size]
+    board = []
+    for pk, score, collisions, p1, p2, father, father_score, mother, mother_score in rows:
+      board.append(self.entry(
+        pk, score, collisions, p1, p2,
+        father and {'id': father, 'score': father_score},
+        mother and {'id': mother, 'score': mother_score},
+        ))
+    self.cache.set(self.key, board)
+    return board
+
+  def entries(self):
+    board = self.cache.get(self.key)
+    if board == None:
+      board = self.rebuild()
+    return board
+
+  def invalidate(self):
+    self.cache.delete(self.key)
+
+  def offer(self, lsh):
+    """
+    Update the board for a hash that was just saved, if it can make a
+    difference.  Untested hashes, most of what the evolver saves, are
+    passed over without reading the board.
+    """
+    if lsh.score == None:
+      return
+    board = self.cache.get(self.key)
+    if board == None:
+      return
+    ids = [entry['id'] for entry in board]
+    on_board = lsh.pk != None and lsh.pk in ids
+    full = len(board) >= self.size
+    if full and lsh.score <= board[-1]['score']:
+      if on_board:
+        #A hash on the board got worse; the one to replace it is in the table
+        self.invalidate()
+      return
+    if lsh.pk == None:
+      #Saved without an id, so it can only be found in the table
+      self.invalidate()
+      return
+
+    parents = {}
+    for entry in board:
+      parents[entry['id']] = {'id': entry['id'], 'score': entry['score']}
+    missing = [pk for pk in (lsh.father_id, lsh.mother_id) if pk and pk not in parents]
+    for pk, score in self.model.objects.filter(pk__in = missing).values_list('id', 'score'):
+      parents[pk] = {'id': pk, 'score': score}
+
+    board = [entry for entry in board if entry['id'] != lsh.pk]
+    board.append(self.entry(
+      lsh.pk, lsh.score, lsh.collisions, lsh.p1, lsh.p2,
+      parents.get(lsh.father_id), parents.get(lsh.mother_id),
+      ))
+    board.sort(key = lambda entry: -entry['score'])
+    self.cache.set(self.key, board[:self.size])
+
+  def saved(self, sender, instance, **kwargs):
+    """
+    ``post_save`` receiver.
+    """
+    self.offer(instance)
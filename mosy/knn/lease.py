@@ -0,0 +1,115 @@
+"""Leases that let many evolver processes share the hash table.
+
+A worker leases untested hashes by stamping ``leased_by`` and
+``leased_until`` with an update that only matches rows still free, so two
+workers never test the same hash.  The worker renews its leases with
+``heartbeat()`` while it tests them; if it dies the leases run out and the
+hashes go back to the pool.  Recording a test result clears the lease.
+
+One worker at a time is elected coordinator the same way, by leasing a row
+of its own, and only the coordinator breeds the next generation.
+"""
+
+import os
+import socket
+
+from datetime import datetime, timedelta
+from random import sample
+from time import time
+
+from django.db.models import Q
+
+def worker_name():
+  return ('%s-%i'%(socket.gethostname(), os.getpid()))[:64]
+
+class Leases(object):
+
+  def __init__(self, model, worker = None, timeout = 600, window = 4):
+    """
+    Leases last ``timeout`` seconds and are renewed a third of the way
+    through.  Each claim picks at random from ``window`` times as many free
+    rows as it asks for, so workers claiming at once mostly don't collide.
+    """
+    self.model = model
+    self.worker = worker or worker_name()
+    self.timeout = timeout
+    self.window = window
+    self.renewed = 0
+
+  def until(self):
+    return datetime.now() + timedelta(seconds = self.timeout)
+
+  def available(self):
+    return self.model.objects.filter(tested = False).filter(Q(leased_until = None) | Q(leased_until__lt = datetime.now()))
+
+  def outstanding(self):
+    """
+    Whether any hash is still untested, leased or not.
+    """
+    return self.model.objects.filter(tested = False).exists()
+
+  def claim(self, count):
+    """
+    Lease up to ``count`` untested hashes and return the ones won.
+    """
+    candidates = list(self.available().order_by('id').values_list('id', flat = True)[:count*self.window])
+    if not candidates:
+      return []
+    ids = sample(candidates, min(count, len(candidates)))
+    self.available().filter(pk__in = ids).update(leased_by = self.worker, leased_until = self.until())
+    self.renewed = time()
+    return list(self.model.objects.filter(pk__in = ids, leased_by = self.worker, tested = False))
+
+  def hold(self, obj):
+    """
+    Lease ``obj`` before it is first saved.
+    """
+    obj.leased_by = self.worker
+    obj.leased_until = self.until()
+
+  def heartbeat(self, force = False):
+    """
+    Renew this worker's leases if a third of the timeout has gone by.
+    """
+    if force or time() - self.renewed >= self.timeout / 3.0:
+      self.model.objects.filter(leased_by = self.worker, tested = False).update(leased_until = self.until())
+      self.renewed = time()
+
+  def release(self):
+    """
+    Give back every hash this worker leased and didn't test.
+    """
+    self.model.objects.filter(leased_by = self.worker, tested = False).update(leased_by = None, leased_until = None)
+
+class Election(object):
+  """
+  Holds ``role`` for one worker at a time, through a row of ``model``.
+  """
+
+  def __init__(self, model, role, worker = None, timeout = 600):
+    self.model = model
+    self.role = role
+    self.worker = worker or worker_name()
+    self.timeout = timeout
+    self.renewed = 0
+
+  def elect(self):
+    """
+    Take the role if it is free or its holder's lease ran out, or renew it
+    if this worker holds it already.  Returns whether this worker holds it.
+    """
+    self.model.objects.get_or_create(role = self.role)
+    now = datetime.now()
+    held = self.model.objects.filter(role = self.role).filter(
+      Q(leased_by = self.worker) | Q(leased_by = None) | Q(leased_until__lt = now)
+      ).update(leased_by = self.worker, leased_until = now + timedelta(seconds = self.timeout))
+    if held:
+      self.renewed = time()
+    return bool(held)
+
+  def heartbeat(self):
+    if self.renewed and time() - self.renewed >= self.timeout / 3.0:
+      self.elect()
+
+  def resign(self):
+    self.model.objects.filter(role = self.role, leased_by = self.worker).update(leased_by = None, leased_until = None)
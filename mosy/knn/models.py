@@ -1,15 +1,27 @@
+from django.conf import settings
 from django.db import models, connection, transaction
 from django.db.models import Q, F
+from django.db.models.signals import post_save
 
-from mosy.pof.fields import PickledObjectField
+from mosy.behaviors.models import Heritable
+from mosy.pof.packed import PackedFloatArrayField
+
+import os.path
+import numpy
 
 from itertools import combinations
 from random import normalvariate, uniform, randint, shuffle, sample, choice
 from math import sqrt, floor
 from threading import Thread
-from time import time
+from time import time, sleep
 
 from mosy.mosaic.models import Tile
+from mosy.knn.parallel import Evaluator
+from mosy.knn.persistence import Writer
+from mosy.knn.index import LSHIndex
+from mosy.knn.leaderboard import Leaderboard
+from mosy.knn.lease import Election, Leases
+from mosy.metrics import lsh_metrics
 
 # Create your models here.
 
@@ -43,10 +55,17 @@ Foo.TOLERANCE
 - Scalar for RADIUS value for when two points should be considered
   'far apart'
 
+Foo.ENGINE
+- A DistanceEngine over all points, used to measure distances from one
+  point to many in a single call.
+
 '''
 PointModel = Tile
 
-class LSH(models.Model):
+class LSH(Heritable):
+  #Descendants on the lineage page are the best scoring of each generation
+  LINEAGE_ORDER = ('-score', 'id')
+
   father = models.ForeignKey('self', related_name = 'father_of', null = True)
   mother = models.ForeignKey('self', related_name = 'mother_of', null = True)
   p1 = models.FloatField(null = True)
@@ -55,76 +74,314 @@ class LSH(models.Model):
 
   tested = models.BooleanField(default = False)
 
-  a = PickledObjectField(null = True)
+  a = PackedFloatArrayField(null = True)
   r = models.IntegerField(null = True)
   b = models.FloatField(null = True)
   mean = models.FloatField(null = True)
   std = models.FloatField(null = True)
+  #p1 - p2, stored so the best hashes can be found through an index
+  score = models.FloatField(null = True, db_index = True)
+  #Which work() process is testing the hash, and until when
+  leased_by = models.CharField(max_length = 64, null = True)
+  leased_until = models.DateTimeField(null = True, db_index = True)
 
-  @property
-  def score(self):
+  def sync_score(self):
     if self.p1 == None or self.p2 == None:
-      return False
-    return self.p1 - self.p2
-
-  @property
-  def generation(self):
-    gen =  0
-    if not self.father and not self.mother:
-      return gen
-    if self.father:
-      gen = self.father.generation + 1
-    if self.mother:
-      gen = max(gen, self.mother.generation + 1)
-    return gen
+      self.score = None
+    else:
+      self.score = self.p1 - self.p2
+
+  def save(self, *args, **kwargs):
+    self.sync_score()
+    super(LSH, self).save(*args, **kwargs)
 
   @classmethod
-  def evolve(cls):
+  def ranked(cls):
+    """
+    Scored hashes, best first.
+    """
+    return cls.objects.exclude(score = None).order_by('-score')
+
+  @models.permalink
+  def get_absolute_url(self):
+    return ('mosy.knn.views.detail', [self.id])
+
+  @classmethod
+  def evolve(cls, processes = None):
+    """
+    Test, breed and test again forever.  With more than one process, hashes
+    are tested in parallel by an ``Evaluator`` pool.  Hashes are saved by a
+    write-behind ``Writer``, which is flushed before each round reads the
+    table again.  Each round's phase timings and counts are written to the
+    ``lsh`` metrics file.  Only one ``evolve()`` can run against a table; use
+    ``work()`` to run several.
+    """
     PointModel.init()
+    if processes == None:
+      processes = getattr(settings, 'LSH_PROCESSES', 1)
+    writer = Writer(cls, on_save = leaderboard.offer, metrics = lsh_metrics)
+    evaluator = None
+    if processes > 1:
+      evaluator = Evaluator(cls, PointModel, processes, writer)
+    lsh_metrics.reset()
     while True:
-      test_list = cls.objects.defer('father', 'mother').filter(tested = False)
-      if test_list.exists():
-        test_list = list(test_list)
+      cls.new_generation()
+      with lsh_metrics.timer('db_read'):
+        test_list = list(cls.objects.defer('father', 'mother').filter(tested = False))
+        population = cls.objects.count()
+      if test_list:
+        stage = 'untested'
+        if evaluator:
+          evaluator.test(test_list)
         while test_list:
           lsh = test_list.pop()
-          lsh.test()
+          if not lsh.tested:
+            lsh.test(writer = writer)
         print "Testing untested hash functions"
-      elif cls.objects.count() < PointModel.INITIAL_POPULATION:
+      elif population < PointModel.INITIAL_POPULATION:
+        stage = 'initial'
         print "Generating Initial Population"
-        for i in range(PointModel.INITIAL_POPULATION-cls.objects.count()):
-          x = cls()
-          x.test()
+        new_hashes = [cls() for i in range(PointModel.INITIAL_POPULATION-population)]
+        if evaluator:
+          evaluator.test(new_hashes)
+        for x in new_hashes:
+          if not x.tested:
+            x.test(writer = writer)
       else:
+        stage = 'breed'
         print "Breeding New Generation"
-        cls.spawn()
+        cls.spawn(evaluator = evaluator, writer = writer)
+      with lsh_metrics.timer('writer_wait'):
+        writer.flush()
+      cls.record_generation(stage)
+
+  @classmethod
+  def work(cls, processes = None, timeout = 600, batch_size = 20, poll = 10.0):
+    """
+    Evolve alongside any number of other ``work()`` processes sharing the
+    table, on this machine or others.  Untested hashes are leased
+    ``batch_size`` at a time for ``timeout`` seconds, renewed as they are
+    tested, and the worker elected coordinator starts each generation once
+    every hash of the last one is tested.  Waits ``poll`` seconds when there
+    is nothing to do.
+
+    Each worker stores a ``MetricsRecord`` for each generation it tested
+    hashes of and each one it started, numbered by the generation count kept
+    on the coordinator row so the metrics page can add up every worker's
+    part of a generation.
+    """
+    PointModel.init()
+    if processes == None:
+      processes = getattr(settings, 'LSH_PROCESSES', 1)
+    leases = Leases(cls, timeout = timeout)
+    election = Election(Coordinator, 'spawn', leases.worker, timeout)
+    #Workers may not share the web host's leaderboard cache, and offers from
+    #several at once would overwrite each other, so the board is left to
+    #expire and be read from the table again
+    writer = Writer(cls, metrics = lsh_metrics)
+    evaluator = None
+    if processes > 1:
+      evaluator = Evaluator(cls, PointModel, processes, writer)
+    lsh_metrics.worker = leases.worker
+    lsh_metrics.reset()
+    try:
+      generation = cls.current_generation(election.role)
+      while True:
+        current = cls.current_generation(election.role)
+        if current != generation:
+          cls.record_work(generation)
+          generation = current
+        if cls.test_batch(leases, election, writer, evaluator, batch_size):
+          continue
+        #Nothing left to lease, so this worker's part of the generation is done
+        cls.record_work(generation)
+        stage = cls.start_generation(leases, election, writer, evaluator)
+        generation = cls.current_generation(election.role)
+        if stage:
+          cls.record_generation(stage, generation = generation)
+        else:
+          sleep(poll)
+          lsh_metrics.reset()
+    finally:
+      #Results still queued are written before the leases are given back
+      writer.close()
+      leases.release()
+      election.resign()
+      lsh_metrics.worker = None
+      if evaluator:
+        evaluator.close()
+
+  @classmethod
+  def current_generation(cls, role = 'spawn'):
+    """
+    How many generations ``work()`` coordinators have started.
+    """
+    counts = list(Coordinator.objects.filter(role = role).values_list('generation', flat = True))
+    return counts[0] if counts else 0
+
+  @classmethod
+  def test_batch(cls, leases, election, writer, evaluator = None, batch_size = 20):
+    """
+    Lease up to ``batch_size`` untested hashes and test them.  Returns how
+    many were leased.
+    """
+    cls.new_generation()
+    with lsh_metrics.timer('db_read'):
+      batch = leases.claim(batch_size)
+    if not batch:
+      return 0
+    if evaluator:
+      evaluator.test(batch)
+    for lsh in batch:
+      if not lsh.tested:
+        lsh.test(writer = writer)
+      leases.heartbeat()
+      election.heartbeat()
+    with lsh_metrics.timer('writer_wait'):
+      writer.flush()
+    return len(batch)
+
+  @classmethod
+  def start_generation(cls, leases, election, writer, evaluator = None):
+    """
+    As coordinator, once every hash is tested, count a new generation and
+    seed or breed it.  Returns what was done, or None if this worker isn't
+    coordinator or hashes are still being tested.
+    """
+    if not election.elect():
+      return None
+    with lsh_metrics.timer('db_read'):
+      outstanding = leases.outstanding()
+      population = cls.objects.count()
+    if outstanding:
+      #Other workers are still testing the current generation
+      return None
+    #Counted first, so workers testing the new hashes record them under it
+    Coordinator.objects.filter(role = election.role).update(generation = F('generation') + 1)
+    if population < PointModel.INITIAL_POPULATION:
+      stage = 'initial'
+      print "Generating Initial Population"
+      for i in range(PointModel.INITIAL_POPULATION - population):
+        lsh = cls()
+        lsh.generate(dimension = PointModel.ENGINE.dimension, commit = False)
+        writer.save(lsh)
+    else:
+      stage = 'breed'
+      print "Breeding New Generation"
+      cls.spawn(evaluator = evaluator, writer = writer, leases = leases, heartbeat = election.heartbeat)
+    with lsh_metrics.timer('writer_wait'):
+      writer.flush()
+    return stage
+
+  @classmethod
+  def record_work(cls, generation):
+    """
+    Write what ``work()`` collected while testing leased hashes of
+    ``generation``, if anything.
+    """
+    if lsh_metrics.counter('tested'):
+      cls.record_generation('leased', generation = generation)
+    else:
+      lsh_metrics.reset()
+
+  @classmethod
+  def record_generation(cls, stage, **fields):
+    """
+    Write the metrics of the round that just ended.
+    """
+    tested = lsh_metrics.counter('tested')
+    record = lsh_metrics.generation(
+      stage = stage,
+      early_exit_rate = float(lsh_metrics.counter('early_exit')) / tested if tested else None,
+      **fields
+      )
+    print "Generation %i: %i hashes tested in %f (%f per second)"%(record['generation'], tested, record['seconds'], record['per_second'].get('tested', 0.0))
+    return record
+
+  @classmethod
+  def index_path(cls):
+    return os.path.join(settings.DATA_ROOT, 'lsh_index.pickle')
+
+  @classmethod
+  def build_index(cls, tables = 8, width = 4):
+    """
+    Index every point with the ``tables*width`` best scoring hashes, in
+    ``tables`` tables of ``width`` hashes, and store the index.
+    """
+    engine = PointModel.ENGINE
+    hashes = []
+    for lsh in cls.ranked().iterator():
+      if lsh.a != None and len(lsh.a) == engine.dimension:
+        hashes.append(lsh)
+        if len(hashes) == tables*width:
+          break
+    index = LSHIndex.from_hashes(hashes, width, engine)
+    index.insert_engine()
+    index.save(cls.index_path())
+    return index
+
+  @classmethod
+  def load_index(cls):
+    """
+    The stored index, rebuilt with as many tables of the same width if the
+    tiles changed since it was saved, or None if none was built.
+    """
+    index = LSHIndex.load(cls.index_path(), PointModel.ENGINE)
+    if index != None and not index.current():
+      print "LSH index is out of date, rebuilding it"
+      index = cls.build_index(len(index.tables), index.width)
+    return index
 
   @classmethod
-  def spawn(cls, top = 60, other = 10):
-    parents_query = cls.objects.raw('SELECT id, collisions, a, b, r, mean, std, p1, p2 FROM knn_lsh ORDER BY p1-p2 DESC LIMIT 0, %s', [top])
-    parents = [lsh for lsh in parents_query]
+  def spawn(cls, top = 60, other = 10, evaluator = None, writer = None, leases = None, heartbeat = None):
+    """
+    Breed every pair of the ``top`` best hashes and ``other`` new random ones.
+    Children are handed to ``writer`` when given, rather than saved one by
+    one.  The new random hashes are held under ``leases`` if given, so no
+    other worker tests them too, and ``heartbeat`` is called as pairs are
+    bred.
+    """
+    with lsh_metrics.timer('db_read'):
+      parents = list(cls.ranked()[:top])
     print "Grabbing random breeders"
-    for i in range(other):
-      new_breeder = cls()
-      new_breeder.test()
+    new_breeders = [cls() for i in range(other)]
+    #Children refer to the new breeders, so they are saved up front
+    with lsh_metrics.timer('db_write'):
+      for new_breeder in new_breeders:
+        if leases:
+          leases.hold(new_breeder)
+        new_breeder.generate(dimension = PointModel.ENGINE.dimension)
+    if evaluator:
+      evaluator.test(new_breeders)
+    for new_breeder in new_breeders:
+      if not new_breeder.tested:
+        new_breeder.test()
       parents.append(new_breeder)
     assert len(parents) == top + other
     for hash_a, hash_b in combinations(parents, 2):
-      print "Breeding (%i: %f) and (%i: %f)"%(hash_a.id, hash_a.score, hash_b.id, hash_b.score)
-      child = cls.breed(hash_a, hash_b)
+      print "Breeding (%i: %f) and (%i: %f)"%(hash_a.id, hash_a.score or 0.0, hash_b.id, hash_b.score or 0.0)
+      with lsh_metrics.timer('breed'):
+        child = cls.breed(hash_a, hash_b, commit = writer == None)
+      lsh_metrics.count('bred' if child else 'duplicate_offspring')
+      if child and writer:
+        writer.save(child)
+      if heartbeat:
+        heartbeat()
     
 
   @classmethod
-  def breed(cls, hash_a, hash_b):
-    score_a = hash_a.score
-    score_b = hash_b.score
+  def breed(cls, hash_a, hash_b, commit = True):
+    score_a = hash_a.score or 0.0
+    score_b = hash_b.score or 0.0
     if score_b > score_a:
-      return cls.breed(hash_b, hash_a)
+      return cls.breed(hash_b, hash_a, commit)
     weight_a = score_a/(score_a + score_b)
     weight_b = score_b/(score_a + score_b)
     
     x = cls()
     x.father = hash_a
     x.mother = hash_b
+    x.inherit(hash_a, hash_b)
     for val in ('b', 'r'):
       if uniform(0, 1) <= weight_a:
         setattr(x, val, getattr(hash_a, val))
@@ -162,10 +419,11 @@ class LSH(models.Model):
       print "Duplicate Offspring"
       return
 
-    x.save()
+    if commit:
+      x.save()
     return x
 
-  def generate(self, mean = None, std = None, dimension = 48):
+  def generate(self, mean = None, std = None, dimension = 48, commit = True):
     if not mean == None:
       self.mean = mean
     else:
@@ -177,7 +435,34 @@ class LSH(models.Model):
     self.a = [normalvariate(self.mean, self.std) for i in range(dimension)]
     self.r = floor(uniform(2, 32768))
     self.b = uniform(0, self.r)
-    self.save()
+    self.__dict__.pop('_buckets_engine', None)
+    if commit:
+      self.save()
+
+  def buckets(self):
+    """
+    ``project()`` of every point, indexed by distance engine row.  Computed
+    once per hash and kept until the hash is regenerated.
+    """
+    engine = PointModel.ENGINE
+    if getattr(self, '_buckets_engine', None) is not engine:
+      if self.a == None or self.b == None or self.r == None:
+        if not self.mother and not self.father:
+          self.generate(dimension = engine.dimension, commit = False)
+      self._buckets = self.project_many(engine.matrix)
+      self._buckets_engine = engine
+    return self._buckets
+
+  def project_many(self, matrix):
+    """
+    ``project()`` for every row of ``matrix`` in one pass.  The dot product is
+    summed one dimension at a time, in the same order as ``project()``, so
+    points land in exactly the same buckets.
+    """
+    dp = numpy.zeros(matrix.shape[0])
+    for i, x in enumerate(self.a[:matrix.shape[1]]):
+      dp += matrix[:, i] * x
+    return numpy.floor((dp + self.b)/float(self.r))
 
   def project(self, point):
     vector = point.address
@@ -187,15 +472,67 @@ class LSH(models.Model):
     dp = sum([x*y for x, y in zip(self.a, vector)])
     return floor((dp + self.b)/float(self.r))
 
-  def test(self, early_exit = True):
+  @classmethod
+  def target_score(cls):
+    """
+    The score a hash is measured against for an early exit during testing:
+    the 1001st best score, or None while the initial population is still
+    being tested.  Looked up once per generation.
+    """
+    if not hasattr(cls, '_target_score'):
+      cls._target_score = None
+      if cls.objects.count() >= PointModel.INITIAL_POPULATION:
+        scores = list(cls.ranked().values_list('score', flat = True)[1000:1001])
+        if scores:
+          cls._target_score = scores[0]
+    return cls._target_score
+
+  @classmethod
+  def new_generation(cls):
+    """
+    Forget the cached ``target_score()`` so the next test looks it up again.
+    """
+    if hasattr(cls, '_target_score'):
+      del cls._target_score
+
+  def test(self, early_exit = True, writer = None):
     start_time = time()
-    if early_exit and LSH.objects.count() >= PointModel.INITIAL_POPULATION:
-      cursor = connection.cursor()
-      cursor.execute("SELECT p1-p2 AS `score` FROM `knn_lsh` ORDER BY p1-p2 DESC LIMIT 1000,1")
-      target_score = float(cursor.fetchone()[0])
+    target_score = None
+    if early_exit:
+      target_score = LSH.target_score()
+    self.record(*self.evaluate(target_score))
+    if writer:
+      writer.save(self)
     else:
-      early_exit = False
-    sample_set = sample(PointModel.POINTS.keys(), 200)
+      with lsh_metrics.timer('db_write'):
+        self.save()
+
+    print "LSH(%s) - Test_Time: %f"%(self.id, time() - start_time)
+
+  def record(self, collisions, p1, p2):
+    self.collisions = collisions
+    self.tested = True
+    self.leased_by = None
+    self.leased_until = None
+    if collisions > 0:
+      self.p1 = p1
+      self.p2 = p2
+    self.sync_score()
+    lsh_metrics.observe('score', self.score)
+
+  def evaluate(self, target_score = None):
+    """
+    Measure how well the hash separates close points from far ones, without
+    touching the database.  Testing stops early if the hash falls too far
+    behind ``target_score``.  Returns ``(collisions, p1, p2)``.
+    """
+    early_exit = target_score != None
+    engine = PointModel.ENGINE
+    with lsh_metrics.timer('project'):
+      buckets = self.buckets()
+    with lsh_metrics.timer('sample'):
+      point_ids = PointModel.POINTS.keys()
+      sample_set = sample(point_ids, 200)
     p1_overall = 0.0
     p2_overall = 0.0
     p3_overall = 0.0
@@ -203,39 +540,28 @@ class LSH(models.Model):
 
     for n in range(len(sample_set)):
       test_point = PointModel.POINTS[sample_set.pop()]
-      test_point.projection = self.project(test_point)
+      projection = buckets[engine.row_of(test_point.id)]
 
-      close_points = test_point.knn
+      with lsh_metrics.timer('ground_truth'):
+        close_points = test_point.knn
 
-      sample_points = PointModel.POINTS.keys()
-      for point in close_points:
-        sample_points.remove(point)
-      sample_points.remove(test_point.id)
-      sample_points = sample(sample_points, 200)
-      sample_points += close_points
-      sample_points = [PointModel.POINTS[p] for p in sample_points]
+      with lsh_metrics.timer('sample'):
+        excluded = set(close_points)
+        excluded.add(test_point.id)
+        sample_points = sample([p for p in point_ids if p not in excluded], 200)
+        sample_points += close_points
 
       assert len(sample_points) == 400
-      for point in sample_points:
-        point.distance = PointModel.distance(test_point, point)
-        point.projection = self.project(point)
-
-      shuffle(sample_points)
-
-      collisions = 0
-      p1_count = 0
-      p2_count = 0
-      p3_count = 0
-      for i in range(400):
-        point = sample_points[i]
-        if test_point.projection == point.projection:
-          collisions += 1
-          if point.distance <= PointModel.RADIUS:
-            p1_count += 1
-          elif point.distance >= PointModel.RADIUS*PointModel.TOLERANCE:
-            p2_count += 1
-          else:
-            p3_count += 1
+      with lsh_metrics.timer('distance'):
+        rows, distances = engine.distance(test_point, candidates = sample_points)
+        distances = distances[buckets[rows] == projection]
+
+      close = distances <= PointModel.RADIUS
+      far = ~close & (distances >= PointModel.RADIUS*PointModel.TOLERANCE)
+      collisions = len(distances)
+      p1_count = int(close.sum())
+      p2_count = int(far.sum())
+      p3_count = collisions - p1_count - p2_count
       p1_overall = (p1_overall*n+p1_count)/(n+1)
       p2_overall = (p2_overall*n+p2_count)/(n+1)
       p3_overall = (p3_overall*n+p3_count)/(n+1)
@@ -243,14 +569,35 @@ class LSH(models.Model):
       if early_exit and n >= 80:
         if p1_overall - p2_overall < target_score*(float(n)/200-0.2):
           print "Early Exit Criteria Met at %i"%n
+          lsh_metrics.count('early_exit')
           break
 
-    self.collisions = collisions_overall
-    self.tested = True
-    if collisions_overall > 0:
-      self.p1 = p1_overall
-      self.p2 = p2_overall
-    self.save()
-
-    print "LSH(%i) - Test_Time: %f"%(self.id, time() - start_time)
+    lsh_metrics.count('tested')
+    lsh_metrics.count('test_points', n + 1)
+    return collisions_overall, p1_overall, p2_overall
     #print "Colisions: %i - P1: %i P2: %i P3: %i"%(int(collisions_overall), int(p1_overall), int(p2_overall), int(p3_overall))
+
+class Coordinator(models.Model):
+  """
+  A role held by one ``LSH.work()`` process at a time, through ``Election``.
+  """
+  role = models.CharField(max_length = 32, unique = True)
+  leased_by = models.CharField(max_length = 64, null = True)
+  leased_until = models.DateTimeField(null = True)
+  #Generations started by whoever held the role
+  generation = models.IntegerField(default = 0)
+
+class MetricsRecord(models.Model):
+  """
+  One worker's metrics for one generation, kept in the table so the metrics
+  page sees those of ``work()`` processes on every host.
+  """
+  loop = models.CharField(max_length = 32)
+  worker = models.CharField(max_length = 64)
+  generation = models.IntegerField(db_index = True)
+  ended = models.FloatField(db_index = True)
+  record = models.TextField()
+
+leaderboard = Leaderboard(LSH)
+post_save.connect(leaderboard.saved, sender = LSH)
+lsh_metrics.model = MetricsRecord
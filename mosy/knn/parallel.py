@@ -0,0 +1,85 @@
+"""Parallel testing of hash functions.
+
+Worker processes are forked after the point set, distance engine and
+neighbor graph are loaded, so they share one read-only copy of them.  Workers
+only run ``LSH.evaluate``; the parent records the results and writes them to
+the database in batches.
+"""
+
+import random
+
+from multiprocessing import Pool
+from time import time
+
+from django.db import connection, transaction
+
+from mosy.metrics import lsh_metrics
+
+def _init_worker():
+  #Forked workers start with the parent's random state; without a reseed
+  #they would all draw the same sample points.
+  random.seed()
+  #They would also report again what the parent collected before forking
+  lsh_metrics.reset()
+
+def _evaluate(args):
+  model, i, a, b, r, target_score = args
+  lsh = model(a = a, b = b, r = r)
+  result = lsh.evaluate(target_score)
+  #Timings collected in the worker go back with the result
+  return i, result, lsh_metrics.take()
+
+class Evaluator(object):
+
+  def __init__(self, model, point_model, processes, writer = None):
+    self.model = model
+    self.processes = processes
+    self.writer = writer
+    #Load everything the workers read before forking them
+    point_model.POINTS, point_model.ENGINE, point_model.GRAPH
+    point_model.RADIUS, point_model.TOLERANCE
+    connection.close()
+    self.pool = Pool(processes, initializer = _init_worker)
+    self.dimension = point_model.ENGINE.dimension
+
+  def test(self, hashes, early_exit = True, batch_size = 100):
+    """
+    Test ``hashes`` across the pool, saving the results ``batch_size`` at a
+    time, or through the writer if there is one.  Hashes without a vector
+    yet are generated first.
+    """
+    start_time = time()
+    target_score = None
+    if early_exit:
+      target_score = self.model.target_score()
+    for lsh in hashes:
+      if lsh.a == None or lsh.b == None or lsh.r == None:
+        lsh.generate(dimension = self.dimension, commit = False)
+    #Unsaved hashes have no id yet, so results are matched up by position
+    jobs = [(self.model, i, lsh.a, lsh.b, lsh.r, target_score) for i, lsh in enumerate(hashes)]
+    results = self.pool.imap_unordered(_evaluate, jobs)
+    pending = []
+    for i, result, taken in results:
+      lsh_metrics.merge(taken)
+      lsh = hashes[i]
+      lsh.record(*result)
+      pending.append(lsh)
+      if len(pending) >= batch_size:
+        self.save(pending)
+        pending = []
+    self.save(pending)
+    print "Tested %i hashes on %i processes in %f"%(len(hashes), self.processes, time() - start_time)
+
+  def save(self, hashes):
+    if self.writer:
+      for lsh in hashes:
+        self.writer.save(lsh)
+      return
+    with lsh_metrics.timer('db_write'):
+      with transaction.commit_on_success():
+        for lsh in hashes:
+          lsh.save()
+
+  def close(self):
+    self.pool.close()
+    self.pool.join()
@@ -0,0 +1,225 @@
+"""Write-behind saving of model rows.
+
+The evolution loop creates and tests hashes far faster than it can save them
+one row at a time.  A ``Writer`` takes a snapshot of each row's column values
+when it is handed an object and queues it; a background thread with its own
+database connection writes the queue out in batches, one ``executemany``
+per statement and one transaction per batch.  The queue is bounded, so a
+producer that gets too far ahead waits for the writer instead of holding an
+unbounded backlog in memory, and anything still queued is written out when
+the process exits.
+
+A batch that fails is retried ``retries`` times.  If it still fails, its rows
+are handed back in a ``WriteError`` raised from the next ``save()``,
+``flush()`` or ``close()``, rather than dropped without a word.
+
+Inserted rows don't get their ids back, so only objects that nothing will
+refer to by id should be handed over unsaved.  Rows written here don't send
+``post_save``; pass ``on_save`` to hear about them instead.  It is called on
+the thread using the writer, from ``save()``, ``flush()`` and ``close()``,
+for the objects whose rows have been committed since.
+"""
+
+import atexit
+
+from Queue import Queue, Empty
+from threading import Thread
+from time import sleep, time
+
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.db.models import AutoField
+
+#Writers not closed yet, closed when the process exits
+_open = set()
+
+def _close_all():
+  for writer in list(_open):
+    writer.close()
+
+atexit.register(_close_all)
+
+class WriteError(Exception):
+  """
+  Rows a ``Writer`` gave up on, kept in ``rows`` as ``(sql, params)``.
+  """
+
+  def __init__(self, rows, error):
+    Exception.__init__(self, '%i rows not written: %s'%(len(rows), error))
+    self.rows = rows
+    self.error = error
+
+class Writer(object):
+
+  def __init__(self, model, batch_size = 500, max_pending = 5000, interval = 1.0, using = DEFAULT_DB_ALIAS, background = True, on_save = None, metrics = None, retries = 2):
+    """
+    Rows are written once ``batch_size`` are waiting or no more have come in
+    for ``interval`` seconds.  With ``background`` off, rows are written by
+    the caller on the shared connection instead, whenever ``flush()`` is
+    called or a batch fills up.  ``on_save`` is called with each object
+    once its row is committed.  Writes are timed as ``db_write`` in ``metrics`` if given.
+    The background thread tries a failed batch ``retries`` more times,
+    ``interval`` seconds apart.
+    """
+    self.model = model
+    self.batch_size = batch_size
+    self.interval = interval
+    self.using = using
+    self.background = background
+    self.on_save = on_save
+    self.metrics = metrics
+    self.retries = retries
+    self.fields = [f for f in model._meta.local_fields if not isinstance(f, AutoField)]
+    self.queue = Queue(max_pending)
+    self.saved = Queue()
+    self.pending = []
+    self.error = None
+    self.written = 0
+
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    columns = [qn(f.column) for f in self.fields]
+    self.insert_sql = 'INSERT INTO %s (%s) VALUES (%s)'%(table, ', '.join(columns), ', '.join(['%s']*len(columns)))
+    self.update_sql = 'UPDATE %s SET %s WHERE %s = %%s'%(table, ', '.join('%s = %%s'%c for c in columns), qn(model._meta.pk.column))
+
+    if background:
+      self.thread = Thread(target = self.run, name = 'Writer(%s)'%model.__name__)
+      self.thread.daemon = True
+      self.thread.start()
+    _open.add(self)
+
+  def save(self, obj):
+    """
+    Queue ``obj`` to be inserted, or updated if it already has an id.  Blocks
+    while the queue is full.
+    """
+    self.check()
+    self.notify()
+    connection = connections[self.using]
+    values = [f.get_db_prep_save(f.pre_save(obj, obj.pk == None), connection = connection) for f in self.fields]
+    #The object is only kept to be handed to on_save once it is written
+    kept = obj if self.on_save else None
+    if obj.pk == None:
+      item = (self.insert_sql, tuple(values), kept)
+    else:
+      item = (self.update_sql, tuple(values) + (obj.pk, ), kept)
+    if self.background:
+      self.queue.put(item)
+    else:
+      self.pending.append(item)
+      if len(self.pending) >= self.batch_size:
+        self.flush()
+
+  def flush(self):
+    """
+    Wait until everything queued so far is written.
+    """
+    if self.background:
+      self.queue.join()
+    else:
+      pending, self.pending = self.pending, []
+      try:
+        with transaction.commit_on_success(using = self.using):
+          self.write(connections[self.using], pending)
+          transaction.set_dirty(using = self.using)
+      except Exception, e:
+        raise WriteError([item[:2] for item in pending], e)
+      self.written_items(pending)
+    self.check()
+    self.notify()
+
+  def close(self):
+    _open.discard(self)
+    if self.background and self.thread.is_alive():
+      self.queue.put(None)
+      self.thread.join()
+    elif not self.background and self.pending:
+      self.flush()
+    self.check()
+    self.notify()
+
+  def check(self):
+    if self.error:
+      error, self.error = self.error, None
+      raise error
+
+  def failed(self, items, error):
+    """
+    Keep ``items`` for the next ``check()`` to raise, along with any kept
+    from earlier batches.
+    """
+    rows = [item[:2] for item in items]
+    if self.error:
+      rows = self.error.rows + rows
+    self.error = WriteError(rows, error)
+
+  def written_items(self, items):
+    """
+    Hold the objects of committed ``items`` for ``notify()``.
+    """
+    for sql, params, obj in items:
+      if obj != None:
+        self.saved.put(obj)
+
+  def notify(self):
+    """
+    Call ``on_save`` with every object written since the last call.
+    """
+    while True:
+      try:
+        obj = self.saved.get_nowait()
+      except Empty:
+        return
+      self.on_save(obj)
+
+  def run(self):
+    connection = connections[self.using]
+    connection = connection.__class__(connection.settings_dict, self.using)
+    running = True
+    while running:
+      items = [self.queue.get()]
+      while items[-1] != None and len(items) < self.batch_size:
+        try:
+          items.append(self.queue.get(timeout = self.interval))
+        except Empty:
+          break
+      if items[-1] == None:
+        running = False
+      rows = [item for item in items if item != None]
+      for attempt in range(self.retries + 1):
+        try:
+          self.write(connection, rows)
+          connection._commit()
+          self.written_items(rows)
+          break
+        except Exception, e:
+          connection._rollback()
+          if attempt == self.retries:
+            self.failed(rows, e)
+          else:
+            sleep(self.interval)
+      for item in items:
+        self.queue.task_done()
+    connection.close()
+
+  def write(self, connection, items):
+    """
+    Run ``items``, each stretch of the same statement as a single
+    ``executemany``.  The caller commits.
+    """
+    if not items:
+      return
+    start_time = time()
+    cursor = connection.cursor()
+    start = 0
+    while start < len(items):
+      sql = items[start][0]
+      end = start
+      while end < len(items) and items[end][0] == sql:
+        end += 1
+      cursor.executemany(sql, [item[1] for item in items[start:end]])
+      start = end
+    self.written += len(items)
+    if self.metrics:
+      self.metrics.add_time('db_write', time() - start_time)
+      self.metrics.count('rows_written', len(items))
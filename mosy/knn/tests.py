@@ -5,8 +5,32 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+from datetime import datetime, timedelta
+from random import Random, seed
+
+import numpy
+
 from django.test import TestCase
 
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from mosy.knn import persistence
+from mosy.knn.index import LSHIndex
+from mosy.knn.leaderboard import Leaderboard
+from mosy.knn.lease import Election, Leases
+from mosy.knn.models import LSH, Coordinator, MetricsRecord, leaderboard
+from mosy.knn.parallel import Evaluator
+from mosy.knn.persistence import WriteError, Writer
+from mosy.metrics import Metrics, lsh_metrics
+from mosy.mosaic.models import Tile
+from mosy.mosaic.tests import synthetic_tile
+from mosy.pof.packed import PackedFloatArray
+
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,3 +38,621 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class PackedVectorTest(TestCase):
+    def test_vector_round_trip(self):
+        vector = [Random(6).normalvariate(0, 64) for i in range(300)]
+        LSH.objects.create(a = vector, r = 100, b = 1.0)
+        lsh = LSH.objects.get()
+        self.assertTrue(isinstance(lsh.a, PackedFloatArray))
+        self.assertEqual(len(lsh.a), 300)
+        self.assertEqual(lsh.a, vector)
+        self.assertEqual(lsh.a[17], vector[17])
+
+    def test_unused_vector_is_not_unpacked(self):
+        LSH.objects.create(a = [1.5, 2.5])
+        lsh = LSH.objects.get()
+        self.assertEqual(lsh.a._values, None)
+        lsh.save()
+        self.assertEqual(list(LSH.objects.get().a), [1.5, 2.5])
+
+
+class ScoreTest(TestCase):
+    def setUp(self):
+        self.initial_population = Tile.INITIAL_POPULATION
+        Tile.INITIAL_POPULATION = 5
+
+    def tearDown(self):
+        Tile.INITIAL_POPULATION = self.initial_population
+        LSH.new_generation()
+
+    def test_score_follows_p1_and_p2(self):
+        lsh = LSH.objects.create(p1 = 5.0, p2 = 1.5)
+        self.assertEqual(LSH.objects.get().score, 3.5)
+        lsh.p2 = None
+        lsh.save()
+        self.assertEqual(LSH.objects.get().score, None)
+        lsh.record(10.0, 4.0, 1.0)
+        self.assertEqual(lsh.score, 3.0)
+
+    def test_ranked_and_target_score(self):
+        for i in range(1005):
+            LSH.objects.create(p1 = float(i), p2 = 0.0)
+        LSH.objects.create(p1 = None, p2 = 0.0)
+        self.assertEqual([lsh.score for lsh in LSH.ranked()[:3]], [1004.0, 1003.0, 1002.0])
+        self.assertEqual(LSH.target_score(), 4.0)
+        LSH.objects.filter(score__lt = 10).delete()
+        self.assertEqual(LSH.target_score(), 4.0)
+        LSH.new_generation()
+        self.assertEqual(LSH.target_score(), None)
+
+
+class LeaderboardTest(TestCase):
+    def setUp(self):
+        leaderboard.invalidate()
+        self.parent = LSH.objects.create(p1 = 1.0, p2 = 0.5)
+        for i in range(5):
+            LSH.objects.create(p1 = 2.0 + i, p2 = 1.0, father = self.parent)
+
+    def tearDown(self):
+        leaderboard.invalidate()
+
+    def scores(self, board):
+        return [entry['score'] for entry in board]
+
+    def test_index_reads_cached_board(self):
+        self.client.get('/')
+        with self.assertNumQueries(0):
+            response = self.client.get('/')
+        top = response.context['top_lsh']
+        self.assertEqual(self.scores(top), [5.0, 4.0, 3.0, 2.0, 1.0, 0.5])
+        self.assertEqual(top[0]['father'], {'id': self.parent.id, 'score': 0.5})
+
+    def test_saves_update_board(self):
+        board = Leaderboard(LSH, size = 3, key = 'test_leaderboard')
+        self.assertEqual(self.scores(board.rebuild()), [5.0, 4.0, 3.0])
+        best = LSH.objects.create(p1 = 9.0, p2 = 1.0, father = self.parent)
+        board.offer(best)
+        board.offer(LSH.objects.create(p1 = 1.0, p2 = 1.0))
+        with self.assertNumQueries(0):
+            entries = board.entries()
+        self.assertEqual(self.scores(entries), [8.0, 5.0, 4.0])
+        self.assertEqual(entries[0]['father'], {'id': self.parent.id, 'score': 0.5})
+        best.p1 = 1.0
+        best.save()
+        board.offer(best)
+        self.assertEqual(self.scores(board.entries()), [5.0, 4.0, 3.0])
+
+    def test_untested_hashes_skip_the_cache(self):
+        board = Leaderboard(LSH, size = 3, key = 'test_leaderboard')
+        board.rebuild()
+        reads = []
+        get = board.cache.get
+        board.cache.get = lambda *args: reads.append(args) or get(*args)
+        try:
+            board.offer(LSH(r = 1))
+            self.assertEqual(reads, [])
+            board.offer(LSH.objects.get(p1 = 6.0))
+            self.assertEqual(len(reads), 1)
+        finally:
+            del board.cache.get
+
+    def test_writer_offers_saved_hashes(self):
+        leaderboard.rebuild()
+        writer = Writer(LSH, background = False, on_save = leaderboard.offer)
+        lsh = LSH.objects.get(p1 = 2.0)
+        lsh.record(3.0, 12.0, 1.0)
+        writer.save(lsh)
+        writer.close()
+        self.assertEqual(leaderboard.entries()[0]['id'], lsh.id)
+        self.assertEqual(leaderboard.entries()[0]['score'], 11.0)
+
+
+class LineageTest(TestCase):
+    def family(self):
+        rand = Random(8)
+        founders = []
+        for i in range(4):
+            founders.append(LSH.objects.create(a = [rand.normalvariate(0, 16) for j in range(4)], r = 64, b = 1.0, mean = 0.0, std = 16.0, p1 = 3.0 + i, p2 = 1.0))
+        seed(8)
+        child_a = LSH.breed(founders[0], founders[1])
+        child_b = LSH.breed(founders[2], founders[1])
+        for child in (child_a, child_b):
+            child.record(1.0, 2.0, 1.0)
+            child.save()
+        grandchild = LSH.breed(child_a, child_b)
+        return founders, child_a, child_b, grandchild
+
+    def test_breed_records_lineage(self):
+        founders, child_a, child_b, grandchild = self.family()
+        self.assertEqual([x.generation for x in founders], [0]*4)
+        self.assertEqual(grandchild.generation, 2)
+        self.assertEqual(grandchild.ancestor_levels, [sorted([child_a.id, child_b.id]), sorted(x.id for x in founders[:3])])
+        self.assertEqual(sorted(x.id for x in founders[1].descendants()), sorted([child_a.id, child_b.id, grandchild.id]))
+
+    def test_rebuild_matches_breed(self):
+        self.family()
+        expected = list(LSH.objects.order_by('id').values_list('generation', 'ancestry'))
+        LSH.objects.update(generation = 0, ancestry = '')
+        self.assertEqual(LSH.rebuild_lineage(), len(expected))
+        self.assertEqual(list(LSH.objects.order_by('id').values_list('generation', 'ancestry')), expected)
+
+    def test_ancestry_is_depth_limited(self):
+        rand = Random(9)
+        def founder():
+            return LSH.objects.create(a = [rand.uniform(-1, 1) for j in range(20)], r = 4, b = 1.0, mean = 0.0, std = 1.0, p1 = 2.0, p2 = 1.0)
+        root = lsh = founder()
+        chain = []
+        for i in range(LSH.ANCESTRY_DEPTH + 3):
+            lsh = LSH.breed(lsh, founder())
+            lsh.record(1.0, 2.0, 1.0)
+            lsh.save()
+            chain.append(lsh)
+        self.assertEqual(lsh.generation, LSH.ANCESTRY_DEPTH + 3)
+        self.assertEqual(len(lsh.ancestor_levels), LSH.ANCESTRY_DEPTH)
+        self.assertEqual([len(level) for level in lsh.ancestor_levels], [2]*LSH.ANCESTRY_DEPTH)
+        #Descendants stop at the same depth, one query per generation
+        with self.assertNumQueries(LSH.ANCESTRY_DEPTH):
+            descendants = root.descendants()
+        self.assertEqual(sorted(x.id for x in descendants), [x.id for x in chain[:LSH.ANCESTRY_DEPTH]])
+
+    def test_descendants_are_the_best_of_each_generation(self):
+        rand = Random(10)
+        def founder():
+            return LSH.objects.create(a = [rand.uniform(-1, 1) for j in range(4)], r = 4, b = 1.0, mean = 0.0, std = 1.0, p1 = 2.0, p2 = 1.0)
+        root = founder()
+        children = []
+        for score in (1.0, 5.0, 3.0, 4.0, 2.0):
+            child = LSH.breed(root, founder())
+            child.record(1.0, 1.0 + score, 1.0)
+            child.save()
+            children.append(child)
+        #Bred from a child that won't be shown, so it isn't followed
+        LSH.breed(children[0], founder())
+        best = LSH.breed(children[1], founder())
+        LSH.LINEAGE_WIDTH = 3
+        try:
+            descendants = root.descendants()
+        finally:
+            del LSH.LINEAGE_WIDTH
+        self.assertEqual([x.id for x in descendants], [children[1].id, children[3].id, children[2].id, best.id])
+
+    def test_lineage_view_query_count(self):
+        founders, child_a, child_b, grandchild = self.family()
+        #The hash, its ancestors, and its descendants a generation at a time
+        with self.assertNumQueries(4):
+            response = self.client.get('/%i/lineage/'%child_a.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([g for g, members in response.context['ancestors']], [0])
+        self.assertEqual([[x.id for x in members] for g, members in response.context['descendants']], [[grandchild.id]])
+
+
+class SyntheticCorpusTestCase(TestCase):
+    """
+    Enough small synthetic tiles for ``LSH.evaluate`` to draw its samples.
+    """
+    point_count = 450
+
+    def setUp(self):
+        rand = Random(5)
+        Tile._POINTS = dict((pk, synthetic_tile(pk, rand, size = 30)) for pk in range(1, self.point_count + 1))
+        Tile._GRAPH = None
+        Tile._RADIUS = 0.3
+        Tile._TOLERANCE = 1.2
+        seed(5)
+
+    def tearDown(self):
+        for key in ('_POINTS', '_ENGINE', '_GRAPH', '_RADIUS', '_TOLERANCE'):
+            if key in Tile.__dict__:
+                delattr(Tile, key)
+
+    def lsh(self, rand):
+        lsh = LSH(mean = 0.0, std = 16.0, r = 64, b = 10.0)
+        lsh.a = [rand.normalvariate(0, 16) for i in range(Tile.ENGINE.dimension)]
+        return lsh
+
+
+class ProjectTest(SyntheticCorpusTestCase):
+    def test_project_many_matches_project(self):
+        rand = Random(3)
+        for i in range(5):
+            lsh = self.lsh(rand)
+            lsh.b = rand.uniform(0, 64)
+            buckets = lsh.buckets()
+            for pk, point in Tile.POINTS.items():
+                self.assertEqual(buckets[Tile.ENGINE.row_of(pk)], lsh.project(point))
+
+
+class EvaluateTest(SyntheticCorpusTestCase):
+    def test_evaluate(self):
+        collisions, p1, p2 = self.lsh(Random(1)).evaluate()
+        self.assertTrue(0 <= collisions <= 400)
+        self.assertTrue(0 <= p2 <= collisions)
+        self.assertTrue(0 <= p1 <= collisions)
+
+    def test_parallel_matches_record(self):
+        rand = Random(2)
+        hashes = [self.lsh(rand) for i in range(4)]
+        for lsh in hashes:
+            lsh.save()
+        evaluator = Evaluator(LSH, Tile, 2)
+        lsh_metrics.reset()
+        try:
+            evaluator.test(hashes, early_exit = False)
+        finally:
+            evaluator.close()
+        self.assertEqual(LSH.objects.filter(tested = True).count(), 4)
+        #Counted in the workers
+        self.assertEqual(lsh_metrics.counter('tested'), 4)
+        self.assertEqual(lsh_metrics.phases['distance'][1], 800)
+        for lsh in LSH.objects.all():
+            self.assertTrue(lsh.collisions >= 0)
+
+
+class MetricsTest(SyntheticCorpusTestCase):
+    def setUp(self):
+        super(MetricsTest, self).setUp()
+        self.metrics_root = getattr(settings, 'METRICS_ROOT', None)
+        settings.METRICS_ROOT = tempfile.mkdtemp()
+        lsh_metrics.reset()
+
+    def tearDown(self):
+        shutil.rmtree(settings.METRICS_ROOT)
+        settings.METRICS_ROOT = self.metrics_root
+        super(MetricsTest, self).tearDown()
+
+    def test_evaluate_phases(self):
+        lsh = self.lsh(Random(1))
+        lsh.record(*lsh.evaluate())
+        record = lsh_metrics.generation(stage = 'test')
+        self.assertEqual(sorted(record['phases']), ['distance', 'ground_truth', 'project', 'sample'])
+        self.assertEqual(record['phases']['distance']['calls'], 200)
+        self.assertEqual(record['counters'], {'tested': 1, 'test_points': 200})
+        self.assertEqual(record['values']['score']['count'], 1)
+        self.assertEqual(lsh_metrics.records(), [record])
+        self.assertEqual(lsh_metrics.counter('tested'), 0)
+
+    def test_rotation_and_merge(self):
+        metrics = Metrics('rotating', max_bytes = 2000, backups = 3)
+        worker = Metrics('worker')
+        for i in range(20):
+            with worker.timer('work'):
+                worker.count('items', 2)
+            worker.observe('value', i)
+            metrics.merge(worker.take())
+            metrics.generation(i = i)
+        self.assertTrue(os.path.exists(metrics.path + '.1'))
+        records = metrics.records(limit = 5)
+        self.assertEqual([r['i'] for r in records], range(15, 20))
+        self.assertEqual(records[-1]['counters'], {'items': 2})
+        self.assertEqual(records[-1]['phases']['work']['calls'], 1)
+        self.assertEqual(records[-1]['values']['value']['max'], 19)
+
+    def test_workers_are_combined_by_generation(self):
+        first, second = Metrics('shared'), Metrics('shared')
+        for metrics, worker in ((first, 'host-1'), (second, 'host-2')):
+            metrics.worker = worker
+            metrics.model = MetricsRecord
+        first.observe('score', 1.0)
+        first.count('tested', 3)
+        first.generation(stage = 'breed', generation = 4)
+        second.observe('score', 3.0)
+        second.count('tested', 1)
+        second.count('early_exit', 2)
+        second.generation(stage = 'leased', generation = 4)
+        second.count('tested', 2)
+        second.generation(stage = 'leased', generation = 5)
+        Metrics('shared').generation(stage = 'alone')
+        self.assertEqual(MetricsRecord.objects.count(), 3)
+        self.assertEqual(len(open(first.path).readlines()), 1)
+        records = first.records()
+        self.assertEqual([r.get('generation') for r in records], [4, 5, 0])
+        combined = records[0]
+        self.assertEqual(combined['workers'], ['host-1', 'host-2'])
+        self.assertEqual(combined['stage'], 'breed/leased')
+        self.assertEqual(combined['counters'], {'tested': 4, 'early_exit': 2})
+        self.assertEqual(combined['early_exit_rate'], 0.5)
+        self.assertEqual(combined['values']['score']['count'], 2)
+        self.assertEqual(combined['values']['score']['mean'], 2.0)
+        self.assertEqual(combined['values']['score']['max'], 3.0)
+        self.assertEqual(records[1]['workers'], ['host-2'])
+        self.assertFalse('workers' in records[2])
+        self.assertEqual(first.records(limit = 1), records[-1:])
+
+    def test_stored_rows_are_pruned(self):
+        metrics = Metrics('pruned', max_rows = 3)
+        metrics.worker = 'host-1'
+        metrics.model = MetricsRecord
+        for i in range(5):
+            metrics.generation(generation = i)
+        self.assertEqual([r['generation'] for r in metrics.records()], [2, 3, 4])
+        self.assertEqual(MetricsRecord.objects.count(), 3)
+
+    def test_page_is_staff_only(self):
+        lsh_metrics.generation(stage = 'breed')
+        response = self.client.get('/metrics/')
+        self.assertEqual(response.status_code, 302)
+        User.objects.create_user('staff', 'staff@example.com', 'secret')
+        User.objects.filter(username = 'staff').update(is_staff = True)
+        self.client.login(username = 'staff', password = 'secret')
+        response = self.client.get('/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['stage'] for r in response.context['loops'][0][1]], ['breed'])
+        for limit in ('x', '-3', '100000'):
+            response = self.client.get('/metrics/', {'limit': limit})
+            self.assertEqual(response.status_code, 200)
+        lsh_metrics.generation(stage = 'breed')
+        response = self.client.get('/metrics/', {'limit': '1'})
+        self.assertEqual(len(response.context['loops'][0][1]), 1)
+
+
+class LeaseTest(TestCase):
+    def setUp(self):
+        rand = Random(6)
+        for i in range(10):
+            LSH.objects.create(a = [rand.normalvariate(0, 16) for j in range(4)], r = 64, b = 1.0, mean = 0.0, std = 16.0)
+
+    def test_workers_claim_disjoint_hashes(self):
+        first, second = Leases(LSH, 'first', window = 2), Leases(LSH, 'second', window = 2)
+        a = first.claim(4)
+        b = second.claim(4)
+        self.assertEqual(len(a), 4)
+        self.assertTrue(len(b) > 0)
+        self.assertFalse(set(x.pk for x in a) & set(x.pk for x in b))
+        self.assertEqual(LSH.objects.filter(leased_by = 'first').count(), 4)
+        self.assertTrue(first.outstanding())
+
+    def test_expired_lease_is_reclaimed(self):
+        first, second = Leases(LSH, 'first'), Leases(LSH, 'second')
+        self.assertEqual(len(first.claim(10)), 10)
+        self.assertEqual(second.claim(10), [])
+        LSH.objects.update(leased_until = datetime.now() - timedelta(seconds = 1))
+        self.assertEqual(len(second.claim(10)), 10)
+        self.assertEqual(LSH.objects.filter(leased_by = 'second').count(), 10)
+
+    def test_heartbeat_release_and_record(self):
+        leases = Leases(LSH, 'first', timeout = 60)
+        claimed = leases.claim(3)
+        LSH.objects.filter(leased_by = 'first').update(leased_until = datetime.now())
+        leases.heartbeat()
+        #Renewed a moment ago by the claim
+        self.assertEqual(LSH.objects.filter(leased_until__gt = datetime.now() + timedelta(seconds = 30)).count(), 0)
+        leases.heartbeat(force = True)
+        self.assertEqual(LSH.objects.filter(leased_until__gt = datetime.now() + timedelta(seconds = 30)).count(), 3)
+        claimed[0].record(10, 5, 1)
+        claimed[0].save()
+        leases.release()
+        self.assertEqual(LSH.objects.exclude(leased_by = None).count(), 0)
+        self.assertEqual(LSH.objects.exclude(leased_until = None).count(), 0)
+        self.assertEqual(len(leases.available()), 9)
+
+    def test_election(self):
+        first = Election(Coordinator, 'spawn', 'first')
+        second = Election(Coordinator, 'spawn', 'second')
+        self.assertTrue(first.elect())
+        self.assertFalse(second.elect())
+        self.assertTrue(first.elect())
+        Coordinator.objects.update(leased_until = datetime.now() - timedelta(seconds = 1))
+        self.assertTrue(second.elect())
+        self.assertFalse(first.elect())
+        second.resign()
+        self.assertTrue(first.elect())
+        self.assertEqual(Coordinator.objects.count(), 1)
+
+
+class WorkRoundTest(SyntheticCorpusTestCase):
+    def setUp(self):
+        super(WorkRoundTest, self).setUp()
+        self.initial_population = Tile.INITIAL_POPULATION
+        Tile.INITIAL_POPULATION = 5
+        leaderboard.invalidate()
+
+    def tearDown(self):
+        Tile.INITIAL_POPULATION = self.initial_population
+        leaderboard.invalidate()
+        super(WorkRoundTest, self).tearDown()
+
+    def test_rounds(self):
+        writer = Writer(LSH, background = False)
+        coordinator = (Leases(LSH, 'first'), Election(Coordinator, 'spawn', 'first'))
+        other = (Leases(LSH, 'second'), Election(Coordinator, 'spawn', 'second'))
+        self.assertEqual(LSH.current_generation(), 0)
+        self.assertEqual(LSH.test_batch(coordinator[0], coordinator[1], writer), 0)
+        self.assertEqual(LSH.start_generation(coordinator[0], coordinator[1], writer), 'initial')
+        self.assertEqual(LSH.current_generation(), 1)
+        self.assertEqual(LSH.objects.filter(tested = False).count(), 5)
+        self.assertEqual(LSH.test_batch(other[0], other[1], writer, batch_size = 3), 3)
+        self.assertEqual(LSH.objects.filter(tested = True).count(), 3)
+        #Only the coordinator starts generations, and only once all are tested
+        self.assertEqual(LSH.start_generation(other[0], other[1], writer), None)
+        self.assertEqual(LSH.start_generation(coordinator[0], coordinator[1], writer), None)
+        self.assertEqual(LSH.test_batch(coordinator[0], coordinator[1], writer, batch_size = 3), 2)
+        self.assertFalse(coordinator[0].outstanding())
+        self.assertEqual(LSH.test_batch(other[0], other[1], writer), 0)
+        self.assertEqual(LSH.objects.exclude(leased_by = None).count(), 0)
+        self.assertEqual(LSH.current_generation(), 1)
+        writer.close()
+
+
+class RecordingWriter(Writer):
+    """
+    A background writer that records what it would run instead of running
+    it, since the test database can't be reached from another connection.
+    """
+    def write(self, connection, items):
+        self.batches.append(items)
+
+
+class FailingWriter(RecordingWriter):
+    """
+    Fails the first ``failures`` writes.
+    """
+    def write(self, connection, items):
+        if self.failures:
+            self.failures -= 1
+            raise IOError('lost connection')
+        RecordingWriter.write(self, connection, items)
+
+
+class WriterTest(TestCase):
+    def test_batches_inserts_and_updates(self):
+        existing = LSH.objects.create(a = [1.0, 2.0], r = 10, b = 1.0)
+        writer = Writer(LSH, batch_size = 3, background = False)
+        for i in range(4):
+            writer.save(LSH(a = [float(i)], r = i + 1, b = 0.5, tested = True, collisions = 2.0))
+        existing.p1 = 4.0
+        writer.save(existing)
+        self.assertEqual(LSH.objects.count(), 4)
+        writer.flush()
+        self.assertEqual(LSH.objects.count(), 5)
+        self.assertEqual(LSH.objects.get(pk = existing.pk).p1, 4.0)
+        self.assertEqual(sorted(list(lsh.a) for lsh in LSH.objects.filter(tested = True)), [[0.0], [1.0], [2.0], [3.0]])
+        self.assertEqual(writer.written, 5)
+
+    def test_background_flush_and_close(self):
+        RecordingWriter.batches = []
+        writer = RecordingWriter(LSH, batch_size = 4, interval = 0.05)
+        for i in range(10):
+            writer.save(LSH(r = i))
+        writer.flush()
+        self.assertEqual(sum(len(batch) for batch in writer.batches), 10)
+        self.assertTrue(max(len(batch) for batch in writer.batches) <= 4)
+        writer.save(LSH(id = 3, r = 1))
+        writer.close()
+        self.assertEqual(writer.batches[-1][-1][0], writer.update_sql)
+        self.assertFalse(writer.thread.is_alive())
+
+    def test_closed_writers_are_let_go(self):
+        RecordingWriter.batches = []
+        writer = RecordingWriter(LSH, interval = 0.01)
+        self.assertTrue(writer in persistence._open)
+        writer.close()
+        self.assertFalse(writer in persistence._open)
+
+    def test_failed_batch_is_retried(self):
+        FailingWriter.batches = []
+        FailingWriter.failures = 2
+        writer = FailingWriter(LSH, batch_size = 4, interval = 0.01)
+        for i in range(3):
+            writer.save(LSH(r = i))
+        writer.close()
+        self.assertEqual([len(batch) for batch in writer.batches], [3])
+
+    def test_failed_rows_are_raised(self):
+        FailingWriter.batches = []
+        FailingWriter.failures = 3
+        writer = FailingWriter(LSH, batch_size = 4, interval = 0.01, retries = 1)
+        for i in range(3):
+            writer.save(LSH(r = i))
+        try:
+            writer.flush()
+        except WriteError, e:
+            self.assertEqual(len(e.rows), 3)
+            self.assertTrue(str(e).startswith('3 rows not written'))
+        else:
+            self.fail('WriteError not raised')
+        #The next batch goes through once the failures run out
+        writer.save(LSH(r = 4))
+        writer.close()
+        self.assertEqual([len(batch) for batch in writer.batches], [1])
+
+    def test_on_save_waits_for_the_commit(self):
+        saved = []
+        writer = Writer(LSH, batch_size = 3, background = False, on_save = saved.append)
+        first = LSH(r = 1)
+        writer.save(first)
+        self.assertEqual(saved, [])
+        writer.flush()
+        self.assertEqual(saved, [first])
+        FailingWriter.batches = []
+        FailingWriter.failures = 1
+        failed = []
+        writer = FailingWriter(LSH, batch_size = 4, interval = 0.01, retries = 0, on_save = failed.append)
+        writer.save(LSH(r = 2))
+        self.assertRaises(WriteError, writer.flush)
+        second = LSH(r = 3)
+        writer.save(second)
+        writer.close()
+        self.assertEqual(failed, [second])
+
+    def test_uncommitted_children_are_written(self):
+        seed(3)
+        rand = Random(7)
+        for i in range(3):
+            LSH.objects.create(a = [rand.normalvariate(0, 16) for j in range(4)], r = 64, b = 1.0, mean = 0.0, std = 16.0, p1 = 3.0 + i, p2 = 1.0, tested = True)
+        writer = Writer(LSH, background = False)
+        parents = list(LSH.objects.all())
+        children = [LSH.breed(a, b, commit = False) for a, b in [(parents[0], parents[1]), (parents[1], parents[2])]]
+        self.assertEqual(LSH.objects.count(), 3)
+        for child in children:
+            writer.save(child)
+        writer.close()
+        self.assertEqual(LSH.objects.filter(father__isnull = False).count(), 2)
+
+
+class LSHIndexTest(SyntheticCorpusTestCase):
+    def index(self, r):
+        rand = Random(4)
+        hashes = [self.lsh(rand) for i in range(6)]
+        for lsh in hashes:
+            lsh.r = r
+            lsh.b = r / 2.0
+        index = LSHIndex.from_hashes(hashes, 3, Tile.ENGINE)
+        index.insert_engine()
+        return index
+
+    def test_wide_buckets_match_exact_knn(self):
+        index = self.index(r = 10**9)
+        tile = Tile.POINTS[10]
+        ids, distances = tile.scan(k = 10)
+        self.assertEqual([pk for pk, d in index.query(tile)], ids)
+
+    def test_query_by_address(self):
+        index = self.index(r = 10**9)
+        tile = Tile.POINTS[10]
+        self.assertEqual(index.query(tile.rgb_list, 1)[0], (10, 0.0))
+
+    def test_candidates_share_a_key(self):
+        index = self.index(r = 512)
+        tile = Tile.POINTS[10]
+        keys = [k[0] for k in index.keys(numpy.array([tile.rgb_list]))]
+        for pk in index.candidates(tile):
+            other = [k[0] for k in index.keys(numpy.array([Tile.POINTS[pk].rgb_list]))]
+            self.assertTrue(any((a == b).all() for a, b in zip(keys, other)))
+
+    def test_save_and_insert(self):
+        index = self.index(r = 10**9)
+        path = os.path.join(tempfile.mkdtemp(), 'index.pickle')
+        index.save(path)
+        loaded = LSHIndex.load(path, Tile.ENGINE)
+        new_tile = synthetic_tile(self.point_count + 1, Random(9), size = 30)
+        loaded.insert(new_tile)
+        self.assertEqual(loaded.query(new_tile.rgb_list, 1)[0], (new_tile.id, 0.0))
+
+    def test_stale_index_is_rebuilt(self):
+        rand = Random(4)
+        for i in range(8):
+            lsh = self.lsh(rand)
+            lsh.r = 10**9
+            lsh.p1, lsh.p2 = 10.0 + i, 1.0
+            lsh.save()
+        data_root = settings.DATA_ROOT
+        settings.DATA_ROOT = tempfile.mkdtemp()
+        try:
+            self.assertEqual(LSH.load_index(), None)
+            index = LSH.build_index(tables = 2, width = 3)
+            self.assertTrue(LSH.load_index().current())
+            #Tile 10 deleted since the index was built
+            del Tile._POINTS[10]
+            del Tile._ENGINE
+            stale = LSHIndex.load(LSH.index_path(), Tile.ENGINE)
+            self.assertFalse(stale.current())
+            self.assertFalse(10 in [pk for pk, d in stale.query(Tile.POINTS[11])])
+            rebuilt = LSH.load_index()
+            self.assertTrue(rebuilt.current())
+            self.assertEqual((len(rebuilt.tables), rebuilt.width), (2, 3))
+            self.assertFalse(10 in rebuilt.ids)
+        finally:
+            shutil.rmtree(settings.DATA_ROOT)
+            settings.DATA_ROOT = data_root
@@ -0,0 +1,116 @@
+"""One-off upgrades for existing knn tables.
+
+syncdb only creates missing tables, so a column that changes after its table
+exists is converted here.  Run these from ``manage.py shell`` once per
+database; running them again is harmless.
+"""
+
+from django.db import connection, transaction
+
+from mosy.knn.models import LSH, Coordinator
+from mosy.mosaic.models import CompareMethod, CompareTest, TileFeatures
+from mosy.pof.fields import dbsafe_decode
+from mosy.pof.packed import binary, pack
+
+def pack_lsh_vectors(batch_size = 1000):
+  """
+  Convert ``knn_lsh.a`` from base64 pickles in a text column to packed
+  float64 bytes in a blob column.
+  """
+  cursor = connection.cursor()
+  cursor.execute("ALTER TABLE `knn_lsh` MODIFY `a` LONGBLOB NULL")
+  cursor.execute("SELECT `id`, `a` FROM `knn_lsh` WHERE `a` IS NOT NULL")
+  updates = []
+  for pk, value in cursor.fetchall():
+    try:
+      vector = dbsafe_decode(str(value))
+    except Exception:
+      #Already packed
+      continue
+    updates.append((binary(connection, pack(vector)), pk))
+  for i in range(0, len(updates), batch_size):
+    with transaction.commit_on_success():
+      cursor.executemany("UPDATE `knn_lsh` SET `a` = %s WHERE `id` = %s", updates[i:i+batch_size])
+  print "Packed %i hash vectors"%len(updates)
+
+def pack_tile_features(batch_size = 1000):
+  """
+  Convert ``mosaic_tilefeatures.rgb_list`` and ``mono_list`` from base64
+  pickles in text columns to packed float64 bytes in blob columns.
+  """
+  cursor = connection.cursor()
+  table = TileFeatures._meta.db_table
+  cursor.execute("ALTER TABLE `%s` MODIFY `rgb_list` LONGBLOB NULL, MODIFY `mono_list` LONGBLOB NULL"%table)
+  cursor.execute("SELECT `id`, `rgb_list`, `mono_list` FROM `%s`"%table)
+  updates = []
+  for pk, rgb_list, mono_list in cursor.fetchall():
+    try:
+      rgb_list, mono_list = dbsafe_decode(str(rgb_list)), dbsafe_decode(str(mono_list))
+    except Exception:
+      #Already packed
+      continue
+    updates.append((binary(connection, pack(rgb_list)), binary(connection, pack(mono_list)), pk))
+  for i in range(0, len(updates), batch_size):
+    with transaction.commit_on_success():
+      cursor.executemany("UPDATE `%s` SET `rgb_list` = %%s, `mono_list` = %%s WHERE `id` = %%s"%table, updates[i:i+batch_size])
+  print "Packed the features of %i tiles"%len(updates)
+
+def add_score_column():
+  """
+  Add the indexed ``knn_lsh.score`` column and fill it from ``p1 - p2``.
+  """
+  cursor = connection.cursor()
+  cursor.execute("SHOW COLUMNS FROM `knn_lsh` LIKE 'score'")
+  if not cursor.fetchall():
+    cursor.execute("ALTER TABLE `knn_lsh` ADD COLUMN `score` DOUBLE NULL, ADD INDEX `knn_lsh_score` (`score`)")
+  with transaction.commit_on_success():
+    cursor.execute("UPDATE `knn_lsh` SET `score` = `p1` - `p2` WHERE `p1` IS NOT NULL AND `p2` IS NOT NULL")
+  print "Scored %i hashes"%cursor.rowcount
+
+def add_lineage_columns():
+  """
+  Add ``generation`` and ``ancestry`` to the hash and compare method tables
+  and fill them in from the parent keys.
+  """
+  cursor = connection.cursor()
+  for model in (LSH, CompareMethod):
+    table = model._meta.db_table
+    cursor.execute("SHOW COLUMNS FROM `%s` LIKE 'ancestry'"%table)
+    if not cursor.fetchall():
+      cursor.execute("ALTER TABLE `%s` ADD COLUMN `generation` INTEGER NOT NULL DEFAULT 0, ADD COLUMN `ancestry` LONGTEXT NOT NULL, ADD INDEX `%s_generation` (`generation`)"%(table, table))
+    print "Rebuilt lineage of %i rows in %s"%(model.rebuild_lineage(), table)
+
+def add_claimed_at_column():
+  """
+  Add the indexed ``claimed_at`` column the compare voting view uses to hand
+  out pending tests.
+  """
+  cursor = connection.cursor()
+  table = CompareTest._meta.db_table
+  cursor.execute("SHOW COLUMNS FROM `%s` LIKE 'claimed_at'"%table)
+  if not cursor.fetchall():
+    cursor.execute("ALTER TABLE `%s` ADD COLUMN `claimed_at` DATETIME NULL, ADD INDEX `%s_claimed_at` (`claimed_at`)"%(table, table))
+  print "Added claimed_at to %s"%table
+
+def add_lease_columns():
+  """
+  Add ``leased_by`` and ``leased_until`` to the hash table for
+  ``LSH.work()``.  The coordinator table is new, so syncdb creates it.
+  """
+  cursor = connection.cursor()
+  cursor.execute("SHOW COLUMNS FROM `knn_lsh` LIKE 'leased_by'")
+  if not cursor.fetchall():
+    cursor.execute("ALTER TABLE `knn_lsh` ADD COLUMN `leased_by` VARCHAR(64) NULL, ADD COLUMN `leased_until` DATETIME NULL, ADD INDEX `knn_lsh_leased_until` (`leased_until`)")
+  print "Added lease columns to knn_lsh"
+
+def add_coordinator_generation_column():
+  """
+  Add the ``generation`` count ``LSH.work()`` numbers its metrics by to the
+  coordinator table.
+  """
+  cursor = connection.cursor()
+  table = Coordinator._meta.db_table
+  cursor.execute("SHOW COLUMNS FROM `%s` LIKE 'generation'"%table)
+  if not cursor.fetchall():
+    cursor.execute("ALTER TABLE `%s` ADD COLUMN `generation` INTEGER NOT NULL DEFAULT 0"%table)
+  print "Added generation to %s"%table
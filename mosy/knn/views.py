@@ -1,14 +1,19 @@
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
 from django.db import connection, transaction
+from django.contrib.auth.decorators import user_passes_test
 
-from mosy.knn.models import LSH
+from mosy.knn.models import LSH, leaderboard
+from mosy.metrics import lsh_metrics, compare_metrics
+
+#Records shown per loop on the metrics page
+METRICS_LIMIT = 50
+METRICS_MAX_LIMIT = 500
 
 def index(request):
   template = 'index.html'
   data = {}
-  top_lsh_query = LSH.objects.raw('SELECT id, collisions, a, b, r, mean, std, p1, p2 FROM knn_lsh ORDER BY p1-p2 DESC LIMIT 0, 50')
-  top_lsh = [lsh for lsh in top_lsh_query]
+  top_lsh = leaderboard.entries()
 
   data['top_lsh'] = top_lsh
 
@@ -28,6 +33,48 @@ def detail(request, lsh_id):
   context = RequestContext(request)
   return render_to_response(template, data, context)
 
+def lineage(request, lsh_id):
+  template = 'lineage.html'
+  this_lsh = get_object_or_404(LSH, pk = lsh_id)
+  ancestors, descendants = this_lsh.family()
+  data = {}
+  data['title'] = 'Hash Function %i'%this_lsh.id
+  data['subject'] = this_lsh
+  data['depth'] = LSH.ANCESTRY_DEPTH
+  data['width'] = LSH.LINEAGE_WIDTH
+  data['ancestors'] = LSH.by_generation(ancestors)
+  data['descendants'] = LSH.by_generation(descendants)
+
+  context = RequestContext(request)
+  return render_to_response(template, data, context)
+
+@user_passes_test(lambda user: user.is_staff)
+def metrics(request):
+  template = 'metrics.html'
+  data = {}
+  loops = []
+  try:
+    limit = min(max(int(request.GET.get('limit', METRICS_LIMIT)), 1), METRICS_MAX_LIMIT)
+  except ValueError:
+    limit = METRICS_LIMIT
+  for title, collected in (('Hash Evolution', lsh_metrics), ('Compare Rounds', compare_metrics)):
+    records = collected.records(limit)
+    records.reverse()
+    for record in records:
+      record['phase_list'] = sorted(record['phases'].items(), key = lambda phase: -phase[1]['seconds'])
+      record['counter_list'] = sorted(record['counters'].items())
+      record['value_list'] = sorted(record['values'].items())
+      record['rate_list'] = []
+      if record['per_second'].get('tested') != None:
+        record['rate_list'].append(('hashes/second', '%.2f'%record['per_second']['tested']))
+      if record.get('early_exit_rate') != None:
+        record['rate_list'].append(('early exit rate', '%i%%'%round(record['early_exit_rate']*100)))
+    loops.append((title, records))
+  data['loops'] = loops
+
+  context = RequestContext(request)
+  return render_to_response(template, data, context)
+
 def datapoint(request, dp_id):
   template = 'datapoint.html'
   this_dp = get_object_or_404(DataPoint, pk = dp_id)
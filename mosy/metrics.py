@@ -0,0 +1,294 @@
+"""Phase timings and counters for the evolution loops.
+
+Code marks the phases it spends time in with ``timer(name)``, counts events
+with ``count(name)`` and keeps values such as scores with
+``observe(name, value)``.  At the end of each generation ``generation()``
+writes what was collected as one JSON line to a rotating file and starts
+over, so the file holds a record per generation for the metrics page to
+read back.
+
+Worker processes collect into their own copy and hand ``take()`` back with
+their results for the parent to ``merge()``.  Phases timed on other threads,
+such as the background database writer, overlap the main loop, so phase
+times can add up to more than the generation took.
+
+Rotating files can't be shared between processes, and processes on other
+hosts can't reach this one's files at all, so a loop run by several
+independent processes at once, as ``LSH.work()`` is, sets ``worker`` and a
+``model`` to store its records in.  ``records()`` reads them back from the
+table and ``combine()``s the records of each generation into one.
+"""
+
+import json
+import logging
+import os
+import os.path
+
+from contextlib import contextmanager
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+from threading import Lock
+from time import time
+
+import numpy
+
+from django.conf import settings
+
+class Metrics(object):
+
+  def __init__(self, name, max_bytes = 1024*1024, backups = 5, max_rows = 5000):
+    """
+    Records go to ``<METRICS_ROOT>/<name>.log``, rotated at ``max_bytes``
+    with ``backups`` old files kept.  Once ``worker`` and ``model`` are set,
+    they go to a row of ``model`` instead, and only the last ``max_rows`` of
+    the loop's rows are kept.
+    """
+    self.name = name
+    self.max_bytes = max_bytes
+    self.backups = backups
+    self.max_rows = max_rows
+    self.worker = None
+    self.model = None
+    self.lock = Lock()
+    self.logger = None
+    self.handler = None
+    self.number = 0
+    self.reset()
+
+  @property
+  def path(self):
+    root = getattr(settings, 'METRICS_ROOT', os.path.join(settings.DATA_ROOT, 'metrics'))
+    return os.path.join(root, '%s.log'%self.name)
+
+  def reset(self):
+    with self.lock:
+      self.started = time()
+      self.phases = {}
+      self.counters = {}
+      self.values = {}
+
+  @contextmanager
+  def timer(self, phase):
+    start = time()
+    try:
+      yield
+    finally:
+      self.add_time(phase, time() - start)
+
+  def add_time(self, phase, seconds, calls = 1):
+    with self.lock:
+      total, n = self.phases.get(phase, (0.0, 0))
+      self.phases[phase] = (total + seconds, n + calls)
+
+  def count(self, name, n = 1):
+    with self.lock:
+      self.counters[name] = self.counters.get(name, 0) + n
+
+  def counter(self, name):
+    return self.counters.get(name, 0)
+
+  def observe(self, name, value):
+    with self.lock:
+      self.values.setdefault(name, []).append(value)
+
+  def take(self):
+    """
+    What was collected since the last ``take()``, for a parent process to
+    ``merge()``.
+    """
+    with self.lock:
+      taken = (self.phases, self.counters, self.values)
+      self.phases, self.counters, self.values = {}, {}, {}
+    return taken
+
+  def merge(self, taken):
+    phases, counters, values = taken
+    for phase, (seconds, calls) in phases.items():
+      self.add_time(phase, seconds, calls)
+    for name, n in counters.items():
+      self.count(name, n)
+    with self.lock:
+      for name, observed in values.items():
+        self.values.setdefault(name, []).extend(observed)
+
+  def summary(self, **fields):
+    """
+    The record for what was collected so far, with ``fields`` added.
+    """
+    with self.lock:
+      ended = time()
+      elapsed = ended - self.started
+      record = {
+        'loop': self.name,
+        'generation': self.number,
+        'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'started': self.started,
+        'ended': ended,
+        'seconds': elapsed,
+        'phases': {},
+        'counters': dict(self.counters),
+        'per_second': {},
+        'values': {},
+        }
+      for phase, (seconds, calls) in self.phases.items():
+        record['phases'][phase] = {'seconds': seconds, 'calls': calls, 'share': seconds / elapsed if elapsed else None}
+      for name, n in self.counters.items():
+        record['per_second'][name] = n / elapsed if elapsed else None
+      for name, observed in self.values.items():
+        a = numpy.array([x for x in observed if x != None], dtype = numpy.float64)
+        if len(a):
+          p10, p50, p90 = numpy.percentile(a, [10, 50, 90])
+          record['values'][name] = {
+            'count': len(a), 'min': a.min(), 'p10': p10, 'median': p50,
+            'p90': p90, 'max': a.max(), 'mean': a.mean(),
+            }
+    if self.worker:
+      record['worker'] = self.worker
+    record.update(fields)
+    return record
+
+  def generation(self, **fields):
+    """
+    Write the record for the generation that just ended and start the next.
+    """
+    record = self.summary(**fields)
+    self.write(record)
+    self.number += 1
+    self.reset()
+    return record
+
+  def write(self, record):
+    if self.worker and self.model:
+      self.store(record)
+      return
+    path = os.path.abspath(self.path)
+    if self.handler == None or self.handler.baseFilename != path:
+      if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+      if self.handler != None:
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+      #Settings can point the file elsewhere after the first record, and a
+      #logger per file keeps other instances out of this one
+      self.logger = logging.getLogger('mosy.metrics.%s'%os.path.basename(path)[:-len('.log')])
+      self.logger.propagate = False
+      self.logger.setLevel(logging.INFO)
+      self.handler = RotatingFileHandler(path, maxBytes = self.max_bytes, backupCount = self.backups)
+      self.handler.setFormatter(logging.Formatter('%(message)s'))
+      self.logger.addHandler(self.handler)
+    self.logger.info(json.dumps(record, sort_keys = True))
+
+  def store(self, record):
+    """
+    Save ``record`` as a row of ``model`` and drop the loop's rows beyond
+    the last ``max_rows``.
+    """
+    self.model.objects.create(
+      loop = self.name,
+      worker = record['worker'],
+      generation = record['generation'],
+      ended = record['ended'],
+      record = json.dumps(record, sort_keys = True),
+      )
+    rows = self.model.objects.filter(loop = self.name)
+    cutoff = list(rows.order_by('-id').values_list('id', flat = True)[self.max_rows:self.max_rows + 1])
+    if cutoff:
+      rows.filter(id__lte = cutoff[0]).delete()
+
+  def records(self, limit = 50):
+    """
+    The last ``limit`` records written, oldest first.  Records are read back
+    from the current file and as many rotated ones as it takes, and from the
+    rows of the last ``limit`` generations workers stored, each generation's
+    rows combined into one record.
+    """
+    lines = []
+    for i in range(self.backups + 1):
+      path = self.path if i == 0 else '%s.%i'%(self.path, i)
+      if not os.path.exists(path):
+        break
+      f = open(path)
+      try:
+        lines = f.read().splitlines() + lines
+      finally:
+        f.close()
+      if len(lines) >= limit:
+        break
+    records = []
+    for line in lines[-limit:]:
+      try:
+        records.append(json.loads(line))
+      except ValueError:
+        #Cut short by a crash mid-write
+        continue
+    if self.model:
+      rows = self.model.objects.filter(loop = self.name)
+      generations = set(rows.order_by('-ended').values_list('generation', flat = True)[:limit])
+      for record in rows.filter(generation__in = generations).values_list('record', flat = True):
+        records.append(json.loads(record))
+    records = combine(records)
+    records.sort(key = lambda record: record.get('ended', 0))
+    return records[-limit:]
+
+def combine(records):
+  """
+  ``records`` with those written by workers replaced by one record per
+  generation.  Phase times, counts and value counts are added up, and rates
+  are taken over the time from the first worker starting to the last
+  finishing.  Combined percentiles are the count-weighted means of the
+  workers' own, so only approximate.
+  """
+  combined = [record for record in records if 'worker' not in record]
+  generations = {}
+  for record in records:
+    if 'worker' in record:
+      generations.setdefault(record['generation'], []).append(record)
+  for generation, parts in sorted(generations.items()):
+    if len(parts) == 1:
+      record = dict(parts[0], workers = [parts[0]['worker']])
+      combined.append(record)
+      continue
+    started = min(part['started'] for part in parts)
+    ended = max(part['ended'] for part in parts)
+    elapsed = ended - started
+    record = {
+      'loop': parts[0]['loop'],
+      'generation': generation,
+      'time': max(part['time'] for part in parts),
+      'started': started,
+      'ended': ended,
+      'seconds': elapsed,
+      'stage': '/'.join(sorted(set(part.get('stage') for part in parts if part.get('stage')))),
+      'workers': sorted(set(part['worker'] for part in parts)),
+      'phases': {},
+      'counters': {},
+      'per_second': {},
+      'values': {},
+      }
+    for part in parts:
+      for phase, stats in part['phases'].items():
+        total = record['phases'].setdefault(phase, {'seconds': 0.0, 'calls': 0})
+        total['seconds'] += stats['seconds']
+        total['calls'] += stats['calls']
+      for name, n in part['counters'].items():
+        record['counters'][name] = record['counters'].get(name, 0) + n
+      for name, stats in part['values'].items():
+        record['values'].setdefault(name, []).append(stats)
+    for stats in record['phases'].values():
+      stats['share'] = stats['seconds'] / elapsed if elapsed else None
+    for name, n in record['counters'].items():
+      record['per_second'][name] = n / elapsed if elapsed else None
+    for name, stats in record['values'].items():
+      count = sum(s['count'] for s in stats)
+      value = {'count': count, 'min': min(s['min'] for s in stats), 'max': max(s['max'] for s in stats)}
+      for key in ('p10', 'median', 'p90', 'mean'):
+        value[key] = sum(s[key] * s['count'] for s in stats) / count
+      record['values'][name] = value
+    tested = record['counters'].get('tested')
+    if tested:
+      record['early_exit_rate'] = float(record['counters'].get('early_exit', 0)) / tested
+    combined.append(record)
+  return combined
+
+lsh_metrics = Metrics('lsh')
+compare_metrics = Metrics('compare')
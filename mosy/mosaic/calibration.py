@@ -0,0 +1,237 @@
+"""Calibration of ``Tile.RADIUS`` and ``Tile.TOLERANCE``.
+
+Both come from the distance of each tile to its nearest neighbor: the radius
+is the mean of those distances plus three standard deviations, and the
+tolerance is the radius over the mean.
+
+A calibration is either exact, keeping every tile's nearest neighbor so it
+can be brought up to date as tiles are added and removed, or sampled, taken
+from the nearest neighbors of a random subset of tiles and reported with a
+confidence interval for the radius.  Results are saved as versioned JSON
+together with a fingerprint of the corpus they were measured on.
+"""
+
+import hashlib
+import json
+import os
+import os.path
+
+from math import erf, sqrt
+from random import Random
+
+import numpy
+
+VERSION = 1
+
+def fingerprint(engine):
+  """
+  Identifies the set of tiles in ``engine``.
+  """
+  return hashlib.sha1(numpy.sort(engine.ids).astype('<i8').tostring()).hexdigest()
+
+def z_score(confidence):
+  """
+  Two-sided standard normal quantile for ``confidence``, by bisection.
+  """
+  low, high = 0.0, 10.0
+  for i in range(60):
+    mid = (low + high) / 2
+    if erf(mid / sqrt(2)) < confidence:
+      low = mid
+    else:
+      high = mid
+  return (low + high) / 2
+
+def nearest_distances(nearest):
+  """
+  The finite distances of a ``{pk: (neighbor id, distance)}`` mapping.
+  """
+  return numpy.array([d for nn, d in nearest.values() if nn >= 0], dtype = numpy.float64)
+
+class Calibration(object):
+
+  def __init__(self, distances, fingerprint = None, nearest = None, interval = None, confidence = None):
+    """
+    ``distances`` are the nearest neighbor distances measured.  Exact
+    calibrations also pass ``nearest``, mapping each tile id to its
+    ``(neighbor id, distance)``, or ``(-1, inf)`` for a tile with no other
+    tile to compare with.
+    """
+    self.distances = numpy.asarray(distances, dtype = numpy.float64)
+    self.fingerprint = fingerprint
+    self.nearest = nearest
+    self.interval = interval
+    self.confidence = confidence
+
+  @property
+  def exact(self):
+    return self.nearest != None
+
+  @property
+  def mean(self):
+    return float(self.distances.mean())
+
+  @property
+  def std(self):
+    return float(self.distances.std())
+
+  @property
+  def radius(self):
+    return self.mean + 3*self.std
+
+  @property
+  def tolerance(self):
+    return self.radius / self.mean
+
+  def current(self, engine):
+    return self.fingerprint == fingerprint(engine)
+
+  @classmethod
+  def from_graph(cls, graph, engine):
+    """
+    Exact calibration read off the first column of a neighbor graph built
+    over ``engine``.
+    """
+    nearest = dict(
+      (int(pk), (int(nn), float(d)))
+      for pk, nn, d in zip(graph.ids, graph.neighbors[:, 0], graph.distances[:, 0])
+      )
+    return cls.from_nearest(nearest, engine)
+
+  @classmethod
+  def from_nearest(cls, nearest, engine):
+    return cls(nearest_distances(nearest), fingerprint(engine), nearest)
+
+  @classmethod
+  def estimate(cls, engine, sample_size = 500, confidence = 0.95, seed = None):
+    """
+    Sampled calibration from the nearest neighbors of ``sample_size`` random
+    tiles, each compared against the whole corpus.
+
+    The interval treats the sample mean and standard deviation as
+    independent and normally distributed, with standard errors
+    ``std/sqrt(n)`` and ``std/sqrt(2(n-1))``.
+    """
+    n = len(engine)
+    rand = Random(seed)
+    sample = rand.sample(range(n), min(sample_size, n))
+    everything = numpy.arange(n)
+    distances = []
+    for row in sample:
+      d = engine.row_distance(row, everything[everything != row])
+      if len(d):
+        distances.append(d.min())
+    calibration = cls(distances, fingerprint(engine), confidence = confidence)
+    m = len(distances)
+    if m > 1:
+      s = calibration.std
+      error = z_score(confidence) * sqrt(s*s/m + 9*s*s/(2*(m-1)))
+      calibration.interval = (calibration.radius - error, calibration.radius + error)
+    return calibration
+
+  def _nearest_to(self, engine, pk, ids):
+    others = [x for x in ids if x != pk]
+    if not others:
+      return -1, float('inf')
+    d = engine.row_distance(engine.row_of(pk), engine.select(others))
+    i = d.argmin()
+    return others[i], float(d[i])
+
+  def add(self, engine, pk):
+    """
+    Measure tile ``pk`` against the calibrated tiles, updating only the
+    tiles it is now the nearest neighbor of.
+    """
+    assert self.exact
+    pk = int(pk)
+    if pk in self.nearest:
+      return
+    ids = list(self.nearest)
+    d = engine.row_distance(engine.row_of(pk), engine.select(ids))
+    for other, distance in zip(ids, d):
+      if distance < self.nearest[other][1]:
+        self.nearest[other] = (pk, float(distance))
+    if len(d):
+      i = d.argmin()
+      self.nearest[pk] = (ids[i], float(d[i]))
+    else:
+      self.nearest[pk] = (-1, float('inf'))
+
+  def remove(self, engine, *pks):
+    """
+    Drop tiles ``pks``.  Tiles whose nearest neighbor was one of them are
+    measured again.
+    """
+    assert self.exact
+    gone = set(int(pk) for pk in pks)
+    for pk in gone:
+      self.nearest.pop(pk, None)
+    ids = list(self.nearest)
+    for pk, (nn, d) in self.nearest.items():
+      if nn in gone:
+        self.nearest[pk] = self._nearest_to(engine, pk, ids)
+
+  def sync(self, engine):
+    """
+    Bring an exact calibration in line with the tiles in ``engine``.  Returns
+    ``(added, removed)`` counts.
+    """
+    current = set(int(pk) for pk in engine.ids)
+    removed = [pk for pk in self.nearest if pk not in current]
+    added = sorted(current - set(self.nearest))
+    self.remove(engine, *removed)
+    for pk in added:
+      self.add(engine, pk)
+    self.distances = nearest_distances(self.nearest)
+    self.fingerprint = fingerprint(engine)
+    return len(added), len(removed)
+
+  def as_dict(self):
+    data = {
+      'version': VERSION,
+      'fingerprint': self.fingerprint,
+      'exact': self.exact,
+      'count': len(self.distances),
+      'mean': self.mean,
+      'std': self.std,
+      'radius': self.radius,
+      'tolerance': self.tolerance,
+      'interval': self.interval and list(self.interval),
+      'confidence': self.confidence,
+      }
+    if self.exact:
+      #JSON has no infinity, so tiles without a neighbor are stored with None
+      data['nearest'] = [[pk, nn, d if nn >= 0 else None] for pk, (nn, d) in sorted(self.nearest.items())]
+    else:
+      data['distances'] = self.distances.tolist()
+    return data
+
+  def save(self, path):
+    tmp_path = path + '.tmp'
+    f = open(tmp_path, 'w')
+    try:
+      json.dump(self.as_dict(), f)
+    finally:
+      f.close()
+    os.rename(tmp_path, path)
+
+  @classmethod
+  def load(cls, path):
+    """
+    The calibration saved at ``path``, or None if there isn't one or it was
+    saved by another version.
+    """
+    if not os.path.exists(path):
+      return None
+    f = open(path)
+    try:
+      data = json.load(f)
+    finally:
+      f.close()
+    if data.get('version') != VERSION:
+      return None
+    interval = data['interval'] and tuple(data['interval'])
+    if data['exact']:
+      nearest = dict((int(pk), (int(nn), float('inf') if d == None else float(d))) for pk, nn, d in data['nearest'])
+      return cls(nearest_distances(nearest), data['fingerprint'], nearest, interval, data['confidence'])
+    return cls(data['distances'], data['fingerprint'], None, interval, data['confidence'])
@@ -0,0 +1,288 @@
+"""Batched tile distances.
+
+The scalar ``Tile.compare`` can be split into parts that don't depend on the
+weight vector: the Levenshtein distance between the two ``str_list`` strings
+and the squared error summed over each of the R, G and B channels.  The mse
+under any weight is then
+
+  (rw**2*E_r + gw**2*E_g + bw**2*E_b) / ((rw+gw+bw)**2 * N)
+
+so the engine computes those components for one query against many tiles in
+a couple of array operations and combines them per weight.
+"""
+
+import Levenshtein
+import numpy
+
+from mosy.mosaic.editdistance import bounded_many, count_bound, histogram
+
+DISTANCE_WEIGHTS = (
+  (18.56569, 11.86457),
+  (16.26291, 21.83507),
+  (25.23813, 18.94915),
+  (27.06847, 17.89424),
+  (30.59219, 24.93490),
+  (17.26454, 18.09663),
+  )
+
+class DistanceEngine(object):
+  """
+  Holds the ``rgb_list`` of every point as one row of a float matrix, plus the
+  matching ``str_list`` strings, so a query can be compared against all of
+  them (or a subset of rows) at once.  ``strings`` may be any sequence; a
+  list is only made of it when a tile is added.  ``histograms`` can be given
+  if they were counted already.
+  """
+
+  def __init__(self, ids, sizes, matrix, strings, histograms = None):
+    self.ids = numpy.asarray(ids, dtype = numpy.int64)
+    self.sizes = numpy.asarray(sizes, dtype = numpy.int64)
+    self.matrix = numpy.asarray(matrix, dtype = numpy.float64)
+    self.strings = strings if hasattr(strings, '__getitem__') else list(strings)
+    assert len(self.ids) == len(self.strings) == self.matrix.shape[0]
+    self._rows = None
+    self._histograms = histograms
+
+  @classmethod
+  def from_points(cls, points):
+    ids = sorted(points.keys())
+    tiles = [points[pk] for pk in ids]
+    return cls(
+      ids,
+      [t.size for t in tiles],
+      [t.rgb_list for t in tiles],
+      [t.str_list for t in tiles],
+      )
+
+  def __len__(self):
+    return len(self.ids)
+
+  @property
+  def rows(self):
+    """
+    ``{id: row}``, built the first time it is needed.
+    """
+    if self._rows is None:
+      self._rows = dict((int(pk), row) for row, pk in enumerate(self.ids))
+    return self._rows
+
+  def __contains__(self, pk):
+    return int(pk) in self.rows
+
+  def add(self, tile):
+    """
+    Append ``tile`` as a new row.  This copies the matrix, so it is meant for
+    the odd new tile rather than loading a corpus.
+    """
+    if tile.id in self:
+      return self.rows[int(tile.id)]
+    address = numpy.asarray(tile.rgb_list, dtype = numpy.float64)
+    assert address.shape[0] == self.dimension
+    self.ids = numpy.append(self.ids, tile.id)
+    self.sizes = numpy.append(self.sizes, tile.size)
+    self.matrix = numpy.vstack((self.matrix, address))
+    self.strings = list(self.strings) + [tile.str_list]
+    self.rows[int(tile.id)] = len(self.ids) - 1
+    self._histograms = None
+    return self.rows[int(tile.id)]
+
+  @property
+  def dimension(self):
+    return self.matrix.shape[1]
+
+  def row_of(self, pk):
+    return self.rows.get(int(pk))
+
+  def select(self, candidates = None, exclude = None):
+    """
+    Resolve ``candidates`` (tile ids, or None for every point) to an array of
+    matrix rows, leaving out the row of ``exclude`` if given.
+    """
+    if candidates is None:
+      rows = numpy.arange(len(self.ids))
+    else:
+      rows = numpy.array([self.rows[int(pk)] for pk in candidates], dtype = numpy.int64)
+    if exclude is not None and int(exclude) in self.rows:
+      rows = rows[rows != self.rows[int(exclude)]]
+    return rows
+
+  def components(self, query, rows):
+    """
+    Per-pair parts of ``Tile.compare`` between ``query`` and each of ``rows``.
+
+    Returns ``(lv, err)``: the raw Levenshtein distances as a float array and an
+    ``(len(rows), 3)`` array of squared errors summed per colour channel.
+    """
+    address = numpy.asarray(query.rgb_list, dtype = numpy.float64)
+    assert address.shape[0] == self.dimension
+    return self._components(address, query.str_list, rows)
+
+  def row_components(self, row, rows):
+    """
+    ``components`` for a point already in the engine, given by its row.
+    """
+    return self._components(self.matrix[row], self.strings[row], rows)
+
+  def _components(self, address, s, rows):
+    diff = self.matrix[rows] - address
+    diff *= diff
+    err = diff.reshape(len(rows), self.dimension/3, 3).sum(axis = 1)
+    strings = self.strings
+    lv = numpy.array([Levenshtein.distance(s, strings[r]) for r in rows], dtype = numpy.float64)
+    return lv, err
+
+  def combine(self, lv, err, weights):
+    """
+    Average of ``Tile.compare`` over ``weights`` given precomputed components.
+    """
+    n = float(self.dimension)
+    d = numpy.zeros(len(lv))
+    for weight in weights:
+      lw, nw = weight[:2]
+      d += lv / n * lw / (lw+nw)
+      d += self.nrmsd(err, weight) * nw / (lw+nw)
+    return d / len(weights)
+
+  def nrmsd(self, err, weight):
+    rw, gw, bw = weight[2:] if len(weight) == 5 else (1.0, 1.0, 1.0)
+    s = rw + gw + bw
+    #Elementwise rather than a dot product, so a row gives the same value
+    #whichever other rows it is computed with
+    mse = (err[:, 0]*(rw*rw) + err[:, 1]*(gw*gw) + err[:, 2]*(bw*bw)) / (s*s) / self.dimension
+    return numpy.sqrt(mse) / 255
+
+  def compare_many(self, lv, err, weights):
+    """
+    ``Tile.compare`` under each five-value weight in ``weights`` given
+    precomputed components, as a ``(len(lv), len(weights))`` array.  Column
+    ``i`` is exactly ``combine(lv, err, (weights[i],))``.
+    """
+    lw, nw, rw, gw, bw = numpy.asarray(weights, dtype = numpy.float64).T
+    s = rw + gw + bw
+    n = float(self.dimension)
+    mse = (err[:, 0:1]*(rw*rw) + err[:, 1:2]*(gw*gw) + err[:, 2:3]*(bw*bw)) / (s*s) / self.dimension
+    d = numpy.zeros((len(lv), len(lw)))
+    d += lv[:, numpy.newaxis] / n * lw / (lw+nw)
+    d += numpy.sqrt(mse) / 255 * nw / (lw+nw)
+    return d
+
+  def compare(self, query, weight, candidates = None, exclude = None):
+    """
+    ``Tile.compare(query, tile, weight)`` for every candidate.  Returns the
+    rows compared and their values.
+    """
+    rows = self.select(candidates, exclude)
+    lv, err = self.components(query, rows)
+    return rows, self.combine(lv, err, (weight,))
+
+  def distance(self, query, candidates = None, exclude = None):
+    """
+    ``Tile.distance(query, tile)`` for every candidate.  Returns the rows
+    compared and their distances.
+    """
+    rows = self.select(candidates, exclude)
+    lv, err = self.components(query, rows)
+    return rows, self.combine(lv, err, DISTANCE_WEIGHTS)
+
+  @property
+  def histograms(self):
+    """
+    Count of each character value in every string, one row per point.
+    """
+    if self._histograms is None:
+      self._histograms = numpy.array([histogram(s) for s in self.strings], dtype = numpy.int32).reshape(len(self.strings), 256)
+    return self._histograms
+
+  def knn(self, query, k, weights = DISTANCE_WEIGHTS, candidates = None, exclude = None, chunk_size = 64):
+    """
+    ``nearest()`` over the average of ``Tile.compare`` under ``weights``, with
+    the same result as measuring every candidate.
+
+    Candidates are visited in order of a lower bound on their distance: the
+    cheap colour error term plus the fewest edits that could turn one
+    string's character counts into the other's.  Levenshtein is only run
+    while that bound can still beat the current ``k``-th nearest.
+    """
+    rows = self.select(candidates, exclude)
+    address = numpy.asarray(query.rgb_list, dtype = numpy.float64)
+    assert address.shape[0] == self.dimension
+    diff = self.matrix[rows] - address
+    diff *= diff
+    err = diff.reshape(len(rows), self.dimension/3, 3).sum(axis = 1)
+
+    edits = count_bound(self.histograms[rows], histogram(query.str_list))
+    bound = self.combine(edits.astype(numpy.float64), err, weights)
+    order = numpy.lexsort((numpy.arange(len(rows)), bound))
+    bound = bound[order]
+    #How much one edit adds to the distance
+    per_edit = self.combine(numpy.ones(1), numpy.zeros((1, 3)), weights)[0]
+
+    s = query.str_list
+    strings = self.strings
+    best_d = numpy.zeros(0)
+    best_i = numpy.zeros(0, dtype = numpy.int64)
+    pos = 0
+    while pos < len(order):
+      if len(best_d) < k:
+        end = pos + max(k - len(best_d), chunk_size)
+      else:
+        #Anything bounded above the k-th distance can't enter the result
+        end = min(numpy.searchsorted(bound, best_d[-1], side = 'right'), pos + chunk_size)
+        if end <= pos:
+          break
+      chunk = order[pos:end]
+      pos += len(chunk)
+      if len(best_d) < k:
+        lv = numpy.array([Levenshtein.distance(s, strings[r]) for r in rows[chunk]], dtype = numpy.float64)
+        d = self.combine(lv, err[chunk], weights)
+      else:
+        #Stop each edit distance once it can't bring the candidate under the
+        #k-th distance, with an edit to spare for rounding
+        cheap = self.combine(numpy.zeros(len(chunk)), err[chunk], weights)
+        max_edits = int(numpy.floor(((best_d[-1] - cheap) / per_edit).max())) + 1
+        lv = bounded_many(s, [strings[r] for r in rows[chunk]], max_edits, self.histograms[rows[chunk]])
+        d = self.combine(lv.astype(numpy.float64), err[chunk], weights)
+        d[lv > max_edits] = numpy.inf
+      d = numpy.concatenate((best_d, d))
+      i = numpy.concatenate((best_i, chunk))
+      keep = numpy.lexsort((i, d))[:k]
+      best_d = d[keep]
+      best_i = i[keep]
+    return self.ids[rows[best_i]], best_d
+
+  def row_distance(self, row, rows):
+    """
+    ``Tile.distance`` from the point at ``row`` to each of ``rows``.
+    """
+    lv, err = self.row_components(row, rows)
+    return self.combine(lv, err, DISTANCE_WEIGHTS)
+
+  def nearest(self, rows, d, k):
+    """
+    The ``k`` closest of ``rows`` as ``(ids, distances)`` sorted nearest
+    first.  Ties keep their order in ``rows``.
+    """
+    order = numpy.argsort(d, kind = 'mergesort')[:k]
+    return self.ids[rows[order]], d[order]
+
+class PairComponents(object):
+  """
+  The components between one target and its candidates, kept so the nearest
+  candidate under any number of weights costs one small array operation
+  instead of a scan.
+  """
+
+  def __init__(self, engine, target, candidates = None):
+    self.engine = engine
+    self.rows = engine.select(candidates, exclude = target.id)
+    self.lv, self.err = engine.components(target, self.rows)
+
+  def compare(self, weights):
+    return self.engine.compare_many(self.lv, self.err, weights)
+
+  def nearest(self, weights):
+    """
+    Id of the nearest candidate under each of ``weights``.
+    """
+    d = self.compare(weights)
+    return [int(pk) for pk in self.engine.ids[self.rows[d.argmin(axis = 0)]]]
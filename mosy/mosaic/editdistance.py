@@ -0,0 +1,123 @@
+"""Edit distances with a cutoff.
+
+Callers that only need to know whether two strings are within
+``max_distance`` edits of each other can stop early once they aren't.  Every
+function here returns the exact distance when it is ``max_distance`` or less
+and ``max_distance + 1`` (meaning "exceeds") otherwise.
+
+Two cheap checks come first: the length difference, and half the L1 gap
+between the strings' character counts, both of which never exceed the edit
+distance.  Strings that pass are compared inside a diagonal band of width
+``2*max_distance + 1``; a path that leaves the band needs more than
+``max_distance`` insertions or deletions, so nothing outside it matters.
+"""
+
+import Levenshtein
+import numpy
+
+#Below this ratio of band width to string length the banded kernel beats
+#running the full C implementation on every candidate.
+BAND_RATIO = 0.1
+
+def histogram(s):
+  return numpy.bincount(numpy.frombuffer(s, dtype = numpy.uint8), minlength = 256)
+
+def count_bound(histogram_a, histogram_b):
+  """
+  Fewest edits that could turn one character count into the other.
+  """
+  return numpy.abs(histogram_a - histogram_b).sum(axis = -1) / 2
+
+def bounded(a, b, max_distance):
+  """
+  Levenshtein distance between ``a`` and ``b``, or ``max_distance + 1`` if it
+  is larger than ``max_distance``.
+  """
+  max_distance = int(max_distance)
+  #Even equal strings are further apart than a negative limit
+  if max_distance < 0:
+    return max_distance + 1
+  if abs(len(a) - len(b)) > max_distance:
+    return max_distance + 1
+  if count_bound(histogram(a), histogram(b)) > max_distance:
+    return max_distance + 1
+  if len(a) == len(b) and 2*max_distance + 1 < BAND_RATIO * len(a):
+    return int(banded(a, [b], max_distance)[0])
+  return min(Levenshtein.distance(a, b), max_distance + 1)
+
+def bounded_many(query, strings, max_distance, histograms = None):
+  """
+  ``bounded()`` between ``query`` and each of ``strings`` as an int array.
+  ``histograms`` may hold precomputed character counts of ``strings``.
+  """
+  max_distance = int(max_distance)
+  result = numpy.empty(len(strings), dtype = numpy.int64)
+  result.fill(max_distance + 1)
+  if max_distance < 0 or not len(strings):
+    return result
+  if histograms is None:
+    histograms = numpy.array([histogram(s) for s in strings]).reshape(len(strings), 256)
+  lengths = numpy.array([len(s) for s in strings])
+  alive = (numpy.abs(lengths - len(query)) <= max_distance)
+  alive &= count_bound(histograms, histogram(query)) <= max_distance
+  alive = numpy.nonzero(alive)[0]
+  if not len(alive):
+    return result
+  if (lengths[alive] == len(query)).all() and 2*max_distance + 1 < BAND_RATIO * len(query):
+    result[alive] = banded(query, [strings[i] for i in alive], max_distance)
+  else:
+    for i in alive:
+      result[i] = min(Levenshtein.distance(query, strings[i]), max_distance + 1)
+  return result
+
+def banded(query, strings, max_distance):
+  """
+  Banded edit distance between ``query`` and strings of the same length, all
+  advanced one row at a time together.  Strings whose whole band goes over
+  ``max_distance`` are dropped as soon as that happens.
+  """
+  n = len(query)
+  k = max_distance
+  width = 2*k + 1
+  limit = k + 1
+  result = numpy.empty(len(strings), dtype = numpy.int64)
+  result.fill(limit)
+  if n == 0:
+    result.fill(0)
+    return result
+
+  q = numpy.frombuffer(query, dtype = numpy.uint8)
+  chars = numpy.frombuffer(''.join(strings), dtype = numpy.uint8).reshape(len(strings), n)
+  index = numpy.arange(len(strings))
+  offsets = numpy.arange(width)
+
+  #Band cell t of row i is column j = i + t - k.  Row 0 is j edits away.
+  j = offsets - k
+  row = numpy.where(j >= 0, j, limit)
+  row = numpy.tile(numpy.minimum(row, limit), (len(strings), 1))
+  for i in range(1, n + 1):
+    j = i + offsets - k
+    inside = (j >= 0) & (j <= n)
+    cols = numpy.clip(j - 1, 0, n - 1)
+    cost = (chars[:, cols] != q[i-1]).astype(numpy.int64)
+    diagonal = row + cost
+    up = numpy.empty_like(row)
+    up[:, :-1] = row[:, 1:] + 1
+    up[:, -1] = limit
+    best = numpy.minimum(diagonal, up)
+    best[:, j == 0] = i
+    best[:, ~inside] = limit
+    #Moves along the row: best[t] = min over s <= t of best[s] + (t - s)
+    best = numpy.minimum.accumulate(best - offsets, axis = 1) + offsets
+    best[:, ~inside] = limit
+    row = numpy.minimum(best, limit)
+
+    alive = row.min(axis = 1) <= k
+    if not alive.all():
+      row = row[alive]
+      chars = chars[alive]
+      index = index[alive]
+      if not len(index):
+        return result
+  result[index] = row[:, k]
+  return result
@@ -0,0 +1,178 @@
+"""Bulk export of tiles from stock images.
+
+Every requested tile size is cut from one decode of the stock image.  JPEGs
+are decoded in draft mode at the smallest scale that still covers the
+largest size, which skips most of the work for big photos.  Tiles are
+encoded and hashed in memory, along with their features, on a pool of worker
+processes, a few images per worker at a time; the parent checks a whole
+batch for existing tiles in one query and inserts the new ones in one
+transaction.
+
+A tile already exported from the same stock image at the same size is
+skipped even if its hash differs, as it will when the image was decoded by an
+earlier version of this module; otherwise the two near copies would be each
+other's nearest neighbors.
+"""
+
+import hashlib
+import os
+
+from cStringIO import StringIO
+from itertools import imap
+from multiprocessing import Pool
+from time import time
+
+from PIL import Image
+
+from django.db import connection, transaction
+
+from mosy.mosaic import features
+from mosy.mosaic.ingest import bounded_imap
+
+def square_box(x_size, y_size):
+  """
+  The square ``export_tile`` cuts from an image: centered across a wide
+  image, from the top of a tall one.
+  """
+  if x_size > y_size:
+    left = int(round((x_size-y_size)/2.0))
+    return (left, 0, left + y_size, y_size)
+  return (0, 0, x_size, x_size)
+
+def render(data, sizes, chunk_size):
+  """
+  Cut tiles of each of ``sizes`` from the image in ``data``.  Returns
+  ``(size, hash, data, (rgb_list, mono_list))`` for each size the image is
+  big enough for; the features are None for sizes ``chunk_size`` doesn't
+  divide.
+  """
+  im = Image.open(StringIO(data))
+  image_format = im.format
+  x_size, y_size = im.size
+  sizes = sorted([s for s in sizes if s <= x_size and s <= y_size], reverse = True)
+  if not sizes:
+    return []
+  #Scale the draft so its short side still covers the largest tile
+  scale = float(sizes[0]) / min(x_size, y_size)
+  im.draft(im.mode, (int(x_size*scale + 0.5), int(y_size*scale + 0.5)))
+  im = im.crop(square_box(*im.size))
+  im.load()
+
+  tiles = []
+  for size in sizes:
+    tile = im.resize((size, size))
+    buf = StringIO()
+    tile.save(buf, image_format)
+    tile_data = buf.getvalue()
+    tile_features = None
+    if size % chunk_size == 0:
+      #Read back what was written, as ``Tile.rgb_list`` would
+      rgb_list, mono_list, str_list = features.extract(Image.open(StringIO(tile_data)), chunk_size)
+      tile_features = (rgb_list, mono_list)
+    tiles.append((size, hashlib.sha256(tile_data).hexdigest(), tile_data, tile_features))
+  return tiles
+
+def _render(args):
+  pk, path, sizes, chunk_size = args
+  try:
+    f = open(path, 'rb')
+    try:
+      data = f.read()
+    finally:
+      f.close()
+    return pk, render(data, sizes, chunk_size), None
+  except Exception, e:
+    return pk, [], str(e) or e.__class__.__name__
+
+class Export(object):
+
+  def __init__(self, tile_model, features_model, processes = 1, batch_size = 100, report_every = 10.0, in_flight = None):
+    self.tile_model = tile_model
+    self.features_model = features_model
+    self.processes = processes
+    self.in_flight = in_flight or 4 * processes
+    self.batch_size = batch_size
+    self.report_every = report_every
+    self.counts = dict.fromkeys(('images', 'created', 'existing', 'error'), 0)
+
+  def run(self, stock_images, sizes):
+    """
+    Export tiles of every one of ``sizes`` from each of ``stock_images``.
+    Returns counts of images read, tiles created, tiles that already
+    existed and images that failed.
+    """
+    names = {}
+    jobs = []
+    for stock in stock_images:
+      names[stock.id] = (stock.filename, stock.extension)
+      jobs.append((stock.id, stock.image.path, tuple(sizes), self.tile_model.CHUNK_SIZE))
+
+    pool = None
+    results = imap(_render, jobs)
+    if self.processes > 1:
+      connection.close()
+      pool = Pool(self.processes)
+      results = bounded_imap(pool, _render, jobs, self.in_flight)
+
+    self.start_time = self.last_report = time()
+    batch = []
+    try:
+      for pk, tiles, error in results:
+        self.counts['images'] += 1
+        if error:
+          print "Skipping stock image %i (%s)"%(pk, error)
+          self.counts['error'] += 1
+        filename, extension = names[pk]
+        for size, im_hash, data, tile_features in tiles:
+          name = '%s_%i%s%s'%(filename, size, os.extsep, extension)
+          batch.append((pk, name, size, im_hash, data, tile_features))
+        if len(batch) >= self.batch_size:
+          self.save(batch)
+          batch = []
+        if time() - self.last_report >= self.report_every:
+          self.report()
+      self.save(batch)
+    except:
+      if pool:
+        pool.terminate()
+      raise
+    if pool:
+      pool.close()
+      pool.join()
+    self.report()
+    return self.counts
+
+  def save(self, batch):
+    """
+    Insert the tiles in ``batch`` whose hash isn't stored yet, and that
+    weren't exported from the same image at the same size before, with their
+    features, in one transaction.
+    """
+    if not batch:
+      return
+    hashes = set(item[3] for item in batch)
+    existing = set(self.tile_model.objects.filter(hash__in = hashes).values_list('hash', flat = True))
+    exported = set(self.tile_model.objects.filter(
+      origin__in = set(item[0] for item in batch),
+      size__in = set(item[2] for item in batch),
+      ).values_list('origin', 'size'))
+    stored = set(self.features_model.objects.filter(hash__in = hashes).values_list('hash', flat = True))
+    with transaction.commit_on_success():
+      for pk, name, size, im_hash, data, tile_features in batch:
+        if im_hash in existing or (pk, size) in exported:
+          self.counts['existing'] += 1
+          continue
+        existing.add(im_hash)
+        exported.add((pk, size))
+        self.tile_model.create_from_data(pk, name, size, im_hash, data)
+        if tile_features and im_hash not in stored:
+          rgb_list, mono_list = tile_features
+          self.features_model.objects.create(hash = im_hash, rgb_list = rgb_list, mono_list = mono_list)
+          stored.add(im_hash)
+        self.counts['created'] += 1
+
+  def report(self):
+    self.last_report = time()
+    elapsed = max(self.last_report - self.start_time, 1e-6)
+    print "%(images)i images: %(created)i tiles created, %(existing)i existing, %(error)i errors"%self.counts,
+    print "(%.1f images/s)"%(self.counts['images']/elapsed)
@@ -0,0 +1,77 @@
+"""Tile feature extraction.
+
+A tile is described by the mean colour of each ``chunk_size`` square block,
+read left to right and top to bottom.  The means are taken over whole-number
+pixel sums, so they are exactly the values ``ImageStat.Stat(block).mean``
+gives for the same block.
+"""
+
+import os
+import os.path
+import hashlib
+
+from cStringIO import StringIO
+
+import numpy
+
+from PIL import Image
+
+def block_means(im, chunk_size):
+  """
+  Mean of every band over each ``chunk_size`` block of ``im``, flattened
+  block by block.
+  """
+  a = numpy.asarray(im, dtype = numpy.int64)
+  if a.ndim == 2:
+    a = a[:, :, numpy.newaxis]
+  height, width, bands = a.shape
+  assert height % chunk_size == 0 and width % chunk_size == 0
+  a = a.reshape(height/chunk_size, chunk_size, width/chunk_size, chunk_size, bands)
+  sums = a.sum(axis = 3).sum(axis = 1)
+  return sums.ravel() / float(chunk_size*chunk_size)
+
+def str_from_rgb(rgb_list):
+  return ''.join([chr(int(round(x))) for x in rgb_list])
+
+def extract(im, chunk_size):
+  """
+  ``(rgb_list, mono_list, str_list)`` for an image, decoding it only once.
+  """
+  im.load()
+  mono = block_means(im.convert('L'), chunk_size)
+  if im.mode == 'L':
+    rgb = numpy.repeat(mono, 3)
+  else:
+    if im.mode != 'RGB':
+      im = im.convert('RGB')
+    rgb = block_means(im, chunk_size)
+  rgb_list = tuple(rgb.tolist())
+  return rgb_list, tuple(mono.tolist()), str_from_rgb(rgb_list)
+
+def extract_file(file_path, chunk_size):
+  """
+  ``(hash, (rgb_list, mono_list, str_list))`` for an image file, hashing and
+  decoding the same bytes.
+  """
+  f = open(file_path, 'rb')
+  try:
+    data = f.read()
+  finally:
+    f.close()
+  im = Image.open(StringIO(data))
+  return hashlib.sha256(data).hexdigest(), extract(im, chunk_size)
+
+def extract_directory(directory, chunk_size):
+  """
+  Yield ``(path, hash, features)`` for every image under ``directory``.
+  Files PIL can't read are skipped.
+  """
+  for root, dirs, files in os.walk(directory):
+    for entry in sorted(files):
+      file_path = os.path.join(root, entry)
+      try:
+        im_hash, features = extract_file(file_path, chunk_size)
+      except IOError:
+        print "IOError (%s)"%file_path
+        continue
+      yield file_path, im_hash, features
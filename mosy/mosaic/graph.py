@@ -0,0 +1,165 @@
+"""Exact k-nearest-neighbor graph over every tile.
+
+Each node keeps the ids and ``Tile.distance`` of its ``k`` nearest tiles,
+nearest first.  Missing neighbors (when the corpus has ``k`` tiles or fewer)
+are stored as id -1 at an infinite distance.
+"""
+
+import os
+import os.path
+
+import numpy
+
+class KNNGraph(object):
+
+  def __init__(self, ids, neighbors, distances):
+    self.ids = numpy.asarray(ids, dtype = numpy.int64)
+    self.neighbors = numpy.asarray(neighbors, dtype = numpy.int64)
+    self.distances = numpy.asarray(distances, dtype = numpy.float64)
+    self.rows = dict((int(pk), row) for row, pk in enumerate(self.ids))
+
+  def __len__(self):
+    return len(self.ids)
+
+  def __contains__(self, pk):
+    return int(pk) in self.rows
+
+  @property
+  def k(self):
+    return self.neighbors.shape[1]
+
+  def covers(self, ids):
+    """
+    Whether the graph was built over exactly the tiles ``ids``.
+    """
+    return len(ids) == len(self.ids) and all(int(pk) in self.rows for pk in ids)
+
+  def neighbors_of(self, pk, k = None):
+    """
+    ``(ids, distances)`` of the ``k`` nearest neighbors of tile ``pk``.
+    """
+    row = self.rows[int(pk)]
+    found = self.neighbors[row] >= 0
+    ids = self.neighbors[row][found][:k]
+    distances = self.distances[row][found][:k]
+    return [int(x) for x in ids], [float(x) for x in distances]
+
+  @classmethod
+  def build(cls, engine, k = 200):
+    """
+    Build the graph over every point in ``engine``.
+
+    The distance is symmetric, so each pair is measured once: row ``i`` is
+    compared with rows after it only, and each of those distances is offered
+    to both ends of the pair.
+    """
+    n = len(engine)
+    distances = numpy.empty((n, k))
+    distances.fill(numpy.inf)
+    neighbors = -numpy.ones((n, k), dtype = numpy.int64)
+    worst = numpy.empty(n)
+    worst.fill(numpy.inf)
+    for i in range(n):
+      rows = numpy.arange(i+1, n)
+      d = engine.row_distance(i, rows) if len(rows) else numpy.zeros(0)
+
+      #Later rows keep d[i, j] if it beats their current farthest neighbor
+      better = d < worst[rows]
+      if better.any():
+        j = rows[better]
+        pos = distances[j].argmax(axis = 1)
+        distances[j, pos] = d[better]
+        neighbors[j, pos] = i
+        worst[j] = distances[j].max(axis = 1)
+
+      #Row i has now seen every earlier row, so merge in the later ones
+      cand_d = numpy.concatenate((distances[i], d))
+      cand_r = numpy.concatenate((neighbors[i], rows))
+      order = numpy.lexsort((cand_r, cand_d))[:k]
+      distances[i] = cand_d[order]
+      neighbors[i] = cand_r[order]
+
+    ids = numpy.where(neighbors >= 0, engine.ids[neighbors], -1)
+    return cls(engine.ids, ids, distances)
+
+  def _scan(self, engine, pk):
+    """
+    Nearest ``k`` graph nodes to tile ``pk`` as ``(ids, distances)`` arrays,
+    padded to length ``k``.
+    """
+    ids = self.ids[self.ids != pk]
+    d = engine.row_distance(engine.row_of(pk), engine.select(ids))
+    order = numpy.lexsort((ids, d))[:self.k]
+    pad = self.k - len(order)
+    return (
+      numpy.concatenate((ids[order], -numpy.ones(pad, dtype = numpy.int64))),
+      numpy.concatenate((d[order], numpy.repeat(numpy.inf, pad))),
+      )
+
+  def add(self, engine, pk):
+    """
+    Add tile ``pk`` (which must be in ``engine``) as a node, offering it to
+    every node it is closer to than their current farthest neighbor.
+    """
+    pk = int(pk)
+    if pk in self.rows:
+      return
+    d = engine.row_distance(engine.row_of(pk), engine.select(self.ids))
+    better = numpy.nonzero(d < self.distances[:, -1])[0]
+    if len(better):
+      self.neighbors[better, -1] = pk
+      self.distances[better, -1] = d[better]
+      for row in better:
+        order = numpy.lexsort((self.neighbors[row], self.distances[row]))
+        self.neighbors[row] = self.neighbors[row][order]
+        self.distances[row] = self.distances[row][order]
+    neighbors, distances = self._scan(engine, pk)
+    self.ids = numpy.append(self.ids, pk)
+    self.neighbors = numpy.vstack((self.neighbors, neighbors))
+    self.distances = numpy.vstack((self.distances, distances))
+    self.rows[pk] = len(self.ids) - 1
+
+  def remove(self, engine, *pks):
+    """
+    Drop tiles ``pks`` from the graph.  Nodes that had one of them as a
+    neighbor are scanned again to refill their list.
+    """
+    gone = numpy.array([int(pk) for pk in pks if int(pk) in self.rows], dtype = numpy.int64)
+    if not len(gone):
+      return
+    keep = ~numpy.in1d(self.ids, gone)
+    self.ids = self.ids[keep]
+    self.neighbors = self.neighbors[keep]
+    self.distances = self.distances[keep]
+    self.rows = dict((int(x), row) for row, x in enumerate(self.ids))
+    for row in numpy.nonzero(numpy.in1d(self.neighbors, gone).reshape(self.neighbors.shape).any(axis = 1))[0]:
+      self.neighbors[row], self.distances[row] = self._scan(engine, int(self.ids[row]))
+
+  def sync(self, engine):
+    """
+    Bring the graph in line with the points in ``engine``, adding and removing
+    only the tiles that changed.  Returns ``(added, removed)`` counts.
+    """
+    current = set(int(pk) for pk in engine.ids)
+    removed = [int(pk) for pk in self.ids if int(pk) not in current]
+    added = sorted(current - set(self.rows))
+    self.remove(engine, *removed)
+    for pk in added:
+      self.add(engine, pk)
+    return len(added), len(removed)
+
+  def save(self, path):
+    tmp_path = path + '.tmp'
+    f = open(tmp_path, 'wb')
+    try:
+      numpy.savez(f, ids = self.ids, neighbors = self.neighbors, distances = self.distances)
+    finally:
+      f.close()
+    os.rename(tmp_path, path)
+
+  @classmethod
+  def load(cls, path):
+    if not os.path.exists(path):
+      return None
+    data = numpy.load(path)
+    return cls(data['ids'], data['neighbors'], data['distances'])
@@ -0,0 +1,177 @@
+"""Streaming import of stock images.
+
+Each file is read once: the same bytes are hashed, checked by PIL, and
+handed to storage.  Reading and checking run on a pool of worker processes
+that are forked after the hashes already in the database are loaded, so
+duplicates are dropped before their bytes are sent back to the parent.  Only
+a few files per worker are in flight at once, so workers wait for the parent
+rather than queueing image bytes faster than it can insert them.  The parent
+inserts new images in batches, one transaction per batch, and
+appends the paths of each committed batch to a journal so an interrupted
+import picks up where it stopped.  Files that couldn't be read or checked
+aren't journaled, so they are tried again.
+"""
+
+import hashlib
+import os
+import os.path
+
+from collections import deque
+from cStringIO import StringIO
+from itertools import imap
+from multiprocessing import Pool
+from time import time
+
+from PIL import Image
+
+from django.db import connection, transaction
+
+#Hashes already imported, set in the parent before the pool is forked
+_known = frozenset()
+
+def read_image(path):
+  """
+  Read the file at ``path`` once and return ``(hash, data)``.  Raises if it
+  can't be read or isn't an image PIL understands.
+  """
+  f = open(path, 'rb')
+  try:
+    data = f.read()
+  finally:
+    f.close()
+  Image.open(StringIO(data)).verify()
+  return hashlib.sha256(data).hexdigest(), data
+
+def _inspect(path):
+  """
+  ``(path, hash, data, error)`` for one file.  ``data`` is None for images
+  that are already imported.
+  """
+  try:
+    im_hash, data = read_image(path)
+  except Exception, e:
+    return path, None, None, str(e) or e.__class__.__name__
+  if im_hash in _known:
+    data = None
+  return path, im_hash, data, None
+
+def bounded_imap(pool, func, items, in_flight):
+  """
+  ``pool.imap(func, items)`` with no more than ``in_flight`` items handed to
+  the pool and not yet consumed.
+  """
+  pending = deque()
+  for item in items:
+    pending.append(pool.apply_async(func, (item, )))
+    if len(pending) >= in_flight:
+      yield pending.popleft().get()
+  while pending:
+    yield pending.popleft().get()
+
+def find_images(directory, pattern):
+  """
+  Every file under ``directory`` whose name matches ``pattern``, in a stable
+  order.
+  """
+  for root, dirs, files in os.walk(directory):
+    dirs.sort()
+    for name in sorted(files):
+      if pattern.match(name):
+        yield os.path.join(root, name)
+
+class Ingest(object):
+
+  def __init__(self, model, processes = 1, batch_size = 100, journal = None, report_every = 10.0, in_flight = None):
+    """
+    At most ``in_flight`` files, four per process by default, are read and
+    not yet inserted at once.
+    """
+    self.model = model
+    self.processes = processes
+    self.in_flight = in_flight or 4 * processes
+    self.batch_size = batch_size
+    self.journal = journal
+    self.report_every = report_every
+    self.done = set()
+    if journal and os.path.exists(journal):
+      f = open(journal)
+      try:
+        self.done = set(line.rstrip('\n') for line in f)
+      finally:
+        f.close()
+    self.counts = dict.fromkeys(('seen', 'imported', 'duplicate', 'error'), 0)
+    self.bytes = 0
+
+  def run(self, paths):
+    """
+    Import every image in ``paths`` not already recorded in the journal.
+    Returns the counts of files seen, imported, skipped as duplicates and
+    failed.
+    """
+    global _known
+    known = set(h for h in self.model.objects.values_list('hash', flat = True) if h)
+    _known = frozenset(known)
+    paths = (path for path in paths if path not in self.done)
+
+    pool = None
+    results = imap(_inspect, paths)
+    if self.processes > 1:
+      connection.close()
+      pool = Pool(self.processes)
+      results = bounded_imap(pool, _inspect, paths, self.in_flight)
+
+    self.start_time = self.last_report = time()
+    batch = []
+    try:
+      for path, im_hash, data, error in results:
+        self.counts['seen'] += 1
+        if error:
+          #Left out of the journal, so a resumed import tries it again
+          print "Skipping %s (%s)"%(path, error)
+          self.counts['error'] += 1
+        else:
+          if data == None or im_hash in known:
+            self.counts['duplicate'] += 1
+            data = None
+          else:
+            known.add(im_hash)
+            self.bytes += len(data)
+          batch.append((path, im_hash, data))
+        if len(batch) >= self.batch_size:
+          self.save(batch)
+          batch = []
+        if time() - self.last_report >= self.report_every:
+          self.report()
+      self.save(batch)
+    except:
+      if pool:
+        pool.terminate()
+      raise
+    if pool:
+      pool.close()
+      pool.join()
+    self.report()
+    return self.counts
+
+  def save(self, batch):
+    """
+    Insert the new images in ``batch`` in one transaction, then record every
+    path in it, imported or duplicate, as done.
+    """
+    with transaction.commit_on_success():
+      for path, im_hash, data in batch:
+        if data != None:
+          self.model.create_from_data(os.path.basename(path), im_hash, data)
+          self.counts['imported'] += 1
+    if self.journal and batch:
+      f = open(self.journal, 'a')
+      try:
+        f.writelines(path + '\n' for path, im_hash, data in batch)
+      finally:
+        f.close()
+
+  def report(self):
+    self.last_report = time()
+    elapsed = max(self.last_report - self.start_time, 1e-6)
+    print "%(seen)i files: %(imported)i imported, %(duplicate)i duplicates, %(error)i errors"%self.counts,
+    print "(%.1f files/s, %.1f MB/s)"%(self.counts['seen']/elapsed, self.bytes/elapsed/2**20)
@@ -0,0 +1,10 @@
+from mosy.mosaic.models import Tile
+
+class PointStoreMiddleware(object):
+  """
+  Switches a web process to a newly published tile snapshot between
+  requests.
+  """
+
+  def process_request(self, request):
+    Tile.refresh()
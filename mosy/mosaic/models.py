@@ -4,19 +4,26 @@ import re
 import hashlib
 import Levenshtein
 import mimetypes
-import shelve
 
+from collections import OrderedDict
 from itertools import combinations
 from math import sqrt, log
-from random import randint, uniform, shuffle, normalvariate
-from PIL.ImageFile import Parser
-from PIL import Image, ImageStat
-from tempfile import NamedTemporaryFile
+from random import randint, uniform, shuffle, normalvariate, sample
+from PIL import Image
 
-from django.core.files import File
-from django.db import models, connection
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import models, connection, transaction
 
 from mosy.behaviors.models import *
+from mosy.metrics import compare_metrics
+from mosy.pof.packed import PackedFloatArrayField
+from mosy.mosaic import export, features, ingest, pixelmap
+from mosy.mosaic.pending import PendingTests
+from mosy.mosaic.calibration import Calibration
+from mosy.mosaic.distance import DistanceEngine, PairComponents, DISTANCE_WEIGHTS
+from mosy.mosaic.graph import KNNGraph
+from mosy.mosaic.snapshot import PointStore, Snapshot, digest
 
 FILE_NAME = re.compile('^([0-9]+)\.(jpg|jpeg|gif|bmp|png)$')
 
@@ -67,73 +74,51 @@ class StockImage(BaseImage):
   BASE_PATH = 'stock'
 
   @classmethod
-  def crawl(cls, directory):
-    for entry in os.listdir(directory):
-      abs_path = os.path.join(directory, entry)
-      if os.path.isdir(abs_path):
-        cls.crawl(abs_path)
-      elif os.path.isfile(abs_path) and FILE_NAME.match(entry):
-        print "Importing %s"%abs_path
-        try:
-          cls.import_image(abs_path)
-        except IOError:
-          print "IOError"
+  def crawl(cls, directory, processes = None, batch_size = 100, journal = None):
+    """
+    Import every image under ``directory``.  ``journal`` names a file that
+    records finished paths, so running the same crawl again resumes it.
+    """
+    if processes == None:
+      processes = getattr(settings, 'INGEST_PROCESSES', 1)
+    pipeline = ingest.Ingest(cls, processes, batch_size, journal)
+    return pipeline.run(ingest.find_images(directory, FILE_NAME))
 
   @classmethod
   def import_image(cls, file_path):
-    image_parser = Parser()
-
-    f = open(file_path, 'rb')
-    while True:
-      buf = f.read(8192)
-      if buf:
-        image_parser.feed(buf)
-        continue
-      break
-    image_parser.close()
-    im_hash = cls.hash_image(f)
+    im_hash, data = ingest.read_image(file_path)
     if cls.objects.filter(hash = im_hash).exists():
       print "Skipping duplicate (%s)"%im_hash
     else:
-      cls.objects.create(
-        image = File(f),
-        hash = im_hash,
-        )
+      return cls.create_from_data(os.path.basename(file_path), im_hash, data)
+
+  @classmethod
+  def create_from_data(cls, name, im_hash, data):
+    stock = cls(hash = im_hash)
+    stock.image.save(name, ContentFile(data))
+    return stock
+
+  @classmethod
+  def export_tiles(cls, sizes, stock_images = None, processes = None, batch_size = 100):
+    """
+    Export tiles of each of ``sizes`` from ``stock_images`` (every stock
+    image by default), decoding each image once for all sizes.
+    """
+    if stock_images == None:
+      stock_images = cls.objects.all()
+    if processes == None:
+      processes = getattr(settings, 'EXPORT_PROCESSES', 1)
+    job = export.Export(Tile, TileFeatures, processes, batch_size)
+    return job.run(stock_images, sizes)
 
   def export_tile(self, tile_size):
-    self.image.open('r')
-    im = Image.open(self.image.file)
-    x_size, y_size = im.size
+    x_size, y_size = self.image.width, self.image.height
     if x_size < tile_size or y_size < tile_size:
       print "Image dimensions (%ix%i) smaller than desired tile size(%i)"%(x_size, y_size, tile_size)
       return False
-    if x_size > y_size:
-      ul = int(round((x_size-y_size)/2.0))
-      ur = 0
-      ll = int(round((x_size-y_size)/2.0+y_size))
-      lr = y_size
-    elif y_size > x_size:
-      ul = 0
-      ur = 0
-      ll = x_size
-      lr = x_size
-
-    if not x_size == y_size:
-      im.crop((ul, ur, ll, lr))
-    im = im.resize((tile_size, tile_size))
-    tmp_file = NamedTemporaryFile(prefix = self.filename, suffix = os.extsep + self.extension)
-    im.save(tmp_file)
-    im_hash = StockImage.hash_image(tmp_file)
-    if Tile.objects.filter(hash = im_hash).exists():
-      print "Tile Already Exists (%s)"%im_hash
-    else:
-      im = File(tmp_file)
-      Tile.objects.create(
-        image = im,
-        hash = im_hash,
-        origin = self,
-        size = tile_size,
-        )
+    counts = StockImage.export_tiles([tile_size], [self], processes = 1)
+    if counts['existing']:
+      print "Tile Already Exists"
 
 class classproperty(property):
   def __get__(self, cls, owner):
@@ -143,76 +128,263 @@ class Tile(BaseImage):
   BASE_PATH = 'tile'
   CHUNK_SIZE = 10
   INITIAL_POPULATION = 2000
+  #Tiles whose distance components pair_components() keeps
+  COMPONENT_CACHE_SIZE = 256
   origin = models.ForeignKey(StockImage, related_name = '+')
   size = models.IntegerField()
 
   @classmethod
-  def load_data(cls, key):
-    ds = shelve.open('tile_data')
-    if ds.has_key(key):
-      setattr(cls, '_' + key, ds[key])
-    ds.close()
+  def init(cls):
+    """
+    Map the published tile snapshot instead of reading every tile from the
+    database.  A missing snapshot, or one whose tiles or images differ from
+    the table's, is published again from the database first.
+    """
+    if hasattr(cls, '_POINTS'):
+      return
+    snapshot = cls.point_store().current()
+    if snapshot != None and snapshot.contents != cls.contents():
+      print "Tile snapshot is out of date, rewriting it"
+      snapshot = None
+    if snapshot == None:
+      snapshot = cls.save_snapshot()
+    cls.use_snapshot(snapshot)
 
   @classmethod
-  def init(cls):
-    ds = shelve.open('tile_data')
-    for key in ('RADIUS', 'TOLERANCE', 'POINTS'):
-      if ds.has_key(key) and not hasattr(cls, '_' + key):
-        setattr(cls, '_' + key, ds[key])
-    ds.close()
+  def contents(cls):
+    """
+    Digest of every tile's id and image hash, to compare with a snapshot's.
+    """
+    rows = list(cls.objects.order_by('id').values_list('id', 'hash'))
+    return digest([pk for pk, im_hash in rows], [im_hash or '' for pk, im_hash in rows])
+
+  @classmethod
+  def attach(cls):
+    """
+    Map the published snapshot, or the newer one if it was published again
+    since, without touching the database.  Returns whether one is mapped.
+    The store is looked at no more than once every few seconds.
+    """
+    snapshot = cls.point_store().current()
+    if snapshot == None:
+      return False
+    if getattr(cls, '_SNAPSHOT', None) is not snapshot:
+      cls.use_snapshot(snapshot)
+    return True
+
+  @classmethod
+  def refresh(cls):
+    """
+    Switch a process that attached to the newest published snapshot.  Web
+    processes call it before each request, so a rebuilt corpus is picked up
+    without a restart and never changes under a view.
+    """
+    if '_SNAPSHOT' in cls.__dict__:
+      cls.attach()
+
+  @classmethod
+  def point_store(cls):
+    if not hasattr(cls, '_STORE'):
+      cls._STORE = PointStore(getattr(settings, 'POINT_STORE_ROOT', settings.DATA_ROOT))
+    return cls._STORE
+
+  @classmethod
+  def save_snapshot(cls):
+    """
+    Rebuild the snapshot from the tile table and publish it for every
+    process on the host to map.  The stored calibration goes with it if it
+    was made over the same tiles; otherwise processes calibrate when they
+    first need ``RADIUS``.
+    """
+    tiles = list(cls.objects.all())
+    cls.load_features(tiles)
+    snapshot = Snapshot.from_points(dict((t.id, t) for t in tiles))
+    calibration = Calibration.load(cls.calibration_path())
+    if calibration and calibration.current(snapshot.engine):
+      snapshot.radius, snapshot.tolerance = calibration.radius, calibration.tolerance
+    return cls.point_store().publish(snapshot)
+
+  @classmethod
+  def use_snapshot(cls, snapshot):
+    cls._SNAPSHOT = snapshot
+    cls._POINTS = snapshot.points(cls)
+    cls._ENGINE = snapshot.engine
+    for key in ('_GRAPH', '_COMPONENTS'):
+      if key in cls.__dict__:
+        delattr(cls, key)
+    if snapshot.radius != None:
+      cls._RADIUS = snapshot.radius
+      cls._TOLERANCE = snapshot.tolerance
+    else:
+      #Calibrated over other tiles
+      for key in ('_RADIUS', '_TOLERANCE'):
+        if key in cls.__dict__:
+          delattr(cls, key)
 
   @classproperty
   @classmethod
   def RADIUS(cls):
     if not hasattr(cls, '_RADIUS'):
-      r = 0.0
-      c = 0
-      for p in cls.POINTS:
-        point = cls.POINTS[p]
-        r = (r*c + cls.distance(point, point.nn))/(c+1)
-      t = 0.0
-      for p in cls.POINTS:
-        point = cls.POINTS[p]
-        t += (cls.distance(point, point.nn) - r)**2
-        t /= len(cls.POINTS)
-        t = sqrt(t)
-      cls._RADIUS = r + 3*t
-      cls._TOLERANCE = cls._RADIUS / r
+      cls.calibrate()
     return cls._RADIUS
 
   @classproperty
   @classmethod
   def TOLERANCE(cls):
     if not hasattr(cls, '_TOLERANCE'):
-      temp = cls.RADIUS
+      cls.calibrate()
     return cls._TOLERANCE
 
+  @classmethod
+  def calibration_path(cls):
+    return os.path.join(settings.DATA_ROOT, 'calibration.json')
+
+  @classmethod
+  def calibrate(cls, sample_size = None, confidence = 0.95):
+    """
+    Set ``RADIUS`` and ``TOLERANCE`` from the stored calibration, brought up
+    to date first if the tiles changed since it was saved.  Without a stored
+    calibration one is read off the neighbor graph, or estimated from a
+    sample of 500 tiles if there is no graph.  Passing ``sample_size`` always
+    takes a fresh sample of that many tiles.
+    """
+    engine = cls.ENGINE
+    calibration = None
+    if sample_size == None:
+      calibration = Calibration.load(cls.calibration_path())
+    changed = calibration == None or not calibration.current(engine)
+    if calibration and changed:
+      if calibration.exact:
+        added, removed = calibration.sync(engine)
+        print "Calibration updated: %i added, %i removed"%(added, removed)
+      else:
+        calibration = None
+    if calibration == None:
+      if sample_size == None and cls.GRAPH:
+        calibration = Calibration.from_graph(cls.GRAPH, engine)
+      else:
+        calibration = Calibration.estimate(engine, sample_size or 500, confidence)
+        if calibration.interval:
+          print "Radius %f, %i%% interval %f - %f"%((calibration.radius, confidence*100) + calibration.interval)
+    if changed:
+      calibration.save(cls.calibration_path())
+    cls._RADIUS = calibration.radius
+    cls._TOLERANCE = calibration.tolerance
+    return calibration
+
   @classproperty
   @classmethod
   def POINTS(cls):
     if not hasattr(cls, '_POINTS'):
-      points = cls.objects.all()
-      temp = {}
-      for p in points:
-        p.mono_list, p.rgb_list, p.str_list
-        temp[p.id] = p
-      cls._POINTS = temp
+      points = list(cls.objects.all())
+      cls.load_features(points)
+      cls._POINTS = dict((p.id, p) for p in points)
     return cls._POINTS
 
+  @classmethod
+  def load_features(cls, tiles, batch_size = 500):
+    """
+    Attach stored features to ``tiles`` in bulk.  Tiles whose image hash has
+    no stored features are decoded once and their features stored.
+    """
+    by_hash = {}
+    for tile in tiles:
+      by_hash.setdefault(tile.hash, []).append(tile)
+    hashes = [h for h in by_hash if h]
+    for i in range(0, len(hashes), batch_size):
+      for stored in TileFeatures.objects.filter(hash__in = hashes[i:i+batch_size]):
+        for tile in by_hash.pop(stored.hash):
+          stored.apply(tile)
+    with transaction.commit_on_success():
+      for missing in by_hash.values():
+        for tile in missing:
+          tile.store_features()
+
+  @classmethod
+  def create_from_data(cls, origin_id, name, size, im_hash, data):
+    tile = cls(origin_id = origin_id, size = size, hash = im_hash)
+    tile.image.save(name, ContentFile(data))
+    return tile
+
+  def store_features(self):
+    if self.hash:
+      TileFeatures.objects.get_or_create(
+        hash = self.hash,
+        defaults = {'rgb_list': self.rgb_list, 'mono_list': self.mono_list},
+        )
+
+  @classproperty
+  @classmethod
+  def ENGINE(cls):
+    if not hasattr(cls, '_ENGINE'):
+      cls._ENGINE = DistanceEngine.from_points(cls.POINTS)
+    return cls._ENGINE
+
+  @classproperty
+  @classmethod
+  def GRAPH(cls):
+    """
+    The stored nearest neighbor graph, or None if there isn't one or it was
+    built over a different set of tiles than ``POINTS``.
+    """
+    if not hasattr(cls, '_GRAPH'):
+      graph = KNNGraph.load(cls.graph_path())
+      if graph and not graph.covers(cls.POINTS.keys()):
+        print "Neighbor graph is out of date, run Tile.update_graph()"
+        graph = None
+      cls._GRAPH = graph
+    return cls._GRAPH
+
+  @classmethod
+  def graph_path(cls):
+    return os.path.join(settings.DATA_ROOT, 'knn_graph.npz')
+
+  @classmethod
+  def build_graph(cls, k = 200):
+    graph = KNNGraph.build(cls.ENGINE, k)
+    graph.save(cls.graph_path())
+    cls._GRAPH = graph
+    return graph
+
+  @classmethod
+  def update_graph(cls):
+    """
+    Add and remove the tiles that changed since the graph was stored, or build
+    it from scratch if there is no stored graph.
+    """
+    graph = KNNGraph.load(cls.graph_path())
+    if graph == None:
+      return cls.build_graph()
+    added, removed = graph.sync(cls.ENGINE)
+    print "Neighbor graph updated: %i added, %i removed"%(added, removed)
+    graph.save(cls.graph_path())
+    cls._GRAPH = graph
+    return graph
+
+  @classmethod
+  def pair_components(cls, tile, cache_size = None):
+    """
+    ``PairComponents`` between ``tile`` and every other point, cached for the
+    ``cache_size`` most recently added tiles.
+    """
+    if cache_size == None:
+      cache_size = cls.COMPONENT_CACHE_SIZE
+    if not hasattr(cls, '_COMPONENTS'):
+      cls._COMPONENTS = OrderedDict()
+    components = cls._COMPONENTS.get(tile.id)
+    if components == None or components.engine is not cls.ENGINE:
+      components = PairComponents(cls.ENGINE, tile)
+      cls._COMPONENTS[tile.id] = components
+      while len(cls._COMPONENTS) > cache_size:
+        cls._COMPONENTS.popitem(last = False)
+    return components
+
   @classmethod
   def distance(cls, tile_a, tile_b):
-    weights = (
-      (18.56569, 11.86457),
-      (16.26291, 21.83507),
-      (25.23813, 18.94915),
-      (27.06847, 17.89424),
-      (30.59219, 24.93490),
-      (17.26454, 18.09663),
-      )
     d = 0.0
-    for weight in weights:
+    for weight in DISTANCE_WEIGHTS:
       d += cls.compare(tile_a, tile_b, weight)
-    return d/len(weights)
+    return d/len(DISTANCE_WEIGHTS)
 
   @classmethod
   def compare(cls, tile_a, tile_b, weight = None, equal = False):
@@ -221,8 +393,10 @@ class Tile(BaseImage):
       if equal:
         weight = (100.0, 100.0)
       weight = tuple([normalvariate(20, 5) for i in range(5)])
-    lw, nw, rw, gw, bw = weight
-    mse = cls.mse(tile_a, tile_b, weight = (rw, gw, bw))
+    #Weights without a colour component compare the channels equally
+    lw, nw = weight[:2]
+    rgb_weight = weight[2:] if len(weight) == 5 else (1.0, 1.0, 1.0)
+    mse = cls.mse(tile_a, tile_b, weight = rgb_weight)
 
     levenshtein = cls.levenshtein(tile_a, tile_b) * lw / (lw+nw)
     #psnr = cls.psnr(tile_a, tile_b, mse = mse) * weight[1] / sum(weight)
@@ -261,64 +435,77 @@ class Tile(BaseImage):
       mse = cls.mse(tile_a, tile_b)
     return sqrt(mse) / 255
 
+  def scan(self, weight = None, k = 1, candidates = None):
+    """
+    The ``k`` nearest points to this tile as ``(ids, distances)``, nearest
+    first.  Measured with ``Tile.distance`` when ``weight`` is None, otherwise
+    with ``Tile.compare`` under that weight.
+    """
+    weights = DISTANCE_WEIGHTS
+    if weight != None:
+      weights = (weight,)
+    ids, d = Tile.ENGINE.knn(self, k, weights, candidates = candidates, exclude = self.id)
+    return [int(pk) for pk in ids], [float(x) for x in d]
+
+  def _neighbor(self, ids, dists):
+    if not ids:
+      return None
+    nn = Tile.POINTS[ids[0]]
+    nn.distance = dists[0]
+    return nn
+
+  def neighbors(self, k):
+    """
+    ``scan()`` for the ``k`` nearest points by ``Tile.distance``, read from the
+    neighbor graph when it covers them.
+    """
+    graph = Tile.GRAPH
+    if graph and self.id in graph and k <= graph.k:
+      return graph.neighbors_of(self.id, k)
+    return self.scan(k = k)
+
   @property
   def nn(self):
     if not hasattr(self, '_nn'):
-      nn = None
-      for p in Tile.POINTS:
-        other = Tile.POINTS[p]
-        if other.id == self.id:
-          continue
-        other.distance = Tile.distance(self, other)
-        if nn == None or other.distance < nn.distance:
-          nn = other
-      self._nn = nn
+      self._nn = self._neighbor(*self.neighbors(1))
     return self._nn
 
   def get_nn(self, weight = None, debug = False):
-    nn = None
-    for p in Tile.POINTS:
-      other = Tile.POINTS[p]
-      if other.id == self.id:
-        continue
-      other.distance = Tile.compare(self, other, weight)
-      if not nn or other.distance < nn.distance:
-        nn = other
-        if debug:
-          print "New Neighbor: %i - %f"%(other.id, other.distance)
+    if weight == None:
+      weight = tuple([normalvariate(20, 5) for i in range(5)])
+    nn = self._neighbor(*self.scan(weight))
+    if debug and nn:
+      print "Nearest Neighbor: %i - %f"%(nn.id, nn.distance)
     return nn
 
+  @classmethod
+  def knn_cache(cls):
+    """
+    ``{id: knn}`` over the current ``ENGINE``.  Kept here rather than on
+    each tile, since ``POINTS`` may let go of a tile and make it again.
+    """
+    engine = cls.ENGINE
+    if getattr(cls, '_KNN_ENGINE', None) is not engine:
+      cls._KNN_ENGINE, cls._KNN = engine, {}
+    return cls._KNN
+
+  #Neighbor ids are ordered farthest first
   @property
   def knn(self):
-    if not hasattr(self, '_knn'):
-      neighbors = []
-      for p in Tile.POINTS:
-        other = Tile.POINTS[p]
-        if other.id == self.id:
-          continue
-        other.distance = Tile.distance(self, other)
-        if len(neighbors) < 200 or other.distance < neighbors[0].distance:
-          neighbors.append(other)
-          neighbors = sorted(neighbors, key = lambda p: p.distance)
-          neighbors = neighbors[:200]
-          neighbors.reverse()
-      self._knn =  [n.id for n in neighbors]
-    return self._knn
+    cache = Tile.knn_cache()
+    if self.id not in cache:
+      ids, dists = self.neighbors(200)
+      ids.reverse()
+      cache[self.id] = ids
+    return cache[self.id]
 
   def get_knn(self, weight = None, points = None):
-    neighbors = []
-    for p in Tile.POINTS:
-      other = Tile.POINTS[p]
-      if other.id == self.id:
-        continue
-      other.distance = Tile.compare(self, other, weight)
-      if len(neighbors) < 200 or other.distance < neighbors[0].distance:
-        neighbors.append(other)
-        neighbors = sorted(neighbors, key = lambda p: p.distance)
-        neighbors = neighbors[:200]
-        neighbors.reverse()
-    return [n.id for n in neighbors]
-    
+    if weight == None:
+      weight = tuple([normalvariate(20, 5) for i in range(5)])
+    ids, dists = self.scan(weight, k = 200, candidates = points)
+    ids.reverse()
+    return ids
+
   @property
   def pixel_map(self):
     if not hasattr(self, '_pixel_map'):
@@ -335,29 +522,44 @@ class Tile(BaseImage):
         pixel_map.append(tuple(pixels))
       self._pixel_map = tuple(pixel_map)
     return self._pixel_map
+
+  @property
+  def pixel_map_url(self):
+    """
+    URL of the ``pixel_map`` as a PNG, rendered the first time it is needed.
+    """
+    if not hasattr(self, '_pixel_map_url'):
+      self._pixel_map_url = pixelmap.url(self)
+    return self._pixel_map_url
+
+  @classmethod
+  def render_pixel_maps(cls, tiles = None, batch_size = 500):
+    """
+    Render the pixel map of every tile in ``tiles`` (all tiles by default)
+    that doesn't have one yet.
+    """
+    if tiles == None:
+      tiles = cls.objects.all()
+    tiles = list(tiles)
+    for i in range(0, len(tiles), batch_size):
+      batch = tiles[i:i+batch_size]
+      cls.load_features(batch)
+      for tile in batch:
+        tile.pixel_map_url
     
 
+  def extract_features(self):
+    self.image.open('rb')
+    im = Image.open(self.image.file)
+    im.load()
+    self.image.close()
+    self._rgb_list, self._mono_list, self._str_list = features.extract(im, self.CHUNK_SIZE)
+
   @property
   def rgb_list(self):
     assert self.size % self.CHUNK_SIZE == 0
     if not hasattr(self, '_rgb_list'):
-      self.image.open('rb')
-      im = Image.open(self.image.file)
-      im.load()
-      self.image.close()
-
-      if im.mode in ('P', 'RGBA'):
-        im = im.convert('RGB')
-
-      self._rgb_list = []
-      if im.mode == 'L':
-        for val in self.mono_list:
-          self._rgb_list += [val]*3
-      else:
-        for y in range(0, self.image.height, self.CHUNK_SIZE):
-          for x in range(0, self.image.width, self.CHUNK_SIZE):
-            self._rgb_list += ImageStat.Stat(im.crop((x, y, x+10, y+10))).mean
-      self._rgb_list = tuple(self._rgb_list)
+      self.extract_features()
     assert len(self._rgb_list) == (self.size/self.CHUNK_SIZE)**2*3
     return self._rgb_list
 
@@ -369,27 +571,46 @@ class Tile(BaseImage):
   def mono_list(self):
     assert self.size % self.CHUNK_SIZE == 0
     if not hasattr(self, '_mono_list'):
-      self.image.open('rb')
-      im = Image.open(self.image.file)
-      im.load()
-      self.image.close()
-
-      im = im.convert('L')
-      self._mono_list = []
-      for y in range(0, self.image.height, self.CHUNK_SIZE):
-        for x in range(0, self.image.width, self.CHUNK_SIZE):
-          self._mono_list += ImageStat.Stat(im.crop((x, y, x+10, y+10))).mean
-      self._mono_list = tuple(self._mono_list)
+      self.extract_features()
     assert len(self._mono_list) == (self.size/self.CHUNK_SIZE)**2
     return self._mono_list
 
   @property
   def str_list(self):
     if not hasattr(self, '_str_list'):
-      self._str_list = ''.join([chr(int(round(x))) for x in self.rgb_list])
+      self._str_list = features.str_from_rgb(self.rgb_list)
     return self._str_list
 
-class CompareMethod(TimeStampable):
+class TileFeatures(models.Model):
+  """
+  Derived features of a tile image, keyed by the image hash so they are only
+  computed again when the image changes.  Both lists are stored packed, so
+  loading every tile's doesn't unpickle a tuple per tile.  ``str_list`` is
+  cheap to rebuild from ``rgb_list`` and isn't stored.
+  """
+  hash = models.CharField(max_length = 64, unique = True)
+  rgb_list = PackedFloatArrayField()
+  mono_list = PackedFloatArrayField()
+
+  def apply(self, tile):
+    tile._rgb_list = tuple(self.rgb_list)
+    tile._mono_list = tuple(self.mono_list)
+
+  @classmethod
+  def import_directory(cls, directory, chunk_size = Tile.CHUNK_SIZE):
+    """
+    Extract and store the features of every tile image under ``directory``
+    that doesn't have them stored yet.
+    """
+    known = set(cls.objects.values_list('hash', flat = True))
+    with transaction.commit_on_success():
+      for file_path, im_hash, (rgb_list, mono_list, str_list) in features.extract_directory(directory, chunk_size):
+        if im_hash in known:
+          continue
+        cls.objects.create(hash = im_hash, rgb_list = rgb_list, mono_list = mono_list)
+        known.add(im_hash)
+
+class CompareMethod(TimeStampable, Heritable):
   mother = models.ForeignKey('self', related_name = 'mother_of', null = True)
   father = models.ForeignKey('self', related_name = 'father_of', null = True)
 
@@ -419,15 +640,25 @@ class CompareMethod(TimeStampable):
   def weight(self):
     return self.lw, self.nw, self.rw, self.gw, self.bw
 
-  def generate_tests(self, other, count = 20, next_group = None):
+  @models.permalink
+  def get_absolute_url(self):
+    return ('mosy.mosaic.views.method_lineage', [self.id])
+
+  def generate_tests(self, other, count = 20, next_group = None, targets = None):
+    """
+    Create tests between this method and ``other`` on ``targets``, or on
+    ``count`` random tiles.
+    """
     tests = []
-    for i in range(count):
-      tile = Tile.objects.order_by('?')[:1].get()
+    if targets == None:
+      targets = [Tile.POINTS[pk] for pk in sample(Tile.POINTS.keys(), count)]
+    for tile in targets:
       methods = [self, other]
       shuffle(methods)
       method_a, method_b = methods
-      tile_a = tile.get_nn(weight = method_a.weight)
-      tile_b = tile.get_nn(weight = method_b.weight)
+      id_a, id_b = Tile.pair_components(tile).nearest([method_a.weight, method_b.weight])
+      tile_a = Tile.POINTS[id_a]
+      tile_b = Tile.POINTS[id_b]
 
       if tile_a == tile_b:
         x, created = CompareTest.objects.get_or_create(
@@ -454,27 +685,62 @@ class CompareMethod(TimeStampable):
         tests.append(x)
     return tests
 
+  @classmethod
+  def generate_round(cls, parents, next_group, count = 20):
+    """
+    Tests between every pair of ``parents``, each pair on its own ``count``
+    random tiles.  They are drawn from a pool no larger than the component
+    cache, so each tile's components are computed once for the round.
+    """
+    pairs = list(combinations(parents, 2))
+    pool = sample(Tile.POINTS.keys(), min(count * len(pairs), Tile.COMPONENT_CACHE_SIZE, len(Tile.POINTS)))
+    tests = []
+    with transaction.commit_on_success():
+      for hash_a, hash_b in pairs:
+        targets = [Tile.POINTS[pk] for pk in sample(pool, min(count, len(pool)))]
+        tests += hash_a.generate_tests(hash_b, next_group = next_group, targets = targets)
+    pending_tests.invalidate()
+    return tests
+
   @classmethod
   def evolve(cls):
-    sample_group = CompareTest.current_group()
-    if cls.objects.count() < 15 and CompareTest.objects.filter(winner = None).count() == 0:
-      cls.generate(15 - cls.objects.count())
-      parents = cls.objects.all()
-      for hash_a, hash_b in combinations(parents, 2):
-        hash_a.generate_tests(hash_b, next_group = sample_group + 1)
-    elif not CompareTest.objects.filter(winner = None).count():
+    """
+    Start the next round of compare tests once every test of the current one
+    has been voted on.  The phases of each round started are written to the
+    ``compare`` metrics file.
+    """
+    compare_metrics.reset()
+    with compare_metrics.timer('db_read'):
+      sample_group = CompareTest.current_group()
+      methods = cls.objects.count()
+      pending = CompareTest.objects.filter(winner = None).count()
+    if pending:
+      return
+    if methods < 15:
+      with compare_metrics.timer('breed'):
+        cls.generate(15 - methods)
+      with compare_metrics.timer('db_read'):
+        parents = list(cls.objects.all())
+    else:
       cursor = connection.cursor()
       winners = []
-      for group in range(sample_group, 0, -1):
-        cursor.execute('SELECT DISTINCT sample_group, winner_id, count(winner_id) AS win_count FROM mosaic_comparetest WHERE sample_group=%s GROUP BY winner_id ORDER BY win_count DESC LIMIT 0,15', [sample_group, ])
-        winners += [winner[0] for winner in cursor.fetchall()]
-        if len(winners) > 15:
-          break
-      winners = winners[:15]
-      parents = list(CompareMethod.objects.filter(pk__in = winners))
-      parents += list(CompareMethod.generate(10))
-      for hash_a, hash_b in combinations(parents, 2):
-        hash_a.generate_tests(hash_b, next_group = sample_group + 1)
+      with compare_metrics.timer('db_read'):
+        for group in range(sample_group, 0, -1):
+          cursor.execute('SELECT winner_id, count(winner_id) AS win_count FROM mosaic_comparetest WHERE sample_group=%s AND winner_id IS NOT NULL GROUP BY winner_id ORDER BY win_count DESC LIMIT 0,15', [group, ])
+          for winner_id, win_count in cursor.fetchall():
+            if winner_id not in winners:
+              winners.append(winner_id)
+            compare_metrics.observe('wins', win_count)
+          if len(winners) > 15:
+            break
+        winners = winners[:15]
+        parents = list(CompareMethod.objects.filter(pk__in = winners))
+      with compare_metrics.timer('breed'):
+        parents += list(CompareMethod.generate(10))
+    with compare_metrics.timer('generate_tests'):
+      tests = cls.generate_round(parents, sample_group + 1)
+    compare_metrics.count('tests', len(tests))
+    compare_metrics.generation(sample_group = sample_group + 1, parents = len(parents))
 
 
   @classmethod
@@ -501,6 +767,7 @@ class CompareMethod(TimeStampable):
       if created:
         x.father = method_a
         x.mother = method_b
+        x.inherit(method_a, method_b)
         x.save()
       else:
         print "Duplicate Offspring - Father(%i) : Mother(%i)"%(method_a.id, method_b.id)
@@ -508,7 +775,7 @@ class CompareMethod(TimeStampable):
 
   @property
   def score(self):
-    if not hashattr(self, '_score'):
+    if not hasattr(self, '_score'):
       self._score = CompareTest.objects.filter(winner = self).count()
     return self._score
 
@@ -521,9 +788,13 @@ class CompareTest(TimeStampable):
   winner = models.ForeignKey(CompareMethod, related_name = '+', null = True)
   method_a = models.ForeignKey(CompareMethod, related_name = '+')
   method_b = models.ForeignKey(CompareMethod, related_name = '+')
+  #When a voter was last handed the test
+  claimed_at = models.DateTimeField(null = True, db_index = True)
 
   @classmethod
   def current_group(cls):
     if not cls.objects.count():
       return 0
     return cls.objects.latest('created_at').sample_group
+
+pending_tests = PendingTests(CompareTest, Tile)
@@ -0,0 +1,84 @@
+"""Hands out pending compare tests to voters.
+
+A test is claimed by stamping ``claimed_at`` with an update that only
+matches while the test is still pending and unclaimed, so two voters never
+get the same test unless the first one's claim has expired.  The next test
+is picked at random from a small window of the oldest candidates, which the
+``id`` index serves without sorting the whole table, and the number of
+pending tests is kept in the cache and adjusted as votes come in rather than
+counted on every page.  The cache is one every web process shares, so they
+all show the same count; adjusting it isn't atomic there, so it is recounted
+every so often to undo any drift.
+"""
+
+from datetime import datetime, timedelta
+from random import choice
+
+from django.core.cache import get_cache
+from django.db.models import Q
+
+class PendingTests(object):
+
+  def __init__(self, model, tile_model, timeout = 300, window = 20, cache = 'compare', key = 'pending_compare_tests', count_timeout = 60):
+    """
+    Claims expire after ``timeout`` seconds.  The count is kept in the
+    ``cache`` cache and recounted at least every ``count_timeout`` seconds.
+    """
+    self.model = model
+    self.tile_model = tile_model
+    self.timeout = timeout
+    self.window = window
+    self.cache_name = cache
+    self.key = key
+    self.count_timeout = count_timeout
+
+  @property
+  def cache(self):
+    if not hasattr(self, '_cache'):
+      self._cache = get_cache(self.cache_name)
+    return self._cache
+
+  def available(self):
+    cutoff = datetime.now() - timedelta(seconds = self.timeout)
+    return self.model.objects.filter(winner = None).filter(Q(claimed_at = None) | Q(claimed_at__lt = cutoff))
+
+  def claim(self, attempts = 5):
+    """
+    Claim a pending test for one voter and return it with its tiles and
+    their features loaded, or None if there are none left.
+    """
+    for i in range(attempts):
+      candidates = list(self.available().order_by('id').values_list('id', flat = True)[:self.window])
+      if not candidates:
+        return None
+      pk = choice(candidates)
+      if self.available().filter(pk = pk).update(claimed_at = datetime.now()):
+        return self.prefetch(self.model.objects.select_related('target', 'tile_a', 'tile_b').get(pk = pk))
+    return None
+
+  def prefetch(self, test):
+    self.tile_model.load_features([test.target, test.tile_a, test.tile_b])
+    return test
+
+  def release(self, test):
+    self.model.objects.filter(pk = test.pk).update(claimed_at = None)
+
+  def remaining(self):
+    count = self.cache.get(self.key)
+    if count == None:
+      count = self.model.objects.filter(winner = None).count()
+      self.cache.set(self.key, count, self.count_timeout)
+    return count
+
+  def resolved(self):
+    """
+    One pending test was voted on or deleted.
+    """
+    try:
+      if self.cache.decr(self.key) < 0:
+        self.cache.delete(self.key)
+    except ValueError:
+      pass
+
+  def invalidate(self):
+    self.cache.delete(self.key)
@@ -0,0 +1,51 @@
+"""Pixel maps rendered as PNG images.
+
+A pixel map shows the mean colour of each chunk of a tile as a flat square.
+Rendered once as a PNG, with each chunk ``scale`` pixels wide, it compresses
+to a few hundred bytes and can be served as a static file instead of building
+a grid of styled cells on every request.  Files are named after the tile
+image hash, so a tile's map never changes once it is written.  Tiles without
+a hash have their maps named after their id instead.
+"""
+
+import os.path
+
+from cStringIO import StringIO
+
+import numpy
+
+from PIL import Image
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+BASE_PATH = 'pixelmap'
+SCALE = 20
+
+def render(rgb_list, scale = SCALE):
+  """
+  PNG bytes of the square chunk grid described by ``rgb_list``.  Colours are
+  truncated to whole numbers, as in ``Tile.pixel_map``.
+  """
+  chunks = numpy.asarray(rgb_list, dtype = numpy.float64).astype(numpy.uint8)
+  size = int(round((len(chunks) / 3) ** 0.5))
+  assert size * size * 3 == len(chunks)
+  grid = chunks.reshape(size, size, 3).repeat(scale, axis = 0).repeat(scale, axis = 1)
+  buf = StringIO()
+  Image.fromarray(grid, 'RGB').save(buf, 'PNG', optimize = True)
+  return buf.getvalue()
+
+def key(tile):
+  return tile.hash or 'id%i'%tile.id
+
+def path(key, scale = SCALE):
+  return os.path.join(BASE_PATH, key[:2], '%s_%i.png'%(key, scale))
+
+def url(tile, scale = SCALE, storage = default_storage):
+  """
+  URL of the pixel map of ``tile``, rendering it first if it hasn't been.
+  """
+  name = path(key(tile), scale)
+  if not storage.exists(name):
+    name = storage.save(name, ContentFile(render(tile.rgb_list, scale)))
+  return storage.url(name)
@@ -0,0 +1,307 @@
+"""Memory-mapped snapshot of the tile corpus.
+
+Everything the distance code reads about a tile (id, origin, size, image
+hash and name, ``rgb_list`` and ``str_list``) is written to one binary file
+together with the calibration constants, and mapped read-only when loaded.
+Nothing is parsed per tile, so loading takes the same few milliseconds
+however many tiles there are; pages are read in as rows are touched, and
+processes forked after loading share them.
+
+The file starts with ``MAGIC``, the format version and the length of a JSON
+header describing each array, followed by the arrays themselves, each
+aligned to ``ALIGN`` bytes.  ``str_list`` holds one character per
+``rgb_list`` value, so strings are stored as a byte matrix the same shape as
+the feature matrix, and the character counts the edit distance bound reads
+are stored with them so they don't have to be counted in every process.
+The header also holds a digest of every tile's id and image hash, which the
+tile table is checked against to tell whether the snapshot is out of date.
+
+A ``PointStore`` publishes snapshots to a directory every process on a host
+maps from, so the corpus is held in memory once however many processes use
+it.
+"""
+
+import hashlib
+import json
+import os
+import os.path
+import struct
+
+from collections import Mapping, OrderedDict
+from time import time
+
+import numpy
+
+from mosy.mosaic.calibration import fingerprint
+from mosy.mosaic.distance import DistanceEngine
+
+MAGIC = 'MOSYSNAP'
+VERSION = 2
+PREAMBLE = struct.Struct('<8sII')
+ALIGN = 64
+
+def digest(ids, hashes):
+  """
+  Identifies a set of tiles and their images from their ids, in order, and
+  image hashes.
+  """
+  sha = hashlib.sha1(numpy.asarray(ids, dtype = '<i8').tostring())
+  sha.update(numpy.asarray(hashes, dtype = 'S64').tostring())
+  return sha.hexdigest()
+
+class StringRows(object):
+  """
+  The rows of a byte matrix as strings, read on demand.
+  """
+
+  def __init__(self, matrix):
+    self.matrix = matrix
+
+  def __len__(self):
+    return len(self.matrix)
+
+  def __getitem__(self, row):
+    return self.matrix[row].tostring()
+
+  def __iter__(self):
+    for row in range(len(self.matrix)):
+      yield self[row]
+
+class Points(Mapping):
+  """
+  ``{id: tile}`` over a snapshot.  Tiles are made when they are looked up,
+  with their features already attached, and the ``cache_size`` most recently
+  used are kept.
+  """
+
+  def __init__(self, snapshot, model, cache_size = 1000):
+    self.snapshot = snapshot
+    self.model = model
+    self.cache_size = cache_size
+    self.tiles = OrderedDict()
+
+  def __len__(self):
+    return len(self.snapshot)
+
+  def __iter__(self):
+    return (int(pk) for pk in self.snapshot.ids)
+
+  def __contains__(self, pk):
+    return self.snapshot.row_of(pk) != None
+
+  def __getitem__(self, pk):
+    tile = self.tiles.pop(pk, None)
+    if tile == None:
+      row = self.snapshot.row_of(pk)
+      if row == None:
+        raise KeyError(pk)
+      tile = self.snapshot.tile(self.model, row)
+      while len(self.tiles) >= self.cache_size:
+        self.tiles.popitem(last = False)
+    self.tiles[pk] = tile
+    return tile
+
+  def keys(self):
+    return self.snapshot.ids.tolist()
+
+class Snapshot(object):
+
+  def __init__(self, arrays, radius = None, tolerance = None, fingerprint = None, contents = None):
+    """
+    ``arrays`` maps each of ``ids``, ``origins``, ``sizes``, ``hashes``,
+    ``images``, ``matrix``, ``strings`` and ``histograms`` to an array with
+    one row per tile.
+    """
+    self.arrays = arrays
+    self.radius = radius
+    self.tolerance = tolerance
+    self.fingerprint = fingerprint
+    self.contents = contents
+    for name, array in arrays.items():
+      setattr(self, name, array)
+    self.engine = DistanceEngine(self.ids, self.sizes, self.matrix, StringRows(self.strings), self.histograms)
+
+  def __len__(self):
+    return len(self.ids)
+
+  def row_of(self, pk):
+    """
+    Row of tile ``pk``, found by bisecting the sorted ids rather than through
+    the engine's row index, which takes a pass over every id to build.
+    """
+    row = int(numpy.searchsorted(self.ids, int(pk)))
+    if row < len(self.ids) and self.ids[row] == int(pk):
+      return row
+    return None
+
+  @classmethod
+  def from_points(cls, points, radius = None, tolerance = None):
+    ids = sorted(points.keys())
+    tiles = [points[pk] for pk in ids]
+    matrix = numpy.array([t.rgb_list for t in tiles], dtype = numpy.float64)
+    strings = numpy.fromstring(''.join(t.str_list for t in tiles), dtype = numpy.uint8).reshape(matrix.shape)
+    arrays = {
+      'ids': numpy.array(ids, dtype = numpy.int64),
+      'origins': numpy.array([t.origin_id or 0 for t in tiles], dtype = numpy.int64),
+      'sizes': numpy.array([t.size for t in tiles], dtype = numpy.int64),
+      'hashes': numpy.array([t.hash or '' for t in tiles], dtype = 'S64'),
+      'images': numpy.array([t.image.name or '' for t in tiles], dtype = numpy.string_),
+      'matrix': matrix,
+      'strings': strings,
+      'histograms': None,
+      }
+    snapshot = cls(arrays, radius, tolerance)
+    snapshot.fingerprint = fingerprint(snapshot.engine)
+    snapshot.contents = digest(snapshot.ids, snapshot.hashes)
+    snapshot.arrays['histograms'] = snapshot.histograms = snapshot.engine.histograms
+    return snapshot
+
+  def tile(self, model, row):
+    tile = model(
+      id = int(self.ids[row]),
+      origin_id = int(self.origins[row]) or None,
+      size = int(self.sizes[row]),
+      hash = str(self.hashes[row]) or None,
+      image = str(self.images[row]),
+      )
+    tile._rgb_list = tuple(self.matrix[row].tolist())
+    tile._str_list = self.strings[row].tostring()
+    return tile
+
+  def points(self, model):
+    return Points(self, model)
+
+  def save(self, path):
+    header = {
+      'count': len(self),
+      'radius': self.radius,
+      'tolerance': self.tolerance,
+      'fingerprint': self.fingerprint,
+      'contents': self.contents,
+      'arrays': {},
+      }
+    layout = []
+    offset = 0
+    for name in sorted(self.arrays):
+      array = numpy.ascontiguousarray(self.arrays[name])
+      array = array.astype(array.dtype.newbyteorder('<'))
+      header['arrays'][name] = {'offset': offset, 'dtype': array.dtype.str, 'shape': array.shape}
+      layout.append((offset, array))
+      offset += -(-array.nbytes // ALIGN) * ALIGN
+    end = offset
+    header = json.dumps(header)
+    #Arrays start at the first aligned offset after the header
+    start = -(-(PREAMBLE.size + len(header)) // ALIGN) * ALIGN
+
+    tmp_path = path + '.tmp'
+    f = open(tmp_path, 'wb')
+    try:
+      f.write(PREAMBLE.pack(MAGIC, VERSION, len(header)))
+      f.write(header)
+      for offset, array in layout:
+        f.seek(start + offset)
+        f.write(array.tostring())
+      f.truncate(start + end)
+    finally:
+      f.close()
+    os.rename(tmp_path, path)
+
+  @classmethod
+  def load(cls, path):
+    """
+    Map the snapshot at ``path``, or return None if there isn't one or it was
+    written by a different version of this module.
+    """
+    if not os.path.exists(path):
+      return None
+    f = open(path, 'rb')
+    try:
+      magic, version, length = PREAMBLE.unpack(f.read(PREAMBLE.size))
+      if magic != MAGIC:
+        raise ValueError('%s is not a tile snapshot'%path)
+      if version != VERSION:
+        return None
+      header = json.loads(f.read(length))
+    finally:
+      f.close()
+    start = -(-(PREAMBLE.size + length) // ALIGN) * ALIGN
+    data = numpy.memmap(path, dtype = numpy.uint8, mode = 'r')
+    arrays = {}
+    for name, info in header['arrays'].items():
+      dtype = numpy.dtype(str(info['dtype']))
+      shape = tuple(info['shape'])
+      offset = start + info['offset']
+      size = dtype.itemsize * int(numpy.prod(shape))
+      arrays[str(name)] = data[offset:offset+size].view(dtype).reshape(shape)
+    return cls(arrays, header['radius'], header['tolerance'], header['fingerprint'], header.get('contents'))
+
+class PointStore(object):
+  """
+  Snapshots published to ``directory``, which every process on the host
+  maps from.
+
+  ``<name>.snapshot`` is a symlink to the current snapshot file.  A new
+  snapshot is written to a file of its own and the link replaced with a
+  rename, so a process attaching sees either the old snapshot or the new
+  one, never a partial file.  Processes already attached keep the snapshot
+  they mapped until they next call ``current()``; old files are unlinked once
+  ``keep`` newer ones are published, which doesn't disturb a process still
+  mapping one.
+  """
+
+  def __init__(self, directory, name = 'tiles', keep = 2, check_interval = 5.0):
+    self.directory = directory
+    self.name = name
+    self.keep = keep
+    self.check_interval = check_interval
+    self.target = None
+    self.snapshot = None
+    self.checked = 0
+
+  @property
+  def link(self):
+    return os.path.join(self.directory, '%s.snapshot'%self.name)
+
+  def publish(self, snapshot):
+    """
+    Write ``snapshot`` and make it the current one.  Returns it as mapped
+    from the store.
+    """
+    file_name = '%s-%i-%i.snapshot'%(self.name, int(time()*1000000), os.getpid())
+    snapshot.save(os.path.join(self.directory, file_name))
+    tmp_link = '%s.%i.tmp'%(self.link, os.getpid())
+    os.symlink(file_name, tmp_link)
+    os.rename(tmp_link, self.link)
+    self.prune(file_name)
+    return self.current(force = True)
+
+  def prune(self, current):
+    prefix = self.name + '-'
+    published = [f for f in os.listdir(self.directory) if f.startswith(prefix) and f.endswith('.snapshot')]
+    published.sort(key = lambda f: int(f[len(prefix):].split('-')[0]))
+    for file_name in published[:-self.keep]:
+      if file_name != current:
+        os.remove(os.path.join(self.directory, file_name))
+
+  def current(self, force = False):
+    """
+    The current snapshot, mapped again only if a new one was published.  The
+    link is looked at no more than once every ``check_interval`` seconds
+    unless ``force`` is set.  None if nothing has been published.
+    """
+    if not force and self.snapshot != None and time() - self.checked < self.check_interval:
+      return self.snapshot
+    self.checked = time()
+    for attempt in range(2):
+      if not os.path.islink(self.link):
+        break
+      target = os.readlink(self.link)
+      if target == self.target:
+        break
+      path = os.path.join(self.directory, target)
+      if not os.path.exists(path):
+        #Pruned since the link was read, so a newer one is up
+        continue
+      self.target, self.snapshot = target, Snapshot.load(path)
+      break
+    return self.snapshot
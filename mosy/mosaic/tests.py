@@ -5,8 +5,43 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import hashlib
+import json
+import os.path
+import shutil
+import tempfile
+
+from datetime import datetime, timedelta
+
+from cStringIO import StringIO
+from math import sqrt
+from multiprocessing import Pool
+from random import Random
+
+import Levenshtein
+import numpy
+
+from PIL import Image, ImageStat
+
+from django.conf import settings
 from django.test import TestCase
 
+from mosy import benchmark
+from mosy.mosaic import features
+from mosy.mosaic import editdistance
+from mosy.mosaic import export
+from mosy.mosaic import ingest
+from mosy.mosaic import pixelmap
+from mosy.mosaic import snapshot
+from mosy.mosaic.calibration import Calibration, fingerprint
+from mosy.mosaic.distance import DistanceEngine, DISTANCE_WEIGHTS
+from mosy.mosaic.editdistance import histogram
+from mosy.mosaic.graph import KNNGraph
+from mosy.mosaic.pending import PendingTests
+from mosy.mosaic.snapshot import PointStore, Snapshot
+from mosy.mosaic.models import CompareMethod, CompareTest, StockImage, Tile, TileFeatures, pending_tests
+from mosy.pof.packed import PackedFloatArray
+
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,3 +49,767 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+def synthetic_tile(pk, rand, size = 100):
+    """
+    A Tile with its features filled in directly, so nothing is read from disk.
+    """
+    tile = Tile(id = pk, size = size)
+    count = (size / Tile.CHUNK_SIZE)**2
+    tile._mono_list = tuple(rand.uniform(0, 255) for i in range(count))
+    tile._rgb_list = tuple(rand.uniform(0, 255) for i in range(count*3))
+    tile._str_list = ''.join([chr(int(round(x))) for x in tile._rgb_list])
+    return tile
+
+
+class SyntheticPointsTestCase(TestCase):
+    point_count = 40
+
+    def setUp(self):
+        rand = Random(1)
+        self.points = dict((pk, synthetic_tile(pk, rand)) for pk in range(1, self.point_count + 1))
+        Tile._POINTS = self.points
+        Tile._GRAPH = None
+
+    def tearDown(self):
+        for key in ('_POINTS', '_ENGINE', '_GRAPH', '_COMPONENTS', '_RADIUS', '_TOLERANCE', '_SNAPSHOT', '_STORE'):
+            if key in Tile.__dict__:
+                delattr(Tile, key)
+
+
+class DistanceEngineTest(SyntheticPointsTestCase):
+    def brute_force(self, tile, measure):
+        others = [p for pk, p in sorted(self.points.items()) if pk != tile.id]
+        return sorted(others, key = lambda p: measure(tile, p))
+
+    def test_distance_matches_scalar(self):
+        tile = self.points[1]
+        rows, d = Tile.ENGINE.distance(tile)
+        for row, value in zip(rows, d):
+            other = self.points[int(Tile.ENGINE.ids[row])]
+            self.assertAlmostEqual(value, Tile.distance(tile, other), places = 9)
+
+    def test_compare_matches_scalar(self):
+        weight = (21.0, 18.5, 19.0, 23.0, 17.5)
+        tile = self.points[2]
+        rows, d = Tile.ENGINE.compare(tile, weight, candidates = [5, 9, 13])
+        for row, value in zip(rows, d):
+            other = self.points[int(Tile.ENGINE.ids[row])]
+            self.assertAlmostEqual(value, Tile.compare(tile, other, weight), places = 9)
+
+    def test_knn_matches_brute_force(self):
+        tile = self.points[3]
+        expected = self.brute_force(tile, Tile.distance)
+        self.assertEqual(tile.nn.id, expected[0].id)
+        knn = tile.knn
+        knn.reverse()
+        self.assertEqual(knn, [p.id for p in expected])
+
+    def test_get_nn_matches_brute_force(self):
+        weight = (15.0, 25.0, 20.0, 20.0, 20.0)
+        tile = self.points[4]
+        expected = self.brute_force(tile, lambda a, b: Tile.compare(a, b, weight))
+        self.assertEqual(tile.get_nn(weight).id, expected[0].id)
+        self.assertEqual(tile.get_knn(weight)[-1], expected[0].id)
+
+
+class CascadeTest(SyntheticPointsTestCase):
+    point_count = 120
+
+    def setUp(self):
+        super(CascadeTest, self).setUp()
+        #Near copies of one tile, so the bound has something to prune
+        rand = Random(7)
+        base = self.points[1]
+        for pk in range(2, 30):
+            tile = self.points[pk]
+            tile._rgb_list = tuple(min(255.0, x + rand.uniform(0, 6)) for x in base._rgb_list)
+            tile._str_list = features.str_from_rgb(tile._rgb_list)
+
+    def assertCascadeExact(self, tile, weights, k):
+        engine = Tile.ENGINE
+        rows, d = engine.compare(tile, weights[0]) if len(weights) == 1 else engine.distance(tile)
+        expected_ids, expected_d = engine.nearest(rows, d, k)
+        ids, d = engine.knn(tile, k, weights, chunk_size = 4)
+        self.assertEqual(list(ids), list(expected_ids))
+        self.assertEqual(list(d), list(expected_d))
+
+    def test_distance(self):
+        for k in (1, 5, 40, 200):
+            self.assertCascadeExact(self.points[1], DISTANCE_WEIGHTS, k)
+            self.assertCascadeExact(self.points[50], DISTANCE_WEIGHTS, k)
+
+    def test_compare(self):
+        weight = (22.0, 17.0, 19.0, 25.0, 16.0)
+        for k in (1, 10):
+            self.assertCascadeExact(self.points[3], (weight,), k)
+
+    def test_lower_bound(self):
+        tile = self.points[1]
+        rows = Tile.ENGINE.select()
+        edits = editdistance.count_bound(Tile.ENGINE.histograms[rows], histogram(tile.str_list))
+        lv, err = Tile.ENGINE.components(tile, rows)
+        self.assertTrue((edits <= lv).all())
+
+
+class BoundedEditDistanceTest(TestCase):
+    def strings(self, count, length = 40, alphabet = 'abcd'):
+        rand = Random(8)
+        base = ''.join(rand.choice(alphabet) for i in range(length))
+        strings = []
+        for i in range(count):
+            s = list(base)
+            for edit in range(rand.randint(0, length / 2)):
+                s[rand.randrange(length)] = rand.choice(alphabet)
+            if i % 3 == 0:
+                s = s[1:] + [rand.choice(alphabet)]
+            strings.append(''.join(s))
+        return base, strings
+
+    def test_bounded_matches_levenshtein(self):
+        base, strings = self.strings(60)
+        for max_distance in (0, 1, 3, 8, 20, 60):
+            for s in strings:
+                expected = min(Levenshtein.distance(base, s), max_distance + 1)
+                self.assertEqual(editdistance.bounded(base, s, max_distance), expected)
+
+    def test_banded_matches_levenshtein(self):
+        base, strings = self.strings(60, length = 120)
+        for max_distance in (0, 2, 5, 14):
+            expected = [min(Levenshtein.distance(base, s), max_distance + 1) for s in strings]
+            self.assertEqual(list(editdistance.banded(base, strings, max_distance)), expected)
+
+    def test_bounded_many(self):
+        base, strings = self.strings(60, length = 120)
+        strings.append('short')
+        for max_distance in (3, 10, 40, 200):
+            expected = [min(Levenshtein.distance(base, s), max_distance + 1) for s in strings]
+            self.assertEqual(list(editdistance.bounded_many(base, strings, max_distance)), expected)
+
+    def test_negative_limit_is_always_exceeded(self):
+        #max_distance + 1, which is still over the limit when it is 0
+        self.assertEqual(editdistance.bounded('abc', 'abc', -1), 0)
+        self.assertEqual(editdistance.bounded('abc', 'abd', -3), -2)
+        self.assertEqual(list(editdistance.bounded_many('abc', ['abc', 'abd'], -1)), [0, 0])
+
+
+class PairComponentsTest(SyntheticPointsTestCase):
+    def test_nearest_matches_get_nn(self):
+        rand = Random(10)
+        weights = [tuple(rand.normalvariate(20, 5) for i in range(5)) for j in range(12)]
+        tile = self.points[6]
+        nearest = Tile.pair_components(tile).nearest(weights)
+        self.assertEqual(nearest, [tile.get_nn(weight).id for weight in weights])
+
+    def test_compare_matches_engine(self):
+        weights = [(21.0, 18.5, 19.0, 23.0, 17.5), (15.0, 25.0, 20.0, 20.0, 20.0)]
+        tile = self.points[8]
+        components = Tile.pair_components(tile)
+        d = components.compare(weights)
+        for i, weight in enumerate(weights):
+            rows, expected = Tile.ENGINE.compare(tile, weight, exclude = tile.id)
+            self.assertEqual(list(d[:, i]), list(expected))
+
+    def test_cache_is_reused(self):
+        tile = self.points[9]
+        self.assertTrue(Tile.pair_components(tile) is Tile.pair_components(tile))
+
+
+class KNNGraphTest(SyntheticPointsTestCase):
+    k = 5
+
+    def engine(self, exclude = ()):
+        points = dict((pk, p) for pk, p in self.points.items() if pk not in exclude)
+        return DistanceEngine.from_points(points)
+
+    def assertGraphsEqual(self, graph, expected):
+        self.assertEqual(sorted(graph.ids), sorted(expected.ids))
+        for pk in expected.ids:
+            self.assertEqual(graph.neighbors_of(pk), expected.neighbors_of(pk))
+
+    def test_build_matches_scan(self):
+        graph = KNNGraph.build(Tile.ENGINE, self.k)
+        for pk, tile in self.points.items():
+            ids, distances = graph.neighbors_of(pk)
+            expected_ids, expected_distances = tile.scan(k = self.k)
+            self.assertEqual(ids, expected_ids)
+            for a, b in zip(distances, expected_distances):
+                self.assertAlmostEqual(a, b, places = 12)
+
+    def test_graph_answers_knn(self):
+        Tile._GRAPH = KNNGraph.build(Tile.ENGINE, 200)
+        tile = self.points[7]
+        self.assertEqual(tile.knn, list(reversed(tile.scan(k = 200)[0])))
+        self.assertEqual(tile.nn.id, tile.scan()[0][0])
+
+    def test_sync_matches_rebuild(self):
+        graph = KNNGraph.build(self.engine(exclude = (3, 11, 12)), self.k)
+        engine = self.engine(exclude = (5, 20))
+        self.assertEqual(graph.sync(engine), (3, 2))
+        self.assertGraphsEqual(graph, KNNGraph.build(engine, self.k))
+
+    def test_small_corpus_pads_neighbors(self):
+        engine = self.engine(exclude = range(4, self.point_count + 1))
+        graph = KNNGraph.build(engine, self.k)
+        self.assertEqual(len(graph.neighbors_of(1)[0]), 2)
+
+
+class CalibrationTest(SyntheticPointsTestCase):
+    def setUp(self):
+        super(CalibrationTest, self).setUp()
+        self.data_root = settings.DATA_ROOT
+        settings.DATA_ROOT = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(settings.DATA_ROOT)
+        settings.DATA_ROOT = self.data_root
+        super(CalibrationTest, self).tearDown()
+
+    def engine(self, exclude = ()):
+        points = dict((pk, p) for pk, p in self.points.items() if pk not in exclude)
+        return DistanceEngine.from_points(points)
+
+    def brute_force(self):
+        distances = [Tile.distance(tile, tile.nn) for tile in self.points.values()]
+        mean = sum(distances) / len(distances)
+        std = sqrt(sum((d - mean)**2 for d in distances) / len(distances))
+        return mean + 3*std, (mean + 3*std) / mean
+
+    def exact(self, engine, k = 1):
+        return Calibration.from_graph(KNNGraph.build(engine, k), engine)
+
+    def test_graph_matches_brute_force(self):
+        radius, tolerance = self.brute_force()
+        calibration = self.exact(Tile.ENGINE, k = 3)
+        self.assertAlmostEqual(calibration.radius, radius, places = 12)
+        self.assertAlmostEqual(calibration.tolerance, tolerance, places = 12)
+        self.assertEqual(calibration.nearest, self.exact(Tile.ENGINE).nearest)
+
+    def test_sync_matches_graph(self):
+        calibration = self.exact(self.engine(exclude = (2, 9, 17)))
+        engine = self.engine(exclude = (4, 30))
+        self.assertEqual(calibration.sync(engine), (3, 2))
+        self.assertEqual(calibration.nearest, self.exact(engine).nearest)
+        self.assertTrue(calibration.current(engine))
+
+    def test_estimate_interval(self):
+        calibration = Calibration.estimate(Tile.ENGINE, sample_size = 20, seed = 3)
+        self.assertEqual(len(calibration.distances), 20)
+        low, high = calibration.interval
+        self.assertTrue(low < calibration.radius < high)
+        everything = Calibration.estimate(Tile.ENGINE, sample_size = self.point_count)
+        self.assertAlmostEqual(everything.radius, self.exact(Tile.ENGINE).radius, places = 12)
+
+    def test_save_and_load(self):
+        path = os.path.join(settings.DATA_ROOT, 'calibration.json')
+        for calibration in (self.exact(Tile.ENGINE), Calibration.estimate(Tile.ENGINE, 10)):
+            calibration.save(path)
+            loaded = Calibration.load(path)
+            self.assertEqual(loaded.nearest, calibration.nearest)
+            self.assertEqual(list(loaded.distances), list(calibration.distances))
+            self.assertEqual(loaded.interval, calibration.interval)
+
+    def test_tile_calibration_follows_corpus(self):
+        Tile._POINTS = dict((pk, p) for pk, p in self.points.items() if pk != 5)
+        Tile._GRAPH = KNNGraph.build(Tile.ENGINE, 1)
+        Tile.calibrate()
+        del Tile._ENGINE
+        Tile._POINTS = self.points
+        calibration = Tile.calibrate()
+        self.assertTrue(calibration.exact)
+        self.assertEqual(calibration.nearest, self.exact(Tile.ENGINE).nearest)
+        self.assertEqual(Tile.RADIUS, calibration.radius)
+
+
+class SnapshotTest(SyntheticPointsTestCase):
+    def setUp(self):
+        super(SnapshotTest, self).setUp()
+        self.path = tempfile.mktemp()
+        for pk, tile in self.points.items():
+            tile.hash = '%064x'%pk
+        Snapshot.from_points(self.points, 1.5, 2.5).save(self.path)
+
+    def tearDown(self):
+        os.remove(self.path)
+        super(SnapshotTest, self).tearDown()
+
+    def test_round_trip(self):
+        loaded = Snapshot.load(self.path)
+        self.assertTrue(isinstance(loaded.matrix.base, numpy.memmap))
+        self.assertEqual((loaded.radius, loaded.tolerance), (1.5, 2.5))
+        self.assertEqual(loaded.fingerprint, fingerprint(DistanceEngine.from_points(self.points)))
+        points = loaded.points(Tile)
+        self.assertEqual(sorted(points.keys()), sorted(self.points.keys()))
+        self.assertFalse(0 in points)
+        for pk, tile in self.points.items():
+            self.assertEqual(points[pk].rgb_list, tuple(tile.rgb_list))
+            self.assertEqual(points[pk].str_list, tile.str_list)
+            self.assertEqual((points[pk].size, points[pk].hash), (tile.size, tile.hash))
+
+    def test_engine_matches_points(self):
+        engine = Snapshot.load(self.path).engine
+        expected = DistanceEngine.from_points(self.points)
+        query = self.points[5]
+        self.assertEqual(engine.distance(query)[1].tolist(), expected.distance(query)[1].tolist())
+        ids, distances = engine.knn(query, 5, exclude = 5)
+        expected_ids, expected_distances = expected.knn(query, 5, exclude = 5)
+        self.assertEqual((ids.tolist(), distances.tolist()), (expected_ids.tolist(), expected_distances.tolist()))
+
+    def test_version_and_magic(self):
+        f = open(self.path, 'r+b')
+        f.write(snapshot.PREAMBLE.pack(snapshot.MAGIC, snapshot.VERSION + 1, 0))
+        f.close()
+        self.assertEqual(Snapshot.load(self.path), None)
+        f = open(self.path, 'r+b')
+        f.write('NOTASNAP')
+        f.close()
+        self.assertRaises(ValueError, Snapshot.load, self.path)
+
+    def test_use_snapshot(self):
+        Tile.use_snapshot(Snapshot.load(self.path))
+        self.assertEqual((Tile.RADIUS, Tile.TOLERANCE), (1.5, 2.5))
+        self.assertTrue(Tile.POINTS[7] is Tile.POINTS[7])
+        self.assertEqual(Tile.ENGINE.row_of(7), 6)
+
+    def test_knn_outlives_evicted_tiles(self):
+        Tile.use_snapshot(Snapshot.load(self.path))
+        Tile.POINTS.cache_size = 2
+        tile = Tile.POINTS[1]
+        knn = tile.knn
+        for pk in (2, 3, 4):
+            Tile.POINTS[pk]
+        self.assertFalse(Tile.POINTS[1] is tile)
+        self.assertTrue(Tile.POINTS[1].knn is knn)
+        self.assertEqual(knn, self.points[1].scan(k = 200)[0][::-1])
+
+
+class PointStoreTest(SyntheticPointsTestCase):
+    def setUp(self):
+        super(PointStoreTest, self).setUp()
+        self.point_store_root = getattr(settings, 'POINT_STORE_ROOT', None)
+        settings.POINT_STORE_ROOT = tempfile.mkdtemp()
+        self.store = PointStore(settings.POINT_STORE_ROOT, check_interval = 60)
+
+    def tearDown(self):
+        shutil.rmtree(settings.POINT_STORE_ROOT)
+        settings.POINT_STORE_ROOT = self.point_store_root
+        super(PointStoreTest, self).tearDown()
+
+    def published(self):
+        return sorted(f for f in os.listdir(settings.POINT_STORE_ROOT) if f.startswith('tiles-'))
+
+    def test_publish_swaps_atomically(self):
+        self.assertEqual(self.store.current(), None)
+        first = self.store.publish(Snapshot.from_points(self.points))
+        self.assertTrue(os.path.islink(self.store.link))
+        self.assertTrue(self.store.current() is first)
+
+        #Another process publishes a smaller corpus
+        del self.points[40]
+        other = PointStore(settings.POINT_STORE_ROOT)
+        other.publish(Snapshot.from_points(self.points))
+        self.assertTrue(self.store.current() is first)
+        second = self.store.current(force = True)
+        self.assertEqual((len(first), len(second)), (40, 39))
+
+        other.publish(Snapshot.from_points(self.points))
+        self.assertEqual(len(self.published()), 2)
+        #The pruned snapshot is still readable where it is mapped
+        self.assertEqual(first.points(Tile)[40].str_list, first.strings[-1].tostring())
+
+    def test_histograms_are_stored(self):
+        snapshot = self.store.publish(Snapshot.from_points(self.points))
+        self.assertTrue(isinstance(snapshot.engine.histograms.base, numpy.memmap))
+        expected = DistanceEngine.from_points(self.points).histograms
+        self.assertEqual(snapshot.engine.histograms.tolist(), expected.tolist())
+
+    def test_tile_attach(self):
+        self.assertFalse(Tile.attach())
+        self.store.publish(Snapshot.from_points(self.points, 0.5, 2.0))
+        del Tile._POINTS
+        self.assertTrue(Tile.attach())
+        self.assertEqual((len(Tile.POINTS), Tile.RADIUS, Tile.TOLERANCE), (40, 0.5, 2.0))
+        self.assertEqual(Tile.POINTS[3].rgb_list, tuple(self.points[3].rgb_list))
+
+    def test_requests_pick_up_a_new_snapshot(self):
+        self.store.publish(Snapshot.from_points(self.points, 0.5, 2.0))
+        Tile._STORE = PointStore(settings.POINT_STORE_ROOT, check_interval = 0)
+        Tile.attach()
+        del self.points[40]
+        self.store.publish(Snapshot.from_points(self.points))
+        self.assertEqual(len(Tile.POINTS), 40)
+        self.client.get('/compare/')
+        self.assertEqual(len(Tile.POINTS), 39)
+        #Calibrated over the old tiles, so dropped
+        self.assertFalse('_RADIUS' in Tile.__dict__)
+
+
+class TileInitTest(TestCase):
+    def setUp(self):
+        self.point_store_root = getattr(settings, 'POINT_STORE_ROOT', None)
+        settings.POINT_STORE_ROOT = tempfile.mkdtemp()
+        rand = Random(14)
+        self.tiles = [synthetic_tile(i + 1, rand, size = 30) for i in range(4)]
+        origin = StockImage.objects.create(image = 'stock/0.jpg', hash = '0' * 64)
+        for tile in self.tiles + [synthetic_tile(9, rand, size = 30)]:
+            tile.hash = '%064x'%tile.id
+            tile.origin = origin
+            tile.store_features()
+        for tile in self.tiles:
+            tile.save()
+
+    def tearDown(self):
+        self.reset()
+        shutil.rmtree(settings.POINT_STORE_ROOT)
+        settings.POINT_STORE_ROOT = self.point_store_root
+
+    def reset(self):
+        for key in ('_POINTS', '_ENGINE', '_GRAPH', '_COMPONENTS', '_RADIUS', '_TOLERANCE', '_SNAPSHOT', '_STORE'):
+            if key in Tile.__dict__:
+                delattr(Tile, key)
+
+    def init(self):
+        self.reset()
+        Tile._RADIUS, Tile._TOLERANCE = 0.5, 2.0
+        Tile.init()
+        return Tile._SNAPSHOT
+
+    def test_snapshot_is_rewritten_when_tiles_change(self):
+        first = self.init()
+        self.assertEqual(first.contents, Tile.contents())
+        self.assertEqual(self.init().contents, first.contents)
+        #Same number of tiles, but one was replaced
+        Tile.objects.filter(pk = 4).delete()
+        Tile.objects.create(id = 9, origin_id = self.tiles[0].origin_id, size = 30, hash = '%064x'%9)
+        self.assertEqual(sorted(self.init().ids.tolist()), [1, 2, 3, 9])
+        #Same tiles, one with a new image
+        Tile.objects.filter(pk = 9).update(hash = '%064x'%4)
+        self.assertEqual(Tile.POINTS[9].hash, '%064x'%9)
+        self.assertEqual(self.init().points(Tile)[9].hash, '%064x'%4)
+
+    def test_save_snapshot_reads_the_table(self):
+        self.init()
+        Tile.objects.create(id = 9, origin_id = self.tiles[0].origin_id, size = 30, hash = '%064x'%9)
+        snapshot = Tile.save_snapshot()
+        self.assertEqual(snapshot.ids.tolist(), [1, 2, 3, 4, 9])
+        self.assertEqual(snapshot.contents, Tile.contents())
+
+
+class BenchmarkTest(TestCase):
+    def test_run_and_compare(self):
+        Tile._POINTS = points = {}
+        try:
+            report = benchmark.run(40, only = ['Tile.distance', 'LSH.project_many'], repeat = 1, min_time = 0)
+            self.assertTrue(Tile._POINTS is points)
+        finally:
+            del Tile._POINTS
+        self.assertEqual(sorted(report['results']), ['LSH.project_many', 'Tile.distance'])
+        baseline = json.loads(json.dumps(report))
+        baseline['results']['Tile.distance']['best'] /= 2
+        self.assertEqual(benchmark.compare(report, baseline), ['Tile.distance'])
+        self.assertAlmostEqual(report['results']['LSH.project_many']['ratio'], 1.0)
+
+
+class IngestTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.directory, 'sub'))
+        for i, (path, colour) in enumerate([('1.png', 'red'), ('sub/2.png', 'blue'), ('sub/3.png', 'red')]):
+            Image.new('RGB', (20, 20), colour).save(os.path.join(self.directory, path))
+        f = open(os.path.join(self.directory, '4.jpg'), 'wb')
+        f.write('not an image')
+        f.close()
+        open(os.path.join(self.directory, 'notes.txt'), 'w').close()
+        self.journal = os.path.join(self.directory, 'journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_crawl_imports_each_image_once(self):
+        counts = StockImage.crawl(self.directory, processes = 1, batch_size = 2, journal = self.journal)
+        self.assertEqual(counts, {'seen': 4, 'imported': 2, 'duplicate': 1, 'error': 1})
+        self.assertEqual(StockImage.objects.count(), 2)
+        stock = StockImage.objects.get(hash = ingest.read_image(os.path.join(self.directory, 'sub/2.png'))[0])
+        stock.image.open('rb')
+        self.assertEqual(Image.open(stock.image.file).getpixel((0, 0)), (0, 0, 255))
+        stock.image.close()
+
+    def test_crawl_resumes_from_journal(self):
+        StockImage.crawl(self.directory, processes = 1, journal = self.journal)
+        Image.new('RGB', (20, 20), 'green').save(os.path.join(self.directory, '5.png'))
+        #The file that failed is tried again, this time whole
+        Image.new('RGB', (20, 20), 'white').save(os.path.join(self.directory, '4.jpg'), 'JPEG')
+        counts = StockImage.crawl(self.directory, processes = 1, journal = self.journal)
+        self.assertEqual(counts, {'seen': 2, 'imported': 2, 'duplicate': 0, 'error': 0})
+
+    def test_import_image_skips_duplicates(self):
+        StockImage.import_image(os.path.join(self.directory, '1.png'))
+        self.assertEqual(StockImage.import_image(os.path.join(self.directory, 'sub/3.png')), None)
+        self.assertEqual(StockImage.objects.count(), 1)
+
+    def test_bounded_imap_waits_for_consumer(self):
+        fed = []
+        def items():
+            for i in range(20):
+                fed.append(i)
+                yield -i
+        pool = Pool(2)
+        try:
+            for n, result in enumerate(ingest.bounded_imap(pool, abs, items(), 3)):
+                self.assertEqual(result, n)
+                self.assertTrue(len(fed) <= n + 3)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(len(fed), 20)
+
+
+class ExportTest(TestCase):
+    def stock_image(self, size, image_format = 'PNG'):
+        #Red left quarter, green middle half, blue right quarter
+        x_size, y_size = size
+        im = Image.new('RGB', size, 'green')
+        im.paste((255, 0, 0), (0, 0, x_size/4, y_size))
+        im.paste((0, 0, 255), (x_size*3/4, 0, x_size, y_size))
+        buf = StringIO()
+        im.save(buf, image_format)
+        data = buf.getvalue()
+        name = 'stock.%s'%image_format.lower()
+        return StockImage.create_from_data(name, hashlib.sha256(data).hexdigest(), data)
+
+    def test_export_tiles_crops_center_square(self):
+        stock = self.stock_image((240, 120))
+        counts = StockImage.export_tiles([100, 60, 200], processes = 1)
+        self.assertEqual(counts, {'images': 1, 'created': 2, 'existing': 0, 'error': 0})
+        self.assertEqual(sorted(Tile.objects.values_list('size', flat = True)), [60, 100])
+        for tile in Tile.objects.all():
+            self.assertEqual(tile.origin_id, stock.id)
+            tile.image.open('rb')
+            im = Image.open(tile.image.file)
+            self.assertEqual(im.size, (tile.size, tile.size))
+            #The square spans the middle half, so it is all green
+            self.assertEqual(set(c for n, c in im.getcolors()), set([(0, 128, 0)]))
+            tile.image.close()
+            stored = TileFeatures.objects.get(hash = tile.hash)
+            self.assertEqual(tuple(stored.rgb_list), tile.rgb_list)
+
+    def test_existing_tiles_are_skipped(self):
+        self.stock_image((120, 120))
+        StockImage.export_tiles([50], processes = 1)
+        counts = StockImage.export_tiles([50], processes = 1)
+        self.assertEqual(counts['existing'], 1)
+        self.assertEqual(Tile.objects.count(), 1)
+
+    def test_reexport_with_a_different_hash_is_skipped(self):
+        self.stock_image((120, 120))
+        StockImage.export_tiles([50], processes = 1)
+        #As if decoded differently by an earlier export
+        Tile.objects.update(hash = 'f' * 64)
+        counts = StockImage.export_tiles([50, 60], processes = 1)
+        self.assertEqual((counts['created'], counts['existing']), (1, 1))
+        self.assertEqual(sorted(Tile.objects.values_list('size', flat = True)), [50, 60])
+
+    def test_export_tile(self):
+        stock = self.stock_image((120, 80))
+        self.assertEqual(stock.export_tile(100), False)
+        stock.export_tile(80)
+        self.assertEqual(Tile.objects.get().size, 80)
+
+    def test_jpeg_draft_decode(self):
+        buf = StringIO()
+        Image.new('RGB', (1600, 1200), 'white').save(buf, 'JPEG')
+        tiles = export.render(buf.getvalue(), [100, 150], 10)
+        self.assertEqual([t[0] for t in tiles], [150, 100])
+        for size, im_hash, data, tile_features in tiles:
+            im = Image.open(StringIO(data))
+            self.assertEqual((im.format, im.size), ('JPEG', (size, size)))
+            self.assertEqual(im_hash, hashlib.sha256(data).hexdigest())
+
+
+class CompareMethodLineageTest(TestCase):
+    def test_method_lineage_view(self):
+        mother, father = [CompareMethod.objects.create(lw = w, nw = 20.0, rw = 20.0, gw = 20.0, bw = 20.0) for w in (10.0, 30.0)]
+        mother._score = father._score = 1
+        child = CompareMethod.breed(father, mother)
+        self.assertEqual((child.generation, child.ancestor_ids), (1, sorted([mother.id, father.id])))
+        with self.assertNumQueries(4):
+            response = self.client.get('/compare/%i/lineage/'%child.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['ancestors'], [(0, [mother, father])])
+        response = self.client.get('/compare/%i/lineage/'%mother.id)
+        self.assertEqual(response.context['descendants'], [(1, [child])])
+
+
+class GenerateRoundTest(SyntheticPointsTestCase):
+    def test_pairs_draw_their_own_targets(self):
+        parents = [CompareMethod.objects.create(lw = w, nw = 20.0, rw = 20.0, gw = 20.0, bw = 20.0) for w in (5.0, 15.0, 25.0, 35.0)]
+        CompareMethod.generate_round(parents, 1, count = 5)
+        targets = {}
+        for test in CompareTest.objects.filter(sample_group = 1):
+            pair = tuple(sorted([test.method_a_id, test.method_b_id]))
+            targets.setdefault(pair, set()).add(test.target_id)
+        self.assertEqual(len(targets), 6)
+        self.assertTrue(all(len(ids) == 5 for ids in targets.values()))
+        pool = set().union(*targets.values())
+        #Drawn from 30 of the 40 tiles, not the same 5 for every pair
+        self.assertTrue(5 < len(pool) <= 30)
+        self.assertEqual(len(Tile._COMPONENTS), len(pool))
+
+
+class CompareEvolveTest(TestCase):
+    def setUp(self):
+        self.metrics_root = getattr(settings, 'METRICS_ROOT', None)
+        settings.METRICS_ROOT = tempfile.mkdtemp()
+        self.generate_round = CompareMethod.__dict__['generate_round']
+        self.rounds = []
+        def generate_round(cls, parents, next_group, count = 20):
+            self.rounds.append((sorted(p.id for p in parents), next_group))
+            return []
+        CompareMethod.generate_round = classmethod(generate_round)
+
+    def tearDown(self):
+        CompareMethod.generate_round = self.generate_round
+        shutil.rmtree(settings.METRICS_ROOT)
+        settings.METRICS_ROOT = self.metrics_root
+
+    def test_parents_are_the_winners_of_recent_groups(self):
+        methods = [CompareMethod.objects.create(lw = 20.0 + i, nw = 20.0, rw = 20.0, gw = 20.0, bw = 20.0) for i in range(15)]
+        wins = [(1, methods[5], 2), (1, methods[6], 1), (2, methods[7], 3), (2, methods[5], 1)]
+        for group, winner, count in wins:
+            for i in range(count):
+                CompareTest.objects.create(sample_group = group, target_id = 1, tile_a_id = 2, tile_b_id = 3, method_a = winner, method_b = methods[0], winner = winner)
+        CompareMethod.evolve()
+        (parents, next_group), = self.rounds
+        self.assertEqual(next_group, 3)
+        #The three winners and ten new methods
+        self.assertEqual(len(parents), 13)
+        self.assertTrue(set([methods[5].id, methods[6].id, methods[7].id]) <= set(parents))
+        self.assertFalse(methods[0].id in parents)
+
+
+class PendingTestsTest(TestCase):
+    def setUp(self):
+        rand = Random(13)
+        self.tiles = [synthetic_tile(i + 1, rand) for i in range(3)]
+        for i, tile in enumerate(self.tiles):
+            tile.hash = '%02i'%i * 32
+            tile.origin = StockImage.objects.create(image = 'stock/%i.jpg'%i, hash = tile.hash)
+            tile.save()
+            tile.store_features()
+        self.a, self.b = [CompareMethod.objects.create(lw = w, nw = 20.0, rw = 20.0, gw = 20.0, bw = 20.0) for w in (10.0, 30.0)]
+        self.tests = [CompareTest.objects.create(sample_group = 0, target = self.tiles[0], tile_a = self.tiles[1], tile_b = self.tiles[2], method_a = self.a, method_b = self.b) for i in range(3)]
+        pending_tests.invalidate()
+
+    def tearDown(self):
+        pending_tests.invalidate()
+
+    def test_claims_are_not_handed_out_twice(self):
+        claimed = [pending_tests.claim() for i in range(3)]
+        self.assertEqual(sorted(t.id for t in claimed), sorted(t.id for t in self.tests))
+        self.assertEqual(pending_tests.claim(), None)
+
+    def test_expired_claim_is_handed_out_again(self):
+        test = pending_tests.claim()
+        CompareTest.objects.filter(pk = test.pk).update(claimed_at = datetime.now() - timedelta(seconds = pending_tests.timeout + 1))
+        claimed = [pending_tests.claim() for i in range(3)]
+        self.assertTrue(test.id in [t.id for t in claimed])
+
+    def test_count_is_kept_in_the_shared_cache(self):
+        other = PendingTests(CompareTest, Tile)
+        self.assertEqual(pending_tests.remaining(), 3)
+        other.resolved()
+        self.assertEqual(pending_tests.remaining(), 2)
+        self.assertEqual(other.cache.get(other.key), 2)
+        self.assertTrue('compare' in settings.CACHES)
+
+    def test_vote_counts_once(self):
+        self.assertEqual(pending_tests.remaining(), 3)
+        test = self.tests[0]
+        self.client.get('/compare/', {'id': test.id, 'w': 'b'})
+        self.client.get('/compare/', {'id': test.id, 'w': 'a'})
+        self.assertEqual(CompareTest.objects.get(pk = test.id).winner, self.b)
+        self.assertEqual(pending_tests.remaining(), 2)
+        self.client.get('/compare/', {'id': self.tests[1].id, 'w': 'c'})
+        self.assertEqual(pending_tests.remaining(), 1)
+        response = self.client.get('/compare/')
+        self.assertEqual(response.context['test_id'], self.tests[2].id)
+        self.assertEqual(response.context['remaining'], 1)
+
+
+class PixelMapTest(TestCase):
+    def test_png_matches_pixel_map(self):
+        tile = synthetic_tile(1, Random(11))
+        im = Image.open(StringIO(pixelmap.render(tile.rgb_list, scale = 3)))
+        self.assertEqual(im.size, (30, 30))
+        for y, row in enumerate(tile.pixel_map):
+            for x, pixel in enumerate(row):
+                self.assertEqual('#%0.2X%0.2X%0.2X'%im.getpixel((x*3 + 2, y*3 + 1)), pixel)
+
+    def test_url_renders_once(self):
+        tile = synthetic_tile(1, Random(12))
+        tile.hash = 'ab' * 32
+        url = pixelmap.url(tile)
+        self.assertTrue(url.endswith(pixelmap.path(tile.hash)))
+        del tile._rgb_list
+        #Already rendered, so the features aren't needed again
+        self.assertEqual(pixelmap.url(tile), url)
+
+    def test_tile_without_hash(self):
+        tile = synthetic_tile(7, Random(12))
+        url = pixelmap.url(tile)
+        self.assertTrue(url.endswith(pixelmap.path('id7')))
+
+
+class TileFeaturesTest(TestCase):
+    def test_features_are_loaded_by_hash(self):
+        stored = synthetic_tile(1, Random(2))
+        stored.hash = 'a' * 64
+        stored.store_features()
+        self.assertEqual(TileFeatures.objects.count(), 1)
+        #Read back packed, unpacked only when a tile's features are used
+        self.assertTrue(isinstance(TileFeatures.objects.get().rgb_list, PackedFloatArray))
+
+        fresh = Tile(id = 1, size = 100, hash = stored.hash)
+        Tile.load_features([fresh])
+        self.assertEqual(fresh.rgb_list, stored.rgb_list)
+        self.assertEqual(fresh.mono_list, stored.mono_list)
+        self.assertEqual(fresh.str_list, stored.str_list)
+
+
+class FeatureExtractionTest(TestCase):
+    def crop_means(self, im):
+        """
+        The per-block ImageStat loop ``extract`` replaces.
+        """
+        means = []
+        for y in range(0, im.size[1], 10):
+            for x in range(0, im.size[0], 10):
+                means += ImageStat.Stat(im.crop((x, y, x+10, y+10))).mean
+        return tuple(means)
+
+    def noise(self, mode, size = 40):
+        rand = Random(3)
+        bands = len(Image.new(mode, (1, 1)).getbands())
+        data = ''.join(chr(rand.randint(0, 255)) for i in range(size*size*bands))
+        return Image.frombuffer(mode, (size, size), data, 'raw', mode, 0, 1)
+
+    def test_rgb_matches_image_stat(self):
+        im = self.noise('RGB')
+        rgb_list, mono_list, str_list = features.extract(im, 10)
+        self.assertEqual(rgb_list, self.crop_means(im))
+        self.assertEqual(mono_list, self.crop_means(im.convert('L')))
+        self.assertEqual(str_list, ''.join([chr(int(round(x))) for x in rgb_list]))
+
+    def test_mono_image_repeats_channels(self):
+        im = self.noise('L')
+        rgb_list, mono_list, str_list = features.extract(im, 10)
+        self.assertEqual(mono_list, self.crop_means(im))
+        self.assertEqual(rgb_list[::3], mono_list)
+        self.assertEqual(rgb_list[2::3], mono_list)
+
+    def test_palette_image_is_converted(self):
+        im = self.noise('RGB').convert('P')
+        rgb_list, mono_list, str_list = features.extract(im, 10)
+        self.assertEqual(rgb_list, self.crop_means(im.convert('RGB')))
+        self.assertEqual(mono_list, self.crop_means(im.convert('L')))
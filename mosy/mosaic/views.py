@@ -1,9 +1,10 @@
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
 from django.db import connection, transaction
+from django.db.models import Count, F
 from django.http import HttpResponseRedirect
 
-from mosy.mosaic.models import StockImage, Tile, CompareMethod, CompareTest
+from mosy.mosaic.models import StockImage, Tile, CompareMethod, CompareTest, pending_tests
 
 # Create your views here.
 def compare(request):
@@ -14,29 +15,29 @@ def compare(request):
   if test_id:
     res = request.GET.get('w', False)
     if res:
-      this_test = CompareTest.objects.get(pk = test_id)
+      #Only the first vote on a test counts
+      pending = CompareTest.objects.filter(pk = test_id, winner = None)
       if res == 'a':
-        this_test.winner = this_test.method_a
+        pending = pending.update(winner = F('method_a'))
       elif res == 'b':
-        this_test.winner = this_test.method_b
+        pending = pending.update(winner = F('method_b'))
       elif res == 'c':
-        this_test.delete()
-        return HttpResponseRedirect('/compare/')
-      if this_test.winner:
-        this_test.save()
-        return HttpResponseRedirect('/compare/')
-
-  if CompareTest.objects.filter(winner = None):
-    this_ct = CompareTest.objects.filter(winner = None).order_by('?')[:1].get()
-  else:
-    this_ct = None
-
-  data['remaining'] = CompareTest.objects.filter(winner = None).count()
+        pending = pending.count()
+        CompareTest.objects.filter(pk = test_id).delete()
+      else:
+        pending = 0
+      if pending:
+        pending_tests.resolved()
+      return HttpResponseRedirect('/compare/')
+
+  this_ct = pending_tests.claim()
+
+  data['remaining'] = pending_tests.remaining()
   if this_ct:
     data['test_id'] = this_ct.id
-    data['target_map'] = this_ct.target.pixel_map
-    data['a_map'] = this_ct.tile_a.pixel_map
-    data['b_map'] = this_ct.tile_b.pixel_map
+    data['target_map'] = this_ct.target.pixel_map_url
+    data['a_map'] = this_ct.tile_a.pixel_map_url
+    data['b_map'] = this_ct.tile_b.pixel_map_url
 
   context = RequestContext(request)
   return render_to_response(template, data, context)
@@ -49,7 +50,28 @@ def tile(request, tile_id):
 
   data['original'] = this_tile.origin
   data['tile'] = this_tile
-  data['pixel_map'] = this_tile.pixel_map
+  data['pixel_map'] = this_tile.pixel_map_url
+
+  context = RequestContext(request)
+  return render_to_response(template, data, context)
+
+def method_lineage(request, method_id):
+  template = 'lineage.html'
+  method = get_object_or_404(CompareMethod, pk = method_id)
+  ancestors, descendants = method.family()
+  #Fill in every score with one query rather than one per method
+  family = [method] + ancestors + descendants
+  wins = CompareTest.objects.filter(winner__in = family).values('winner').annotate(wins = Count('id'))
+  wins = dict((row['winner'], row['wins']) for row in wins)
+  for x in family:
+    x._score = wins.get(x.id, 0)
+  data = {}
+  data['title'] = 'Compare Method %i'%method.id
+  data['subject'] = method
+  data['depth'] = CompareMethod.ANCESTRY_DEPTH
+  data['width'] = CompareMethod.LINEAGE_WIDTH
+  data['ancestors'] = CompareMethod.by_generation(ancestors)
+  data['descendants'] = CompareMethod.by_generation(descendants)
 
   context = RequestContext(request)
   return render_to_response(template, data, context)
@@ -0,0 +1,149 @@
+"""Packed float array field implementation for Django."""
+
+import sys
+
+from array import array
+
+from django.db import models
+
+
+class PackedFloatArray(object):
+    """
+    A read-only sequence of floats backed by packed little-endian bytes.
+
+    The bytes are only unpacked the first time a value is needed, so rows
+    that are loaded but never look at the array don't pay for it.
+
+    """
+
+    def __init__(self, data, typecode='d'):
+        self._data = str(data)
+        self._typecode = typecode
+        self._values = None
+
+    @property
+    def values(self):
+        if self._values is None:
+            values = array(self._typecode)
+            values.fromstring(self._data)
+            if sys.byteorder == 'big':
+                values.byteswap()
+            self._values = values.tolist()
+            self._data = None
+        return self._values
+
+    def packed(self):
+        if self._data is not None:
+            return self._data
+        return pack(self.values, self._typecode)
+
+    def __len__(self):
+        if self._data is not None:
+            return len(self._data) / array(self._typecode).itemsize
+        return len(self._values)
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __eq__(self, other):
+        try:
+            return self.values == list(other)
+        except TypeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'PackedFloatArray(%r)' % self.values
+
+
+def pack(values, typecode='d'):
+    """
+    Pack a sequence of floats as little-endian bytes.
+    """
+    packed = array(typecode, values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tostring()
+
+
+def binary(connection, data):
+    """
+    Wrap ``data`` with the DB-API ``Binary`` of the backend behind
+    ``connection`` so it is sent as bytes rather than text.
+    """
+    return sys.modules[connection.__module__].Database.Binary(data)
+
+
+class PackedFloatArrayDescriptor(object):
+    """
+    Wraps raw bytes loaded from the database in a ``PackedFloatArray``.
+    Anything else assigned to the attribute (such as a list) is kept as is.
+
+    """
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            raise AttributeError(
+                "The '%s' attribute can only be accessed from %s instances."
+                % (self.field.name, owner.__name__))
+        return instance.__dict__[self.field.name]
+
+    def __set__(self, instance, value):
+        if isinstance(value, (str, buffer)):
+            value = PackedFloatArray(value, self.field.typecode)
+        instance.__dict__[self.field.name] = value
+
+
+class PackedFloatArrayField(models.Field):
+    """
+    Stores a sequence of floats as raw little-endian float64 (or float32 with
+    ``precision=32``) bytes in a binary column.  Values read back are
+    ``PackedFloatArray`` instances, which unpack lazily.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        precision = kwargs.pop('precision', 64)
+        assert precision in (32, 64)
+        self.typecode = precision == 64 and 'd' or 'f'
+        kwargs.setdefault('null', True)
+        kwargs.setdefault('editable', False)
+        super(PackedFloatArrayField, self).__init__(*args, **kwargs)
+
+    def contribute_to_class(self, cls, name):
+        super(PackedFloatArrayField, self).contribute_to_class(cls, name)
+        setattr(cls, self.name, PackedFloatArrayDescriptor(self))
+
+    def db_type(self, connection):
+        engine = connection.settings_dict['ENGINE']
+        if 'mysql' in engine:
+            return 'longblob'
+        if 'postgresql' in engine:
+            return 'bytea'
+        return 'blob'
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if value is None:
+            return None
+        if isinstance(value, PackedFloatArray):
+            data = value.packed()
+        else:
+            data = pack(value, self.typecode)
+        return binary(connection, data)
+
+    def value_to_string(self, obj):
+        return repr(list(self._get_val_from_obj(obj)))
+
+    def get_db_prep_lookup(self, lookup_type, value, connection, prepared=False):
+        if lookup_type != 'isnull':
+            raise TypeError('Lookup type %s is not supported.' % lookup_type)
+        return super(PackedFloatArrayField, self).get_db_prep_lookup(
+            lookup_type, value, connection, prepared)
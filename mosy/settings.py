@@ -49,6 +49,40 @@ USE_L10N = True
 # Example: "/home/media/media.lawrence.com/media/"
 MEDIA_ROOT = '/Users/aaronmerriam/Sites/mosy.com/public/'
 
+# Absolute filesystem path to the directory that holds data derived from the
+# tiles, such as the nearest neighbor graph.
+DATA_ROOT = '/Users/aaronmerriam/Sites/mosy.com/data/'
+
+# Directory the tile snapshot is published to.  Every web and evolver process
+# on a host maps the same file, so the corpus is held in memory once; a
+# memory-backed directory such as /dev/shm keeps it from being paged out.
+POINT_STORE_ROOT = DATA_ROOT
+
+# Per generation timings of the evolution loops, one rotating file per loop,
+# shown to staff at /metrics/.  LSH.work() processes store theirs in the
+# database instead, so the page sees every host's.
+METRICS_ROOT = DATA_ROOT + 'metrics'
+
+# The leaderboard caches the best hashes for the index page.  An evolver on
+# the web host updates it as it saves hashes, but LSH.work() processes on
+# other hosts can't reach it, so it only lives for a minute before it is
+# read from the table again.  The count of pending compare tests is shared by
+# every web process on the host.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'leaderboard': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': DATA_ROOT + 'cache/leaderboard',
+        'TIMEOUT': 60,
+    },
+    'compare': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': DATA_ROOT + 'cache/compare',
+    },
+}
+
 # URL that handles the media served from MEDIA_ROOT. Make sure to use a
 # trailing slash.
 # Examples: "http://media.lawrence.com/media/", "http://example.com/media/"
@@ -101,6 +135,7 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'debug_toolbar.middleware.DebugToolbarMiddleware',
+    'mosy.mosaic.middleware.PointStoreMiddleware',
 )
 
 ROOT_URLCONF = 'mosy.urls'
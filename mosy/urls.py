@@ -9,10 +9,13 @@ urlpatterns = patterns('',
     # url(r'^$', 'mosy.views.home', name='home'),
     # url(r'^mosy/', include('mosy.foo.urls')),
     (r'^compare/$', 'mosy.mosaic.views.compare'),
+    (r'^compare/(?P<method_id>[0-9]+)/lineage/$', 'mosy.mosaic.views.method_lineage'),
     (r'^$', 'mosy.knn.views.index'),
     (r'^d/(?P<dp_id>[0-9]+)/$', 'mosy.knn.views.datapoint'),
     (r'^t/(?P<tile_id>[0-9]+)/$', 'mosy.mosaic.views.tile'),
     (r'^(?P<lsh_id>[0-9]+)/$', 'mosy.knn.views.detail'),
+    (r'^(?P<lsh_id>[0-9]+)/lineage/$', 'mosy.knn.views.lineage'),
+    (r'^metrics/$', 'mosy.knn.views.metrics'),
 
     # Uncomment the admin/doc line below to enable admin documentation:
     # url(r'^admin/doc/', include('django.contrib.admindocs.urls')),